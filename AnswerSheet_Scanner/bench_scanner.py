@@ -0,0 +1,151 @@
+"""
+Speed and accuracy benchmark for the scanner (multi_column_correction) and the student ID OMR.
+
+Runs over a corpus from synth_sheets.py and reports images/sec, mean time per stage and accuracy against the ground
+truth: column boxes found in the right place, the share of sheets scanner.py would rename to err-, and student ID
+digits read correctly by Task_AnswerSheetName.
+
+    python synth_sheets.py --out ./synthetic --count 200 --severity 0,0.5,1
+    python bench_scanner.py ./synthetic --output bench.json
+    python bench_scanner.py ./synthetic --compare bench.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+import pic_4pCorrect
+from synth_sheets import ID_DIGITS
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "distributed_ai_caller"))
+import Task_AnswerSheetName
+
+EXPECTED_COLUMNS = 6
+
+
+class StageTimer:
+    """Trace factory for multi_column_correction that sums the seconds spent in each stage."""
+
+    def __init__(self):
+        self.totals = {}
+
+    @contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - start
+
+
+def count_matched_boxes(image, truth_boxes, min_area, max_contours):
+    """Number of detected boxes whose centre lies inside the ground-truth box at the same position in the order."""
+    preprocessed = pic_4pCorrect.preprocess_image(image)
+    found = pic_4pCorrect.order_boxes(pic_4pCorrect.find_column_contours(preprocessed, min_area, max_contours),
+                                      image.shape[1])
+    matched = 0
+    for box, truth in zip(found, truth_boxes):
+        centre = tuple(float(v) for v in box.mean(axis=0))
+        matched += cv2.pointPolygonTest(np.array(truth, dtype=np.float32).reshape(-1, 1, 2), centre, False) >= 0
+    return matched
+
+
+def benchmark(corpus_dir, min_area=5000, max_contours=6, visualize=False):
+    with open(os.path.join(corpus_dir, "ground_truth.json")) as f:
+        truths = json.load(f)
+
+    timer = StageTimer()
+    by_severity = {}
+    for file, truth in truths.items():
+        with timer('read'):
+            image = cv2.imread(os.path.join(corpus_dir, file))
+        result = pic_4pCorrect.multi_column_correction(image, min_area, max_contours, visualize, trace=timer)
+        columns = result[0] if visualize else result
+
+        student_id = None
+        if columns:
+            with timer('omr'):
+                try:
+                    student_id = Task_AnswerSheetName.recognize_image(columns[0])
+                except Exception:
+                    pass
+
+        # Accuracy bookkeeping is outside the timed stages
+        stats = by_severity.setdefault(str(truth['severity']), {'sheets': 0, 'boxes_matched': 0, 'err': 0,
+                                                                 'id_digits_correct': 0, 'ids_correct': 0})
+        stats['sheets'] += 1
+        stats['boxes_matched'] += count_matched_boxes(image, truth['boxes'], min_area, max_contours)
+        stats['err'] += len(columns) != EXPECTED_COLUMNS
+        if student_id:
+            stats['id_digits_correct'] += sum(a == b for a, b in zip(student_id, truth['student_id']))
+            stats['ids_correct'] += student_id == truth['student_id']
+
+    sheets = len(truths)
+    elapsed = sum(timer.totals.values())
+    report = {
+        'sheets': sheets,
+        'images_per_sec': round(sheets / elapsed, 3) if elapsed else 0.0,
+        'stage_ms': {name: round(total / sheets * 1000, 2) for name, total in timer.totals.items()},
+        'accuracy': {},
+    }
+    for severity, stats in sorted(by_severity.items()):
+        n = stats['sheets']
+        report['accuracy'][severity] = {
+            'sheets': n,
+            'boxes_matched_rate': round(stats['boxes_matched'] / (n * EXPECTED_COLUMNS), 4),
+            'err_rate': round(stats['err'] / n, 4),
+            'id_digit_accuracy': round(stats['id_digits_correct'] / (n * ID_DIGITS), 4),
+            'id_accuracy': round(stats['ids_correct'] / n, 4),
+        }
+    return report
+
+
+def print_report(report, baseline=None):
+    def delta(value, old):
+        return f" ({value - old:+.3f})" if old is not None else ''
+
+    print(f"{report['sheets']} sheets, {report['images_per_sec']:.2f} images/sec"
+          f"{delta(report['images_per_sec'], baseline and baseline['images_per_sec'])}")
+    print("Mean time per stage (ms):")
+    for name, ms in report['stage_ms'].items():
+        old = baseline and baseline['stage_ms'].get(name)
+        print(f"  {name:<32}{ms:>10.2f}{delta(ms, old)}")
+    print(f"{'severity':<10}{'sheets':>8}{'boxes ok':>10}{'err-':>8}{'id digits':>11}{'ids':>8}")
+    for severity, acc in report['accuracy'].items():
+        print(f"{severity:<10}{acc['sheets']:>8}{acc['boxes_matched_rate']:>10.1%}{acc['err_rate']:>8.1%}"
+              f"{acc['id_digit_accuracy']:>11.1%}{acc['id_accuracy']:>8.1%}")
+        old = baseline and baseline['accuracy'].get(severity)
+        if old:
+            print(f"{'':<18}vs baseline: boxes {acc['boxes_matched_rate'] - old['boxes_matched_rate']:+.1%}, "
+                  f"err- {acc['err_rate'] - old['err_rate']:+.1%}, "
+                  f"id digits {acc['id_digit_accuracy'] - old['id_digit_accuracy']:+.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scanner and OMR on a synthetic corpus")
+    parser.add_argument('corpus', help="directory written by synth_sheets.py")
+    parser.add_argument('--min-area', type=int, default=5000)
+    parser.add_argument('--max-contours', type=int, default=6)
+    parser.add_argument('--visualize', action='store_true', help="include the detected_columns rendering")
+    parser.add_argument('--output', help="write the report as JSON")
+    parser.add_argument('--compare', help="JSON report of an earlier run to compare against")
+    args = parser.parse_args()
+
+    report = benchmark(args.corpus, args.min_area, args.max_contours, args.visualize)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+调试图按需生成，不占用扫描和批改的时间
+
+以前每份答卷都复制整张原图、画出检测到的列框并写一张全尺寸的 detected_columns.jpg。现在每份答卷只写一个很小的
+debug.json（原图路径、页码和各列框的四个角点）；只有异常（err-）答卷和按抽样率选中的答卷由后台进程读原图、画框、写盘，
+其余答卷在复核界面（Showoff）第一次打开调试图时才生成。
+"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+import page_source
+import pic_4pCorrect
+import quality_gate
+
+DEBUG_FILE = "debug.json"
+DEBUG_IMAGE = "detected_columns.jpg"
+
+
+def sampled(name, rate):
+    # 按文件名哈希抽样，重复运行时抽中的是同一批答卷
+    if rate <= 0:
+        return False
+    return int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:8], 16) / 0x100000000 < rate
+
+
+def render_detected_columns(folder):
+    """按 folder/debug.json 在原图上画出列框，写入 folder/detected_columns.jpg；返回其路径，原图已不存在时返回 None"""
+    with open(os.path.join(folder, DEBUG_FILE), "r", encoding="utf-8") as f:
+        info = json.load(f)
+    # 文档中的页按记录的页码和分辨率重新光栅化
+    try:
+        image = page_source.load_page(page_source.Page(info["source"], info.get("page"), None),
+                                      info.get("dpi", page_source.DEFAULT_DPI))
+    finally:
+        page_source.close()
+    if image is None:
+        return None
+    # 列框是在质量检查转正后的图上检测的
+    image = quality_gate.rotate(image, info.get("rotation", 0))
+    path = os.path.join(folder, DEBUG_IMAGE)
+    cv2.imwrite(path, pic_4pCorrect.draw_columns(image, info["boxes"]))
+    return path
+
+
+def _report(future):
+    if future.exception() is not None:
+        print("调试图生成失败:", future.exception())
+
+
+class DebugArtifacts:
+    """
+    Args:
+    sample_rate (float): 正常答卷中生成调试图的比例，0 表示只为异常答卷生成
+    """
+
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self.executor = None
+        # record 由多个扫描线程同时调用，后台进程只能创建一次
+        self.lock = threading.Lock()
+
+    def record(self, folder, page, boxes, anomaly, rotation=0, dpi=page_source.DEFAULT_DPI):
+        info = {"source": os.path.abspath(page.path), "page": page.index, "dpi": dpi, "rotation": rotation,
+                "boxes": [box.tolist() for box in boxes]}
+        with open(os.path.join(folder, DEBUG_FILE), "w", encoding="utf-8") as f:
+            json.dump(info, f)
+        if anomaly or sampled(os.path.basename(folder), self.sample_rate):
+            with self.lock:
+                if self.executor is None:
+                    # 画图在单独的进程里进行，不与扫描争抢GIL
+                    self.executor = ProcessPoolExecutor(max_workers=1)
+            self.executor.submit(render_detected_columns, folder).add_done_callback(_report)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -15,7 +15,7 @@ for folder_name in os.listdir("../distributed_ai_caller/output"):
     if os.path.isdir(folder_path) and not folder_name.startswith("err-"):
         detected_columns_path = os.path.join(folder_path, "detected_columns.jpg")
 
-        # 检查detected_columns.jpg是否存在
+        # 检查detected_columns.jpg是否存在（只有抽样的答卷会预先生成，其余在Showoff中按需查看）
         if os.path.exists(detected_columns_path):
             # 从文件夹名称中提取序号（去掉.jpg后缀）
             original_number = folder_name.rstrip('.jpg')
@@ -23,10 +23,16 @@ for folder_name in os.listdir("../distributed_ai_caller/output"):
             # 构造新的文件名，保持原始序号
             new_filename = f"{original_number}-detected_columns.jpg"
 
-            # 复制文件到reviews文件夹
-            shutil.copy(detected_columns_path, os.path.join("./reviews", new_filename))
+            # 以硬链接放入reviews文件夹，不再复制整张图片；跨磁盘等无法链接时才复制
+            review_path = os.path.join("./reviews", new_filename)
+            if os.path.exists(review_path):
+                os.remove(review_path)
+            try:
+                os.link(detected_columns_path, review_path)
+            except OSError:
+                shutil.copy(detected_columns_path, review_path)
 
-            print(f"Copied {detected_columns_path} to ./reviews/{new_filename}")
+            print(f"Linked {detected_columns_path} to {review_path}")
 
             processed_files += 1
 
@@ -0,0 +1,150 @@
+"""
+从 target 读取答题卡页面：散放的图片，以及复印机扫描仪输出的多页 PDF 和 TIFF
+
+iter_pages 只列出页面（文件路径、页码和页面 id），不解码；load_page 在处理到某一页时才把它光栅化，处理完即释放，
+所以同时在内存中的页面只有正在处理的那几页，与文档有几百页无关。load_page 让最近读的文档保持打开，读到另一个文件时
+关闭它；处理完所有页面后调用 close() 关闭最后一个。
+
+页面 id 用作 output/ 下的文件夹名：散放的图片沿用文件名（1.jpg），文档中的页为“文件名-p页码”（batch.pdf-p0007），
+重新扫描同一份文档时不变。
+
+PDF 使用 pypdfium2（已列入 requirements.txt），未安装时跳过 PDF 并给出提示；TIFF 使用 Pillow。
+"""
+import os
+import threading
+from collections import namedtuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+TIFF_EXTENSIONS = (".tif", ".tiff")
+PDF_EXTENSIONS = (".pdf",)
+# 答题卡的框线和手写字在200 DPI下足够清晰；A4一页约1650x2340像素
+DEFAULT_DPI = 200
+
+# index 为文档中的页码（从0开始），散放的图片为 None
+Page = namedtuple("Page", ["path", "index", "page_id"])
+
+# pdfium 和打开的 TIFF 都不是线程安全的，文档操作串行进行；最近读的文档保持打开，顺序读页时不必反复解析，
+# TIFF 也只需从当前帧向后 seek，不必每页从第一帧数起
+_lock = threading.Lock()
+_open = {}
+
+
+def _document(path):
+    if path not in _open:
+        _close_documents()
+        ext = os.path.splitext(path)[1].lower()
+        _open[path] = Image.open(path) if ext in TIFF_EXTENSIONS else pdfium.PdfDocument(path)
+    return _open[path]
+
+
+def _close_documents():
+    for document in _open.values():
+        document.close()
+    _open.clear()
+
+
+def close():
+    """关闭 load_page 仍打开的文档"""
+    with _lock:
+        _close_documents()
+
+
+def page_count(path):
+    # 只为数页而打开的文档数完即关闭
+    ext = os.path.splitext(path)[1].lower()
+    if ext in TIFF_EXTENSIONS:
+        with Image.open(path) as img:
+            return getattr(img, "n_frames", 1)
+    with _lock:
+        document = pdfium.PdfDocument(path)
+        try:
+            return len(document)
+        finally:
+            document.close()
+
+
+def iter_pages(target):
+    """按文件名顺序逐个给出 target 下所有文件的页面"""
+    warned = False
+    for root, dirs, files in os.walk(target):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            ext = os.path.splitext(file)[1].lower()
+            if ext in IMAGE_EXTENSIONS:
+                yield Page(path, None, file)
+            elif ext in TIFF_EXTENSIONS or ext in PDF_EXTENSIONS:
+                if ext in PDF_EXTENSIONS and pdfium is None:
+                    if not warned:
+                        print("未安装 pypdfium2，跳过 PDF 文件（pip install pypdfium2）")
+                        warned = True
+                    continue
+                try:
+                    count = page_count(path)
+                except Exception as e:
+                    # 损坏或不完整的文档跳过，不影响其余文件
+                    print(f"无法读取文档 '{path}'，已跳过: {e}")
+                    continue
+                for index in range(count):
+                    yield Page(path, index, f"{file}-p{index + 1:04d}")
+
+
+def _to_bgr(img):
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("L" if img.mode in ("1", "I;16", "I", "F") else "RGB")
+    array = np.asarray(img)
+    return cv2.cvtColor(array, cv2.COLOR_GRAY2BGR if array.ndim == 2 else cv2.COLOR_RGB2BGR)
+
+
+def load_page(page, dpi=DEFAULT_DPI):
+    """
+    把一页光栅化为 BGR 图像
+
+    Args:
+    page (Page): iter_pages 给出的页面
+    dpi (int): PDF 的渲染分辨率；分辨率更高的 TIFF 页也缩小到这一分辨率
+
+    Returns:
+    numpy.ndarray: BGR 图像，无法读取时为 None
+    """
+    if page.index is None:
+        return cv2.imread(page.path)
+    try:
+        return _render_page(page, dpi)
+    except Exception as e:
+        # 与 cv2.imread 一致，读不出的页返回 None，由调用方按无法读取处理；出错的文档不再复用
+        print(f"无法读取 '{page.path}' 第{page.index + 1}页: {e}")
+        close()
+        return None
+
+
+def _render_page(page, dpi):
+    ext = os.path.splitext(page.path)[1].lower()
+    if ext in TIFF_EXTENSIONS:
+        with _lock:
+            img = _document(page.path)
+            img.seek(page.index)
+            image = _to_bgr(img)
+            source_dpi = img.info.get("dpi", (0, 0))[0]
+        if source_dpi and source_dpi > dpi:
+            scale = dpi / float(source_dpi)
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return image
+    with _lock:
+        pdf_page = _document(page.path)[page.index]
+        try:
+            bitmap = pdf_page.render(scale=dpi / 72)
+            image = _to_bgr(bitmap.to_pil())
+            bitmap.close()
+        finally:
+            pdf_page.close()
+    return image
@@ -1,5 +1,6 @@
 import cv2
 import numpy as np
+from contextlib import nullcontext
 
 
 def preprocess_image(image):
@@ -75,7 +76,33 @@ def order_boxes(boxes, image_width):
     return final_order
 
 
-def multi_column_correction(image, min_area=10000, max_contours=10, visualize=True):
+def _no_trace(name):
+    return nullcontext()
+
+
+def detect_columns(image, min_area=10000, max_contours=10, trace=None):
+    """Find the column boxes of an exam paper image, in reading order."""
+    trace = trace or _no_trace
+    with trace('scanner.preprocess'):
+        preprocessed = preprocess_image(image)
+    with trace('scanner.find_contours'):
+        column_boxes = find_column_contours(preprocessed, min_area, max_contours)
+    with trace('scanner.order_boxes'):
+        return order_boxes(column_boxes, image.shape[1])
+
+
+def draw_columns(image, boxes):
+    """Copy of the image with the numbered column boxes drawn on it, for checking detection by eye."""
+    vis_image = image.copy()
+    for i, box in enumerate(boxes):
+        box = np.asarray(box, dtype=np.int32)
+        cv2.drawContours(vis_image, [box], 0, (0, 255, 0), 2)
+        x, y = box[0]
+        cv2.putText(vis_image, str(i + 1), (int(x), int(y)), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 2)
+    return vis_image
+
+
+def multi_column_correction(image, min_area=10000, max_contours=10, visualize=True, trace=None):
     """
     Correct perspective and extract columns from an exam paper image.
 
@@ -84,23 +111,20 @@ def multi_column_correction(image, min_area=10000, max_contours=10, visualize=Tr
     min_area (int): Minimum contour area to consider as a column
     max_contours (int): Maximum number of contours to process
     visualize (bool): Whether to create a visualization image
+    trace (callable): Optional factory returning a context manager that times the named stage, e.g. tracing.span
 
     Returns:
     tuple: (list of corrected column images, visualization image if visualize=True else None)
     """
-    preprocessed = preprocess_image(image)
-    column_boxes = find_column_contours(preprocessed, min_area, max_contours)
-
-    ordered_boxes = order_boxes(column_boxes, image.shape[1])
+    trace = trace or _no_trace
+    ordered_boxes = detect_columns(image, min_area, max_contours, trace)
 
-    corrected_columns = [perspective_transform(image, box) for box in ordered_boxes]
+    with trace('scanner.perspective_transform'):
+        corrected_columns = [perspective_transform(image, box) for box in ordered_boxes]
 
     if visualize:
-        vis_image = image.copy()
-        for i, box in enumerate(ordered_boxes):
-            cv2.drawContours(vis_image, [box], 0, (0, 255, 0), 2)
-            x, y = box[0]
-            cv2.putText(vis_image, str(i + 1), (int(x), int(y)), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 2)
+        with trace('scanner.visualize'):
+            vis_image = draw_columns(image, ordered_boxes)
         return corrected_columns, vis_image
     else:
         return corrected_columns
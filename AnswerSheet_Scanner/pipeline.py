@@ -0,0 +1,111 @@
+"""
+扫描并批改，答题卡裁剪全程留在内存中
+
+分步批改时每个裁剪写成 JPEG，批改时再读回、重新编码，既多了磁盘读写又多了一次有损压缩。这里在同一进程内完成：
+scanner.scan_page 得到的裁剪只编码一次，直接随请求提交给考号识别和填空批改；需要复核时，同样的字节在后台线程写入
+output/<文件名>/corrected_column_N.jpg，并记入批改清单，之后运行 Task_AnswerSheetReview.py 不会重复处理。
+直接运行 scanner.py 也走这条路径，只是默认不写裁剪。
+
+    python pipeline.py --target ./target
+    python pipeline.py --target ./target --no-crops
+    python pipeline.py --target ./scans --dpi 200      # 复印机扫描的多页PDF/TIFF
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import page_source
+import quality_gate
+import scanner
+from debug_artifacts import DebugArtifacts
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "distributed_ai_caller"))
+import tracing
+import Task_AnswerSheetNamerec
+import Task_AnswerSheetReview
+from adaptive_concurrency import AIMDController, GatewayProbe, run_adaptive
+from grading_manifest import RunManifest, text_hash
+from image_utils import bytes_to_base64
+
+
+def process_sheet(page, answer_key, writer, debug, manifest, save_crops=True, rescan=None,
+                  dpi=page_source.DEFAULT_DPI):
+    with tracing.span("pipeline.sheet", path=page.path, page=page.index):
+        # 模糊、过暗、裁切不全的照片不做矫正和批改，记入补扫队列
+        scan = scanner.scan_page(page, debug, rescan, dpi, tracing.span)
+        if scan is None:
+            return None
+        folder, encoded = scan.folder, scan.encoded
+        if save_crops or scan.anomaly:
+            scanner.save_crops(writer, scan)
+        if scan.anomaly:
+            # 列数不对的答卷保存裁剪供人工检查，不送批改
+            print("Anomaly detected in", page.page_id)
+            return None
+
+        student = Task_AnswerSheetNamerec.evlaulateTask1(page.path, image=bytes_to_base64(encoded[0]))
+        extracted = Task_AnswerSheetReview.extract_answers(scan.columns[1])
+        verdicts = Task_AnswerSheetReview.judge_answers(extracted, answer_key, list(answer_key))
+
+    result = json.dumps(verdicts, ensure_ascii=False, indent=4) if isinstance(verdicts, dict) else verdicts
+    if save_crops:
+        # 与 Task_AnswerSheetReview 的清单格式一致，之后增量批改时这份答卷视为已完成
+        manifest.update(os.path.relpath(f"{folder}/corrected_column_2.jpg"),
+                        image_hash=hashlib.sha256(encoded[1]).hexdigest(),
+                        extract_version=Task_AnswerSheetReview.EXTRACT_VERSION, extracted=extracted,
+                        compare_version=Task_AnswerSheetReview.COMPARE_VERSION,
+                        key_hashes={q: text_hash(a) for q, a in answer_key.items()},
+                        verdicts=verdicts if isinstance(verdicts, dict) else None,
+                        status="done", result=result, error=None)
+    return folder, student, {"status": "success", "result": result}
+
+
+def save_results(page, outcome):
+    if outcome is None:
+        return
+    folder, student, result = outcome
+    Task_AnswerSheetNamerec.save_result(f"{folder}/corrected_column_1.jpg", student)
+    Task_AnswerSheetReview.save_result(f"{folder}/corrected_column_2.jpg", result)
+
+
+def run(target, dpi=page_source.DEFAULT_DPI, save_crops=True, debug_sample_rate=0.0,
+        rescan_queue="./output/rescan_queue.jsonl", no_gate=False, manifest="./output/review_manifest.json", job=None):
+    Task_AnswerSheetNamerec.JOB_ID = Task_AnswerSheetReview.JOB_ID = job
+    answer_key = json.loads(Task_AnswerSheetReview.ANSWER)
+    # 只列出页面，PDF/TIFF的每页在处理时才光栅化，同时在内存中的页数不超过并发数
+    pages = list(page_source.iter_pages(target))
+
+    os.makedirs("output", exist_ok=True)
+    rescan = None if no_gate else quality_gate.RescanQueue(rescan_queue)
+    # 裁剪图在后台线程写盘，不占用扫描和批改的时间
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="crop-writer") as writer, \
+            DebugArtifacts(debug_sample_rate) as debug, RunManifest(manifest) as run_manifest:
+        try:
+            run_adaptive(pages,
+                         lambda page: process_sheet(page, answer_key, writer, debug, run_manifest, save_crops, rescan,
+                                                   dpi),
+                         AIMDController(initial=2), on_result=save_results, probe=GatewayProbe("http://localhost:5000"))
+        finally:
+            page_source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="扫描./target下的答题卡并直接提交批改")
+    parser.add_argument("--target", default="./target", help="答题卡图片，以及多页PDF/TIFF")
+    parser.add_argument("--dpi", type=int, default=page_source.DEFAULT_DPI, help="PDF页面的渲染分辨率")
+    parser.add_argument("--no-crops", action="store_true", help="不保存裁剪图（异常答卷仍会保存）")
+    parser.add_argument("--debug-sample-rate", type=float, default=0.0,
+                        help="为这一比例的正常答卷生成detected_columns.jpg（异常答卷总会生成），默认0")
+    parser.add_argument("--manifest", default="./output/review_manifest.json")
+    parser.add_argument("--rescan-queue", default="./output/rescan_queue.jsonl", help="未通过质量检查的照片及原因")
+    parser.add_argument("--no-gate", action="store_true", help="跳过扫描前的质量检查")
+    parser.add_argument("--job", help="批改任务（job）id，多位老师同时批改时按权重公平分配worker")
+    args = parser.parse_args()
+    run(args.target, args.dpi, not args.no_crops, args.debug_sample_rate, args.rescan_queue, args.no_gate,
+        args.manifest, args.job)
+
+if __name__ == "__main__":
+    main()
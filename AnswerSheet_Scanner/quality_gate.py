@@ -0,0 +1,163 @@
+"""
+扫描前的快速质量检查：在缩小的副本上用几毫秒判断一张照片能否批改
+
+模糊、过暗、裁切不全的手机照片以前要走完整的 multi_column_correction，之后才以 err- 文件夹或模型的胡乱回复
+暴露出来，白白花掉一次付费的识别调用。这里先在长边 GATE_SIZE 像素的灰度副本上检查：
+
+- 清晰度：最强边缘处的梯度与对比度之比，失焦或抖动的照片边缘变缓
+- 曝光：纸面亮度和明暗对比
+- 画面覆盖：答题框是否完整、是否只占画面一小部分
+- 方向：按版式（左侧三分之一有四个框，中、右各一个高框）判断是否倒置或横置，并自动转正
+
+未通过的照片连同原因写入补扫队列（rescan_queue.jsonl），不再矫正和批改。
+
+    python quality_gate.py ./target
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+GATE_SIZE = 512
+# 清晰度：横、纵梯度99.5分位数中较小者与对比度之比；清晰的照片在4以上，明显失焦或抖动的在3以下
+MIN_SHARPNESS = 3.0
+# 曝光：纸面（90分位）亮度与明暗差（95分位 - 5分位）
+MIN_PAPER_LEVEL = 70
+MIN_CONTRAST = 60
+# 答题框外接矩形至少占画面的比例；框不全且有框碰到画面边缘（BORDER_MARGIN 像素内）视为被裁切
+EXPECTED_BOXES = 6
+MIN_COVERAGE = 0.2
+BORDER_MARGIN = 1
+MIN_BOX_AREA = 0.01
+ROTATIONS = {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+
+def rotate(image, angle):
+    """顺时针旋转 angle（0/90/180/270）度"""
+    return image if angle == 0 else cv2.rotate(image, ROTATIONS[angle])
+
+
+def downscale(image):
+    # 先按整数步长抽取到约两倍 GATE_SIZE 再做区域平均：整张大图做区域平均要十几毫秒
+    step = max(1, max(image.shape[:2]) // (2 * GATE_SIZE))
+    small = np.ascontiguousarray(image[::step, ::step])
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+    scale = GATE_SIZE / max(gray.shape)
+    if scale >= 1:
+        return gray
+    return cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def find_boxes(small):
+    """缩小图上的答题框外接矩形 (x, y, w, h)"""
+    mask = cv2.adaptiveThreshold(small, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 10)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    min_area = MIN_BOX_AREA * small.size
+    return [cv2.boundingRect(c) for c in contours if cv2.contourArea(c) > min_area]
+
+
+def layout_score(boxes, width):
+    # 正放时左侧三分之一有四个框、右侧一个；倒置时相反
+    left = sum(1 for x, y, w, h in boxes if x + w / 2 < width / 3)
+    right = sum(1 for x, y, w, h in boxes if x + w / 2 > width * 2 / 3)
+    return left - right
+
+
+def check(image):
+    """
+    检查一张答题卡照片
+
+    Args:
+    image (numpy.ndarray): BGR 或灰度原图
+
+    Returns:
+    dict: {"ok": 是否可批改, "reasons": 不通过的原因列表, "rotation": 需顺时针旋转的角度, "metrics": 各项测量值}
+    """
+    small = downscale(image)
+    p5, p90, p95 = np.percentile(small, (5, 90, 95))
+    contrast = float(p95 - p5)
+    # 分别取横、纵方向，单方向的抖动模糊也能发现
+    sharpness = min(float(np.percentile(np.abs(cv2.Sobel(small, cv2.CV_32F, dx, 1 - dx)), 99.5))
+                    for dx in (0, 1)) / max(contrast, 1.0)
+
+    # 纸面应是竖放的：横置的照片只需在90和270度中选，竖放的在0和180度中选
+    candidates = (90, 270) if small.shape[1] > small.shape[0] else (0, 180)
+    scored = []
+    for angle in candidates:
+        rotated = rotate(small, angle)
+        boxes = find_boxes(rotated)
+        scored.append((layout_score(boxes, rotated.shape[1]), angle, rotated.shape, boxes))
+    score, rotation, (height, width), boxes = max(scored, key=lambda s: s[0])
+    if score <= 0:
+        # 版式看不出方向时保持竖放
+        score, rotation, (height, width), boxes = scored[0]
+
+    reasons = []
+    if sharpness < MIN_SHARPNESS:
+        reasons.append("blurry")
+    if p90 < MIN_PAPER_LEVEL:
+        reasons.append("too_dark")
+    elif contrast < MIN_CONTRAST:
+        reasons.append("low_contrast")
+
+    coverage = 0.0
+    if boxes:
+        x0 = min(x for x, y, w, h in boxes)
+        y0 = min(y for x, y, w, h in boxes)
+        x1 = max(x + w for x, y, w, h in boxes)
+        y1 = max(y + h for x, y, w, h in boxes)
+        coverage = (x1 - x0) * (y1 - y0) / (width * height)
+        touches = x0 <= BORDER_MARGIN or y0 <= BORDER_MARGIN or x1 >= width - BORDER_MARGIN or \
+            y1 >= height - BORDER_MARGIN
+        if touches and len(boxes) < EXPECTED_BOXES:
+            reasons.append("cropped")
+    if coverage < MIN_COVERAGE:
+        reasons.append("page_too_small" if boxes else "no_answer_boxes")
+
+    return {
+        "ok": not reasons,
+        "reasons": reasons,
+        "rotation": rotation,
+        "metrics": {"sharpness": round(sharpness, 3), "paper_level": float(p90), "contrast": contrast,
+                    "coverage": round(coverage, 3), "boxes": len(boxes), "layout_score": score},
+    }
+
+
+class RescanQueue:
+    """未通过检查的照片，每行一条 JSON：路径、原因和测量值，补拍后重新放入 target 即可"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def add(self, image_path, report, page=None):
+        """page 为多页文档中的页码（从0开始）"""
+        entry = {"path": os.path.abspath(image_path), "reasons": report["reasons"], "metrics": report["metrics"],
+                 "time": time.time()}
+        if page is not None:
+            entry["page"] = page + 1
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检查文件夹中的答题卡照片，输出每张的检查结果")
+    parser.add_argument("target")
+    args = parser.parse_args()
+    for root, dirs, files in os.walk(args.target):
+        for file in sorted(files):
+            if file.endswith(".jpg"):
+                image = cv2.imread(os.path.join(root, file))
+                start = time.perf_counter()
+                report = check(image)
+                elapsed = (time.perf_counter() - start) * 1000
+                print(f"{file}: {'ok' if report['ok'] else ','.join(report['reasons'])} rotation={report['rotation']} "
+                      f"{report['metrics']} {elapsed:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
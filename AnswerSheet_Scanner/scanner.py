@@ -1,42 +1,142 @@
-import pic_4pCorrect
-import cv2
-import numpy as np
+import argparse
 import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import page_source
+import pic_4pCorrect
+import quality_gate
+from debug_artifacts import DebugArtifacts
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "distributed_ai_caller"))
+from image_utils import encode_jpeg
+
+# 单独运行时不记录耗时；设置环境变量 TRACE_SCANNER=1 时用distributed_ai_caller中的tracing记录各阶段耗时，
+# 否则不启动导出线程，也不写 traces.jsonl
+TRACE_SCANNER = bool(os.environ.get("TRACE_SCANNER"))
+if TRACE_SCANNER:
+    import tracing
+
+EXPECTED_COLUMNS = 6
+
+# 一页答卷的矫正结果：folder 为 output/ 下的文件夹，encoded 为各列只编码一次的 JPEG 字节
+Scan = namedtuple("Scan", ["folder", "image", "columns", "encoded", "anomaly"])
+
+
+def span(name, **attributes):
+    return tracing.span(name, **attributes) if TRACE_SCANNER else nullcontext()
+
+
+def _no_span(name, **attributes):
+    return nullcontext()
+
+
+def write_bytes(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def scan_page(page, debug, rescan=None, dpi=page_source.DEFAULT_DPI, trace=None):
+    """
+    矫正一页答题卡，裁剪留在内存中，由调用方决定提交批改还是写盘
+
+    Args:
+    page (Page): iter_pages 给出的页面
+    debug (DebugArtifacts): 记录列框，异常和抽样的答卷在后台生成调试图
+    rescan (RescanQueue): 未通过质量检查的照片记入此队列；None 表示跳过质量检查
+    trace (callable): tracing.span 一类的耗时记录，None 表示不记录
+
+    Returns:
+    Scan: 矫正结果，未通过质量检查时为 None；无法读取时抛出 ValueError
+    """
+    trace = trace or _no_span
+    with trace("scanner.read"):
+        image = page_source.load_page(page, dpi)
+    if image is None:
+        raise ValueError(f"无法读取图像文件 '{page.path}'")
+    rotation = 0
+    if rescan is not None:
+        # 模糊、过暗、裁切不全的照片不做矫正，记入补扫队列；倒置或横置的先转正
+        with trace("scanner.quality_gate"):
+            report = quality_gate.check(image)
+        if not report["ok"]:
+            print("需要补扫:", page.page_id, report["reasons"])
+            rescan.add(page.path, report, page.index)
+            return None
+        rotation = report["rotation"]
+        image = quality_gate.rotate(image, rotation)
+    boxes = pic_4pCorrect.detect_columns(image, min_area=5000, max_contours=EXPECTED_COLUMNS,
+                                         trace=None if trace is _no_span else trace)
+    with trace("scanner.perspective_transform"):
+        columns = [pic_4pCorrect.perspective_transform(image, box) for box in boxes]
+    # 列数不对则标记为异常，保存到err-原名文件夹
+    anomaly = len(columns) != EXPECTED_COLUMNS
+    folder = f"output/err-{page.page_id}" if anomaly else f"output/{page.page_id}"
+    os.makedirs(folder, exist_ok=True)
+    # 调试图只为异常和抽样的答卷在后台进程生成，其余在复核时按需生成
+    debug.record(folder, page, boxes, anomaly, rotation, dpi)
+    # 每个裁剪只编码一次：提交给模型和写入磁盘的是同一份字节
+    with trace("scanner.encode"):
+        encoded = [encode_jpeg(column) for column in columns]
+    return Scan(folder, image, columns, encoded, anomaly)
+
+
+def save_crops(writer, scan):
+    """在后台线程把裁剪写入 folder/corrected_column_N.jpg"""
+    for i, data in enumerate(scan.encoded):
+        writer.submit(write_bytes, f"{scan.folder}/corrected_column_{i + 1}.jpg", data)
+
+
+def scan_only(args):
+    # 分步批改：裁剪写入output/，之后由Task_AnswerSheetNamerec.py和Task_AnswerSheetReview.py读取
+    rescan = None if args.no_gate else quality_gate.RescanQueue(args.rescan_queue)
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="crop-writer") as writer, \
+            DebugArtifacts(args.debug_sample_rate) as debug:
+        try:
+            for page in page_source.iter_pages(args.target):
+                print("Processing:", page.page_id)
+                with span("scanner.sheet", path=page.path, page=page.index):
+                    try:
+                        scan = scan_page(page, debug, rescan, args.dpi, span if TRACE_SCANNER else None)
+                    except ValueError:
+                        print("Cannot read:", page.page_id)
+                        continue
+                    if scan is None:
+                        continue
+                    save_crops(writer, scan)
+                print("Saved", len(scan.encoded), "files")
+                if scan.anomaly:
+                    print("Anomaly detected in", page.page_id)
+                print("=" * 50)
+        finally:
+            page_source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="矫正./target下的答题卡并直接提交批改，裁剪留在内存中")
+    parser.add_argument("--target", default="./target", help="答题卡图片，以及多页PDF/TIFF")
+    parser.add_argument("--dpi", type=int, default=page_source.DEFAULT_DPI, help="PDF页面的渲染分辨率")
+    parser.add_argument("--save-crops", action="store_true",
+                        help="同时把裁剪写入output/供查看（异常答卷总会写入）")
+    parser.add_argument("--scan-only", action="store_true",
+                        help="只矫正不批改，把各列保存到output/，之后运行Task_AnswerSheet*.py分步批改")
+    parser.add_argument("--debug-sample-rate", type=float, default=0.0,
+                        help="为这一比例的正常答卷生成detected_columns.jpg（异常答卷总会生成），默认0")
+    parser.add_argument("--rescan-queue", default="output/rescan_queue.jsonl", help="未通过质量检查的照片及原因")
+    parser.add_argument("--no-gate", action="store_true", help="跳过扫描前的质量检查")
+    args = parser.parse_args()
+    os.makedirs("output", exist_ok=True)
+
+    if args.scan_only:
+        scan_only(args)
+        return
+    # 裁剪在内存中交给批改，与pipeline.py走同一条路径，只在 --save-crops 时写盘
+    import pipeline
+    pipeline.run(args.target, args.dpi, args.save_crops, args.debug_sample_rate, args.rescan_queue, args.no_gate)
 
-# 逐个遍历文件夹中的图片
-for root, dirs, files in os.walk("./target"):
-    for file in files:
-        if file.endswith(".jpg"):
-            image_path = os.path.join(root, file)
-            image = cv2.imread(image_path)
-            print("Processing:", image_path)
-            # 调用函数
-            result = pic_4pCorrect.multi_column_correction(image, min_area=5000, max_contours=6, visualize=True)
-            print("Saving results for:", image_path)
-
-
-            if len(result) == 2:
-                corrected_columns, vis_image = result
-                # cv2.imwrite(f"detected_columns_{file}", vis_image)
-                # 在output文件夹中创建对应的文件夹
-                os.makedirs(f"output/{file}", exist_ok=True)
-                # 将文件写入到output中的{file}子文件夹中
-                cv2.imwrite(f"output/{file}/detected_columns.jpg", vis_image)
-            else:
-                corrected_columns = result
-
-            # 保存每个矫正后的列
-            for i, column in enumerate(corrected_columns):
-                # cv2.imwrite(f"corrected_column_{file}_{i + 1}.jpg", column)
-                cv2.imwrite(f"output/{file}/corrected_column_{i + 1}.jpg", column)
-
-            # 输出保存了多少文件
-            print("Saved", len(corrected_columns) + 1, "files")
-
-            # 如果保存文件不是7个，则标记为异常
-            if len(corrected_columns) + 1 != 7:
-                print("Anomaly detected in", image_path)
-                # 重命名文件夹为err-原名
-                os.rename(f"output/{file}", f"output/err-{file}")
-            print("=" * 50)
 
+# 调试图在子进程中生成，子进程会重新导入本文件（Windows），扫描只在直接运行时进行
+if __name__ == "__main__":
+    main()
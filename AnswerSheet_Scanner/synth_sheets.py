@@ -0,0 +1,219 @@
+"""
+Render synthetic answer sheets with known ground truth, for testing and benchmarking the scanner and OMR code.
+
+The layout follows what multi_column_correction expects: four boxes stacked in the left third (student ID, the 12
+fill-in answers, then two working boxes) and one tall box in each of the middle and right thirds. Sheets are
+degraded with perspective skew, rotation, blur, a lighting gradient, noise and JPEG compression.
+
+    python synth_sheets.py --count 200 --out ./synthetic --widths 1240,2480 --severity 0.5
+"""
+import argparse
+import json
+import os
+
+import cv2
+import numpy as np
+
+ID_DIGITS = 6
+ANSWER_ROWS = 12
+# Box rectangles as fractions of page width/height, in the order multi_column_correction returns them
+BOX_LAYOUT = [
+    (0.04, 0.08, 0.31, 0.26),  # 1: name and student ID bubbles
+    (0.04, 0.28, 0.31, 0.70),  # 2: fill-in answers 1-12
+    (0.04, 0.72, 0.31, 0.84),  # 3
+    (0.04, 0.86, 0.31, 0.97),  # 4
+    (0.35, 0.08, 0.65, 0.97),  # 5
+    (0.69, 0.08, 0.96, 0.97),  # 6
+]
+# Student ID bubble grid inside box 1, as fractions of the box
+ID_GRID = (0.52, 0.10, 0.94, 0.92)
+# Width of the question-number label at the left of each answer row, as a fraction of box 2's width
+ANSWER_LABEL_WIDTH = 0.18
+ANSWER_VOCABULARY = ["1-2i", "4", "(2,3)", "3", "24", "60", "2/5", "5", "[0,6]", "sqrt2", "-1/4e", "pi/3", "x>1",
+                     "12", "-3", "y=2x+1", "(0,1)", "7/8"]
+A4_RATIO = 297 / 210
+
+
+def box_corners(rect, width, height):
+    x0, y0, x1, y1 = rect
+    return np.array([[x0 * width, y0 * height], [x1 * width, y0 * height],
+                     [x1 * width, y1 * height], [x0 * width, y1 * height]], dtype=np.float32)
+
+
+def draw_id_grid(page, box, student_id, rng):
+    x0, y0, x1, y1 = box
+    bw, bh = x1 - x0, y1 - y0
+    gx0, gy0 = int(x0 + ID_GRID[0] * bw), int(y0 + ID_GRID[1] * bh)
+    gx1, gy1 = int(x0 + ID_GRID[2] * bw), int(y0 + ID_GRID[3] * bh)
+    thickness = max(1, bw // 200)
+    cv2.rectangle(page, (gx0, gy0), (gx1, gy1), 0, thickness + 1)
+    col_w, row_h = (gx1 - gx0) / ID_DIGITS, (gy1 - gy0) / 10
+    radius = int(min(col_w, row_h) * 0.32)
+    font_scale = radius / 22
+    for col, digit in enumerate(student_id):
+        cx = int(gx0 + (col + 0.5) * col_w)
+        for row in range(10):
+            cy = int(gy0 + (row + 0.5) * row_h)
+            if row == int(digit):
+                # A pencil mark is rarely a perfect circle
+                axes = (int(radius * rng.uniform(0.9, 1.15)), int(radius * rng.uniform(0.85, 1.1)))
+                cv2.ellipse(page, (cx, cy), axes, rng.uniform(0, 180), 0, 360, int(rng.integers(20, 70)), -1)
+            else:
+                cv2.circle(page, (cx, cy), radius, 90, thickness)
+                cv2.putText(page, str(row), (cx - radius // 2, cy + radius // 2), cv2.FONT_HERSHEY_SIMPLEX,
+                            font_scale, 120, thickness)
+
+
+def draw_answers(page, box, answers, rng):
+    x0, y0, x1, y1 = box
+    bw, bh = x1 - x0, y1 - y0
+    row_h = bh / ANSWER_ROWS
+    thickness = max(1, bw // 250)
+    font_scale = row_h / 45
+    for i in range(ANSWER_ROWS):
+        top = int(y0 + i * row_h)
+        if i:
+            cv2.line(page, (x0, top), (x1, top), 110, thickness)
+        cv2.putText(page, f"{i + 1}.", (x0 + int(0.03 * bw), int(top + row_h * 0.68)), cv2.FONT_HERSHEY_SIMPLEX,
+                    font_scale * 0.8, 60, thickness)
+        answer = answers[str(i + 1)]
+        if answer:
+            # Slightly uneven handwriting position, weight and slant
+            x = int(x0 + (ANSWER_LABEL_WIDTH + rng.uniform(0.02, 0.15)) * bw)
+            y = int(top + row_h * rng.uniform(0.6, 0.8))
+            font = cv2.FONT_HERSHEY_SCRIPT_SIMPLEX if rng.random() < 0.5 else cv2.FONT_HERSHEY_SIMPLEX
+            cv2.putText(page, answer, (x, y), font, font_scale * rng.uniform(0.9, 1.2), int(rng.integers(10, 60)),
+                        thickness + 1)
+
+
+def draw_scribbles(page, box, rng):
+    x0, y0, x1, y1 = box
+    row_h = max(20, (x1 - x0) // 12)
+    for y in range(y0 + row_h, y1 - row_h // 2, row_h):
+        if rng.random() < 0.6:
+            text = ' '.join(rng.choice(ANSWER_VOCABULARY) for _ in range(int(rng.integers(1, 5))))
+            cv2.putText(page, text, (x0 + row_h // 2, y), cv2.FONT_HERSHEY_SCRIPT_SIMPLEX, row_h / 45, 50,
+                        max(1, row_h // 20))
+
+
+def render_sheet(student_id, answers, width, rng):
+    """Render a clean, upright sheet; returns (grayscale page, list of 6 box corner arrays)."""
+    height = int(width * A4_RATIO)
+    page = np.full((height, width), 245, dtype=np.uint8)
+    border = max(2, width // 400)
+    cv2.putText(page, "Mathematics Answer Sheet", (int(0.30 * width), int(0.05 * height)), cv2.FONT_HERSHEY_SIMPLEX,
+                width / 1300, 30, max(1, width // 600))
+
+    boxes = []
+    for i, rect in enumerate(BOX_LAYOUT):
+        corners = box_corners(rect, width, height)
+        x0, y0 = corners[0].astype(int)
+        x1, y1 = corners[2].astype(int)
+        cv2.rectangle(page, (x0, y0), (x1, y1), 20, border)
+        if i == 0:
+            cv2.putText(page, "Name", (x0 + width // 80, y0 + height // 30), cv2.FONT_HERSHEY_SIMPLEX, width / 2000,
+                        40, max(1, width // 800))
+            cv2.putText(page, "ID", (x0 + width // 80, y0 + height // 12), cv2.FONT_HERSHEY_SIMPLEX, width / 2000,
+                        40, max(1, width // 800))
+            draw_id_grid(page, (x0, y0, x1, y1), student_id, rng)
+        elif i == 1:
+            draw_answers(page, (x0, y0, x1, y1), answers, rng)
+        else:
+            draw_scribbles(page, (x0, y0, x1, y1), rng)
+        boxes.append(corners)
+    return page, boxes
+
+
+def degrade(page, boxes, rng, skew=0.03, rotation=3.0, blur=1.0, gradient=0.35, noise=3.0, jpeg_quality=85):
+    """Apply a random photo-like degradation; box corners are transformed along with the image."""
+    height, width = page.shape
+    src = np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float32)
+    jitter = rng.uniform(-skew, skew, size=(4, 2)) * [width, height]
+    matrix = cv2.getPerspectiveTransform(src, (src + jitter).astype(np.float32))
+    angle = rng.uniform(-rotation, rotation)
+    rotate = np.vstack([cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0), [0, 0, 1]])
+    matrix = rotate @ matrix
+    image = cv2.warpPerspective(page, matrix, (width, height), borderMode=cv2.BORDER_REPLICATE)
+    boxes = [cv2.perspectiveTransform(b.reshape(-1, 1, 2), matrix).reshape(4, 2) for b in boxes]
+
+    if blur > 0:
+        sigma = rng.uniform(0, blur) * width / 1240
+        if sigma > 0.3:
+            image = cv2.GaussianBlur(image, (0, 0), sigma)
+
+    image = image.astype(np.float32)
+    if gradient > 0:
+        direction = rng.uniform(0, 2 * np.pi)
+        yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+        ramp = (np.cos(direction) * xx / width + np.sin(direction) * yy / height)
+        ramp = (ramp - ramp.min()) / max(1e-6, ramp.max() - ramp.min())
+        image *= 1.0 - gradient * rng.uniform(0.3, 1.0) * ramp
+    if noise > 0:
+        image += rng.normal(0, noise, size=image.shape)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+
+    # Phone photos arrive as colour JPEGs
+    color = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    _, encoded = cv2.imencode('.jpg', color, [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)])
+    return cv2.imdecode(encoded, cv2.IMREAD_COLOR), boxes
+
+
+def random_truth(rng, blank_rate=0.2):
+    student_id = "220" + ''.join(str(d) for d in rng.integers(0, 10, size=ID_DIGITS - 3))
+    answers = {str(i): ("" if rng.random() < blank_rate else str(rng.choice(ANSWER_VOCABULARY)))
+               for i in range(1, ANSWER_ROWS + 1)}
+    return student_id, answers
+
+
+def generate_sheet(rng, width=1240, severity=0.5, blank_rate=0.2):
+    """Return (BGR image, ground truth dict) for one random sheet; severity scales every degradation."""
+    student_id, answers = random_truth(rng, blank_rate)
+    page, boxes = render_sheet(student_id, answers, width, rng)
+    params = {'skew': 0.04 * severity, 'rotation': 4.0 * severity, 'blur': 2.0 * severity,
+              'gradient': 0.5 * severity, 'noise': 6.0 * severity, 'jpeg_quality': 95 - 30 * severity}
+    image, boxes = degrade(page, boxes, rng, **params)
+    truth = {
+        'student_id': student_id,
+        'answers': answers,
+        'boxes': [b.round(1).tolist() for b in boxes],
+        'width': width,
+        'severity': severity,
+        'params': params,
+    }
+    return image, truth
+
+
+def generate_corpus(out_dir, count, widths=(1240,), severities=(0.5,), seed=0, blank_rate=0.2):
+    """Write count sheets plus ground_truth.json to out_dir, cycling through widths and severities."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    truths = {}
+    for i in range(count):
+        width = widths[i % len(widths)]
+        severity = severities[(i // len(widths)) % len(severities)]
+        image, truth = generate_sheet(rng, width, severity, blank_rate)
+        file = f"synthetic_{i:05d}.jpg"
+        cv2.imwrite(os.path.join(out_dir, file), image)
+        truths[file] = truth
+    with open(os.path.join(out_dir, "ground_truth.json"), 'w') as f:
+        json.dump(truths, f, indent=1)
+    return truths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic answer sheets with ground truth")
+    parser.add_argument('--out', default='./synthetic')
+    parser.add_argument('--count', type=int, default=50)
+    parser.add_argument('--widths', default='1240', help="comma-separated page widths in pixels")
+    parser.add_argument('--severity', default='0.5', help="comma-separated degradation levels, 0 = clean scan")
+    parser.add_argument('--blank-rate', type=float, default=0.2, help="fraction of answers left blank")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate_corpus(args.out, args.count, [int(w) for w in args.widths.split(',')],
+                    [float(s) for s in args.severity.split(',')], args.seed, args.blank_rate)
+    print(f"Wrote {args.count} sheets and ground_truth.json to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+# test_scanner.py
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest.mock import patch
+import cv2
+import numpy as np
+from PIL import Image
+import page_source
+import quality_gate
+import scanner
+import synth_sheets
+from debug_artifacts import DEBUG_FILE, DEBUG_IMAGE, DebugArtifacts, render_detected_columns
+
+
+class TestPageSource(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = self.enterContext(tempfile.TemporaryDirectory())
+        self.pages = [Image.new('L', (170, 240), shade) for shade in (50, 150, 250)]
+        self.addCleanup(page_source.close)
+
+    def save_document(self, name, **params):
+        path = os.path.join(self.folder, name)
+        self.pages[0].save(path, save_all=True, append_images=self.pages[1:], **params)
+        return path
+
+    def test_multi_page_tiff_pages_are_loaded_one_at_a_time(self):
+        self.save_document('batch.tif', dpi=(400, 400))
+        pages = list(page_source.iter_pages(self.folder))
+        self.assertEqual([page.page_id for page in pages], [f'batch.tif-p000{i}' for i in (1, 2, 3)])
+        with patch('page_source.Image.open', wraps=Image.open) as opened:
+            images = [page_source.load_page(page, dpi=200) for page in pages]
+        # The file is opened once and each page is a seek onward from the last
+        opened.assert_called_once()
+        # 400 DPI pages are scaled down to the requested 200 DPI
+        self.assertEqual(images[1].shape, (120, 85, 3))
+        self.assertEqual([int(image[60, 40, 0]) for image in images], [50, 150, 250])
+        page_source.close()
+        self.assertEqual(page_source._open, {})
+
+    def test_multi_page_pdf_pages_are_rasterized_at_the_requested_dpi(self):
+        self.save_document('batch.pdf', resolution=72)
+        pages = list(page_source.iter_pages(self.folder))
+        self.assertEqual([page.index for page in pages], [0, 1, 2])
+        image = page_source.load_page(pages[2], dpi=144)
+        self.assertEqual(image.shape, (480, 340, 3))
+        self.assertGreater(int(image[240, 170, 0]), 240)
+
+    def test_corrupt_documents_are_skipped(self):
+        for name in ('corrupt.pdf', 'corrupt.tif'):
+            with open(os.path.join(self.folder, name), 'wb') as f:
+                f.write(b'not a document' * 10)
+        # A document that opens but whose last page's compressed data is damaged
+        path = self.save_document('damaged.tif', compression='tiff_deflate')
+        with Image.open(path) as img:
+            img.seek(2)
+            offset, length = img.tag_v2[273][0], img.tag_v2[279][0]
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            f.write(b'\xff' * length)
+
+        pages = list(page_source.iter_pages(self.folder))
+        self.assertEqual([page.page_id for page in pages], [f'damaged.tif-p000{i}' for i in (1, 2, 3)])
+        self.assertEqual(page_source.load_page(pages[0]).shape, (240, 170, 3))
+        self.assertIsNone(page_source.load_page(pages[2]))
+
+
+class TestQualityGate(unittest.TestCase):
+
+    def setUp(self):
+        self.image, _ = synth_sheets.generate_sheet(np.random.default_rng(0), width=1240, severity=0.3)
+
+    def test_rotated_sheets_are_turned_upright(self):
+        self.assertTrue(quality_gate.check(self.image)['ok'])
+        for angle in (90, 180, 270):
+            report = quality_gate.check(quality_gate.rotate(self.image, angle))
+            self.assertTrue(report['ok'], report)
+            self.assertEqual((angle + report['rotation']) % 360, 0)
+
+    def test_blurry_and_dark_photos_are_rejected(self):
+        report = quality_gate.check(cv2.GaussianBlur(self.image, (0, 0), 6))
+        self.assertFalse(report['ok'])
+        self.assertIn('blurry', report['reasons'])
+        report = quality_gate.check((self.image * 0.2).astype(np.uint8))
+        self.assertFalse(report['ok'])
+        self.assertIn('too_dark', report['reasons'])
+
+
+class TestScanner(unittest.TestCase):
+
+    def test_crops_are_encoded_once_and_written_only_on_request(self):
+        folder = self.enterContext(tempfile.TemporaryDirectory())
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(folder)
+        image, _ = synth_sheets.generate_sheet(np.random.default_rng(0), width=1240, severity=0.3)
+        page = page_source.Page('sheet.jpg', None, 'sheet.jpg')
+        cv2.imwrite(page.path, image)
+
+        with DebugArtifacts() as debug:
+            scan = scanner.scan_page(page, debug, quality_gate.RescanQueue('rescan.jsonl'))
+        self.assertFalse(scan.anomaly)
+        self.assertEqual(len(scan.encoded), 6)
+        # Nothing but the debug record is written until the crops are asked for
+        self.assertEqual(os.listdir(scan.folder), [DEBUG_FILE])
+        with ThreadPoolExecutor(max_workers=2) as writer:
+            scanner.save_crops(writer, scan)
+        with open(os.path.join(scan.folder, 'corrected_column_2.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), scan.encoded[1])
+
+
+class TestDebugArtifacts(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = self.enterContext(tempfile.TemporaryDirectory())
+        image, truth = synth_sheets.generate_sheet(np.random.default_rng(0), width=620, severity=0.3)
+        self.page = page_source.Page(os.path.join(self.folder, 'sheet.jpg'), None, 'sheet.jpg')
+        cv2.imwrite(self.page.path, image)
+        self.boxes = [np.array(box, dtype=np.float32) for box in truth['boxes']]
+
+    def sheet_folder(self, name):
+        folder = os.path.join(self.folder, name)
+        os.makedirs(folder)
+        return folder
+
+    def test_normal_sheets_are_rendered_on_demand(self):
+        folder = self.sheet_folder('ok')
+        with DebugArtifacts(sample_rate=0.0) as debug:
+            debug.record(folder, self.page, self.boxes, anomaly=False)
+            self.assertIsNone(debug.executor)
+        with open(os.path.join(folder, DEBUG_FILE), encoding='utf-8') as f:
+            info = json.load(f)
+        self.assertEqual(info['source'], self.page.path)
+        self.assertEqual(len(info['boxes']), 6)
+        self.assertEqual(os.listdir(folder), [DEBUG_FILE])
+
+        path = render_detected_columns(folder)
+        self.assertEqual(path, os.path.join(folder, DEBUG_IMAGE))
+        self.assertEqual(cv2.imread(path).shape, cv2.imread(self.page.path).shape)
+
+    def test_anomalies_from_many_threads_share_one_renderer(self):
+        folders = [self.sheet_folder(f'err-{i}') for i in range(4)]
+        with patch('debug_artifacts.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as executor:
+            with DebugArtifacts() as debug, ThreadPoolExecutor(max_workers=4) as pool:
+                list(pool.map(lambda folder: debug.record(folder, self.page, self.boxes, anomaly=True), folders))
+        executor.assert_called_once_with(max_workers=1)
+        for folder in folders:
+            self.assertTrue(os.path.exists(os.path.join(folder, DEBUG_IMAGE)))
+
+
+if __name__ == '__main__':
+    unittest.main()
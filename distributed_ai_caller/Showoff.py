@@ -1,16 +1,16 @@
-from flask import Flask, render_template, jsonify, send_from_directory
+from flask import Flask, Response, render_template, jsonify, send_from_directory, stream_with_context
 import os
+import sys
 import json
+from gradebook import (QuestionStats, csv_chunks, gradebook_rows, iter_sheets, parse_json_content, question_order,
+                       xlsx_chunks)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AnswerSheet_Scanner"))
 
 app = Flask(__name__)
 
 OUTPUT_FOLDER = 'output'
 
-def parse_json_content(content):
-    if isinstance(content, dict):
-        return content
-    return json.loads(content)
-
 def get_student_ids():
     student_ids = []
     errors = []
@@ -65,6 +65,42 @@ def student_detail(student_id):
                 return f"Unexpected error processing {id_file}: {str(e)}", 500
     return "Student not found", 404
 
+EXPORT_FORMATS = {
+    'csv': (csv_chunks, 'text/csv; charset=utf-8'),
+    'xlsx': (xlsx_chunks, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+@app.route('/export/gradebook.<fmt>')
+def export_gradebook(fmt):
+    if fmt not in EXPORT_FORMATS:
+        return f"Unsupported format: {fmt}", 404
+    encode, mimetype = EXPORT_FORMATS[fmt]
+    # 题号列取自统计；尚无统计时从第一份答卷取
+    questions = list(QuestionStats(OUTPUT_FOLDER).summary()['questions'])
+    if not questions:
+        first = next(iter_sheets(OUTPUT_FOLDER), None)
+        questions = sorted(first[2], key=question_order) if first else []
+    # 逐行读取答卷并编码发送，导出多少份答卷都只占一行的内存
+    rows = gradebook_rows(iter_sheets(OUTPUT_FOLDER), questions)
+    return Response(stream_with_context(encode(rows)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=gradebook.{fmt}'})
+
+@app.route('/stats')
+def question_stats():
+    return jsonify(QuestionStats(OUTPUT_FOLDER).summary())
+
+@app.route('/debug/<folder>/detected_columns.jpg')
+def detected_columns(folder):
+    # 扫描时只为异常和抽样的答卷生成调试图，其余在第一次查看时按debug.json生成
+    from debug_artifacts import DEBUG_FILE, DEBUG_IMAGE, render_detected_columns
+    folder_path = os.path.join(OUTPUT_FOLDER, folder)
+    if folder in ('.', '..') or not os.path.isdir(folder_path):
+        return "Sheet not found", 404
+    if not os.path.exists(os.path.join(folder_path, DEBUG_IMAGE)):
+        if not os.path.exists(os.path.join(folder_path, DEBUG_FILE)) or render_detected_columns(folder_path) is None:
+            return "No debug information for this sheet", 404
+    return send_from_directory(folder_path, DEBUG_IMAGE)
+
 @app.route('/output/<path:filename>')
 def serve_image(filename):
     return send_from_directory(OUTPUT_FOLDER, filename)
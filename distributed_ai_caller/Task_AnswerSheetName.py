@@ -1,14 +1,19 @@
+import argparse
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.signal import find_peaks
 
 
 def preprocess_image(image_path):
     img = cv2.imread(image_path)
+    gray, binary = binarize(img)
+    return img, gray, binary
+
+
+def binarize(img):
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-    return img, gray, binary
+    return gray, binary
 
 
 def extract_number_area(binary):
@@ -95,7 +100,22 @@ def recognize_number(columns):
     return result
 
 
-def visualize_steps(original, gray, binary, number_area, columns, exam_number, vertical_lines):
+def recognize_image(img):
+    # 直接识别内存中的考号列图像（corrected_column_1），返回考号字符串
+    _, binary = binarize(img)
+    number_area, _ = extract_number_area(binary)
+    vertical_lines = detect_vertical_lines(number_area)
+    columns = split_into_columns(number_area, vertical_lines)
+    return recognize_number(columns)
+
+
+def visualize_steps(original, gray, binary, number_area, columns, exam_number, vertical_lines,
+                    output_path='recognition_steps.png'):
+    # 只在调试时导入matplotlib，识别本身不依赖它
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(20, 15))
 
     plt.subplot(231), plt.imshow(cv2.cvtColor(original, cv2.COLOR_BGR2RGB))
@@ -121,24 +141,31 @@ def visualize_steps(original, gray, binary, number_area, columns, exam_number, v
     plt.axis('off')
 
     plt.tight_layout()
-    plt.savefig('recognition_steps.png')
+    plt.savefig(output_path)
     plt.close()
 
 
-def main(image_path):
+def main(image_path, visualize=False, output_path='recognition_steps.png'):
     original, gray, binary = preprocess_image(image_path)
     number_area, (x, y, w, h) = extract_number_area(binary)
     vertical_lines = detect_vertical_lines(number_area)
     columns = split_into_columns(number_area, vertical_lines)
     exam_number = recognize_number(columns)
 
-    visualize_steps(original, gray, binary, number_area, columns, exam_number, vertical_lines)
-
     print(f"识别出的考号是: {exam_number}")
-    print("处理步骤的可视化结果已保存为 'recognition_steps.png'")
+    # 六宫格调试图渲染较慢，只在需要时生成
+    if visualize:
+        visualize_steps(original, gray, binary, number_area, columns, exam_number, vertical_lines, output_path)
+        print(f"处理步骤的可视化结果已保存为 '{output_path}'")
+    return exam_number
 
 
 # 使用示例
-# main('path_to_your_image.jpg')
+# python Task_AnswerSheetName.py ./output/1.jpg/corrected_column_1.jpg --visualize
 if __name__ == '__main__':
-    main("./output/1.jpg/corrected_column_1.jpg")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="识别考号列图像中的考号")
+    parser.add_argument("image_path", nargs="?", default="./output/1.jpg/corrected_column_1.jpg")
+    parser.add_argument("--visualize", action="store_true", help="保存各处理步骤的可视化结果")
+    parser.add_argument("--output", default="recognition_steps.png")
+    args = parser.parse_args()
+    main(args.image_path, args.visualize, args.output)
@@ -2,43 +2,53 @@ import json
 import time
 import requests
 import os
-import threading
-from queue import Queue
+from adaptive_concurrency import AIMDController, GatewayProbe, ResultTimeout, run_adaptive
 
-def call_ai_api(model_name, system_prompt, user_request, image_paths):
+# 设置后所有请求都归入该批改任务（job），由scheduler.py与其他任务按权重轮流调度
+JOB_ID = None
+
+def call_ai_api(model_name, system_prompt, user_request, image_paths, images=None):
     url = "http://localhost:5000/call_ai"
     payload = {
         "model_name": model_name,
         "system_prompt": system_prompt,
         "user_request": user_request,
-        "image_paths": image_paths
+        "image_paths": image_paths,
+        "images": images,
+        "job_id": JOB_ID
     }
     response = requests.post(url, json=payload)
     response.raise_for_status()
     return response.json()["task_id"]
 
+RESULT_TIMEOUT = 3600
+
 def get_result(task_id):
     url = f"http://localhost:5000/get_result/{task_id}"
-    max_retries = 10
     retry_delay = 2
+    # 任务可能还在排队或退避重试；一直轮询到结果过期（result_expires）为止，超时也不重新提交，以免重复付费调用
+    deadline = time.monotonic() + RESULT_TIMEOUT
 
-    for _ in range(max_retries):
+    while time.monotonic() < deadline:
         try:
             response = requests.get(url)
-            response.raise_for_status()
+            # 任务失败（重试耗尽或不可重试的错误）时返回500和错误信息，此时不再轮询
+            if response.status_code != 500 or response.json().get("status") != "error":
+                response.raise_for_status()
             result = response.json()
             if result["status"] == "completed":
                 return result["result"]
             elif result["status"] == "error":
-                raise Exception(result["message"])
+                raise Exception(f"{result.get('type', 'Error')}: {result['message']}")
             time.sleep(retry_delay)
         except requests.RequestException as e:
             print(f"请求发生错误: {e}")
             time.sleep(retry_delay)
 
-    raise TimeoutError("获取结果超时")
+    raise ResultTimeout(f"获取结果超时: {task_id}")
 
-def evlaulateTask1(file_path):
+def evlaulateTask1(file_path, image=None):
+    # image为已编码的base64 JPEG时直接随请求发送，不再由worker从磁盘读取file_path
     try:
         extract_prompt = """You are tasked with extracting a student's ID number from a part of an answer sheet.
 
@@ -56,58 +66,39 @@ Provide only the JSON string as your output, without any additional explanation
             "claude-3-5-sonnet-20240620",
             extract_prompt,
             "Image has been received!",
-            image_paths=[file_path]
+            image_paths=None if image else [file_path],
+            images=[image] if image else None
         )
         tExtractedReply = get_result(ExtractedReply)
 
         return tExtractedReply
     except Exception as e:
         print(f"发生错误: {e}")
-        return None
-
-def worker(queue):
-    while True:
-        file_path = queue.get()
-        if file_path is None:
-            break
-        print(f"Processing: {file_path}")
-        result = evlaulateTask1(file_path)
-        if result:
-            root = os.path.dirname(file_path)
-            print(f"Saving result to {root}/id.json")
-            with open(os.path.join(root, "id.json"), 'w') as f:
-                json.dump(result, f, ensure_ascii=False, indent=4)
-        queue.task_done()
+        raise
 
-def main():
-    file_queue = Queue()
-    # 创建两个工作线程
-    threads = []
-    for _ in range(2):
-        t = threading.Thread(target=worker, args=(file_queue,))
-        t.start()
-        threads.append(t)
+def save_result(file_path, result):
+    root = os.path.dirname(file_path)
+    print(f"Saving result to {root}/id.json")
+    with open(os.path.join(root, "id.json"), 'w') as f:
+        json.dump(result, f, ensure_ascii=False, indent=4)
 
+def main():
     # 获取当前脚本的绝对路径
     script_dir = os.path.dirname(os.path.abspath(__file__))
     # 构建输出文件夹的绝对路径
     output_dir = os.path.join(script_dir, "output")
 
     # 遍历output文件夹下的所有文件夹中的corrected_column_1.jpg文件
+    file_paths = []
     for root, dirs, files in os.walk(output_dir):
         for file in files:
             if file == "corrected_column_1.jpg":
                 file_path = os.path.join(root, file)
-                file_queue.put(os.path.abspath(file_path))  # 使用绝对路径
-
-    # 等待所有任务完成
-    file_queue.join()
+                file_paths.append(os.path.abspath(file_path))  # 使用绝对路径
 
-    # 停止工作线程
-    for _ in range(2):
-        file_queue.put(None)
-    for t in threads:
-        t.join()
+    # 并发数不再固定为2：根据延迟、429/超时和队列深度自动调整，并定期打印当前并发与吞吐
+    run_adaptive(file_paths, evlaulateTask1, AIMDController(initial=2), on_result=save_result,
+                 probe=GatewayProbe("http://localhost:5000"))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
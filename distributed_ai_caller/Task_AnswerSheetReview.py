@@ -1,46 +1,60 @@
+import argparse
 import json
 import time
 import requests
 import os
-import threading
-from queue import Queue
+import cv2
+from adaptive_concurrency import AIMDController, GatewayProbe, ResultTimeout, run_adaptive
+from image_utils import bytes_to_base64, encode_jpeg
+from answer_cells import ANSWER_ROWS, PREFILTER_VERSION, answered_questions, compose_rows
+from gradebook import QuestionStats, parsed_result, read_json
+from grading_manifest import RunManifest, changed_items, file_hash, text_hash, write_json_atomic
 
-def call_ai_api(model_name, system_prompt, user_request, image_paths=None):
+# 设置后所有请求都归入该批改任务（job），由scheduler.py与其他任务按权重轮流调度
+JOB_ID = None
+
+def call_ai_api(model_name, system_prompt, user_request, image_paths=None, images=None):
     url = "http://localhost:5000/call_ai"
     payload = {
         "model_name": model_name,
         "system_prompt": system_prompt,
         "user_request": user_request,
-        "image_paths": image_paths
+        "image_paths": image_paths,
+        "images": images,
+        "job_id": JOB_ID
     }
     response = requests.post(url, json=payload)
     response.raise_for_status()
     return response.json()["task_id"]
 
+RESULT_TIMEOUT = 3600
+
 def get_result(task_id):
     url = f"http://localhost:5000/get_result/{task_id}"
-    max_retries = 10
     retry_delay = 2
+    # 任务可能还在排队或退避重试；一直轮询到结果过期（result_expires）为止，超时也不重新提交，以免重复付费调用
+    deadline = time.monotonic() + RESULT_TIMEOUT
 
-    for _ in range(max_retries):
+    while time.monotonic() < deadline:
         try:
             response = requests.get(url)
-            response.raise_for_status()
+            # 任务失败（重试耗尽或不可重试的错误）时返回500和错误信息，此时不再轮询
+            if response.status_code != 500 or response.json().get("status") != "error":
+                response.raise_for_status()
             result = response.json()
             if result["status"] == "completed":
                 return result["result"]
             elif result["status"] == "error":
-                raise Exception(result["message"])
+                raise Exception(f"{result.get('type', 'Error')}: {result['message']}")
             time.sleep(retry_delay)
         except requests.RequestException as e:
             print(f"请求发生错误: {e}")
             time.sleep(retry_delay)
 
-    raise TimeoutError("获取结果超时")
+    raise ResultTimeout(f"获取结果超时: {task_id}")
 
-def evlaulateTask2(file_path, answer):
-    try:
-        extract_prompt = """You are tasked with extracting student answers from an image of a worksheet or test paper. The image will contain a grid of numbered questions with corresponding answers or values.
+EXTRACT_MODEL = "claude-3-5-sonnet-20240620"
+EXTRACT_PROMPT = """You are tasked with extracting student answers from an image of a worksheet or test paper. The image will contain a grid of numbered questions with corresponding answers or values.
 Follow these steps to extract the information and format it as a JSON string:
 1. Examine the image carefully, noting that it contains a grid of numbered items from 1 to 12.
 2. For each numbered item, identify the corresponding answer or value written next to or below it.
@@ -62,21 +76,14 @@ Remember to:
 - Double-check that your JSON string is valid and includes all 12 items.
 Provide only the JSON string as your output, without any additional explanation or commentary."""
 
-        ExtractedReply = call_ai_api(
-            "claude-3-5-sonnet-20240620",
-            extract_prompt,
-            "Student's answer submitted!",
-            image_paths=[file_path]
-        )
-        tExtractedReply = get_result(ExtractedReply)
-
-        compare_prompt = """You are tasked with evaluating the correctness of student answers by comparing extracted answers to the correct answers. Both sets of answers are provided in JSON format.
+COMPARE_MODEL = "claude-3-haiku-20240307"
+COMPARE_PROMPT = """You are tasked with evaluating the correctness of student answers by comparing extracted answers to the correct answers. Both sets of answers are provided in JSON format.
 
 Follow these steps to evaluate the answers and format the results as a JSON string:
 
 1. Parse both JSON strings to access the extracted and correct answers.
 
-2. For each question number (1 through 12):
+2. For each question number in the correct answers:
 a. Compare the extracted answer to the correct answer.
 b. Determine if the extracted answer is correct, incorrect, or requires review.
 
@@ -103,31 +110,8 @@ Additional guidelines:
 
 Provide only the JSON string as your output, without any additional explanation or commentary."""
 
-        CompareOutput = call_ai_api(
-            "claude-3-haiku-20240307",
-            compare_prompt,
-            f"Student answer: {tExtractedReply}\nCorrect answer: {answer}",
-        )
-        return get_result(CompareOutput)
-    except Exception as e:
-        print(f"发生错误: {e}")
-        return None
-
-def worker(queue, answer):
-    while True:
-        file_path = queue.get()
-        if file_path is None:
-            break
-        print(f"Processing: {file_path}")
-        result = evlaulateTask2(file_path, answer)
-        if result:
-            root = os.path.dirname(file_path)
-            with open(os.path.join(root, "result.json"), 'w') as f:
-                json.dump(result, f, ensure_ascii=False, indent=4)
-        queue.task_done()
-
-def main():
-    answer = """{
+# 标准答案
+ANSWER = """{
     "1": "1-2i",
     "2": "4",
     "3": "(2,3)",
@@ -142,29 +126,154 @@ def main():
     "12": "-1/(4e)"
     }"""
 
-    file_queue = Queue()
+# 模型、提示词或本地预筛参数变化时版本号随之变化，清单中对应的缓存即失效
+EXTRACT_VERSION = text_hash(EXTRACT_MODEL, EXTRACT_PROMPT, PREFILTER_VERSION)
+COMPARE_VERSION = text_hash(COMPARE_MODEL, COMPARE_PROMPT)
+
+def parse_reply(reply):
+    # worker已把能解析的JSON回复转为dict；其余是字符串，可能带有```json代码块；无法解析时返回None
+    if isinstance(reply, dict):
+        return reply
+    if not isinstance(reply, str):
+        return None
+    text = reply.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.index("\n") + 1:] if "\n" in text else text
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def extract_answers(img):
+    # 先在本地测量每格墨迹：空白题直接记为空答案，只把有作答的行拼成一张图发给模型，整张空白则不调用模型
+    answered = answered_questions(img)
+    blanks = {str(q): "" for q in range(1, ANSWER_ROWS + 1) if str(q) not in answered}
+    if not answered:
+        return blanks
+
+    # 拼接图在内存中编码一次后随请求发送，不落盘
+    cells = bytes_to_base64(encode_jpeg(compose_rows(img, answered)))
+    user_request = (f"Student's answer submitted! The image shows only questions {', '.join(answered)}; "
+                    f"the other questions are blank and need not be included.")
+    task_id = call_ai_api(EXTRACT_MODEL, EXTRACT_PROMPT, user_request, images=[cells])
+    reply = get_result(task_id)["result"]
+    # 能解析为JSON时按题号缓存，之后答案修改可以只比对变化的题目
+    extracted = parse_reply(reply)
+    if extracted is None:
+        return reply
+    return {**blanks, **{q: str(extracted.get(q, "")) for q in answered}}
+
+def compare_answers(extracted, answer_key, questions):
+    if isinstance(extracted, dict):
+        student = {q: extracted.get(q, "") for q in questions}
+        correct = {q: answer_key[q] for q in questions}
+        user_request = (f"Student answer: {json.dumps(student, ensure_ascii=False)}\n"
+                        f"Correct answer: {json.dumps(correct, ensure_ascii=False)}")
+    else:
+        user_request = f"Student answer: {extracted}\nCorrect answer: {json.dumps(answer_key, ensure_ascii=False)}"
+    task_id = call_ai_api(COMPARE_MODEL, COMPARE_PROMPT, user_request)
+    return get_result(task_id)["result"]
+
+def judge_answers(extracted, answer_key, questions, verdicts=None):
+    # 比对questions中的题目并与已有判定合并；模型回复无法按题解析时返回原始回复
+    # 要重新比对的题目不沿用旧判定
+    verdicts = {q: v for q, v in (verdicts or {}).items() if q not in questions}
+    if isinstance(extracted, dict):
+        # 空白题按比对规则本就是review_required，在本地直接填写，不再交给模型
+        blanks = [q for q in questions if not extracted.get(q, "").strip()]
+        verdicts.update({q: "review_required" for q in blanks})
+        questions = [q for q in questions if q not in blanks]
+    else:
+        questions = list(answer_key)
+
+    if questions:
+        reply = compare_answers(extracted, answer_key, questions)
+        compared = parse_reply(reply)
+        if compared is None:
+            return reply
+        verdicts.update({q: compared[q] for q in questions if q in compared})
+    return {q: verdicts.get(q, "review_required") for q in answer_key}
+
+def evlaulateTask2(file_path, answer_key, manifest, full=False):
+    sheet_id = os.path.relpath(file_path)
+    try:
+        entry = {} if full else manifest.get(sheet_id)
+        image_hash = file_hash(file_path)
+        # 图片和识别步骤都未变化时沿用上次识别出的答案
+        if entry.get("image_hash") != image_hash or entry.get("extract_version") != EXTRACT_VERSION \
+                or "extracted" not in entry:
+            print(f"Extracting: {file_path}")
+            img = cv2.imread(file_path)
+            if img is None:
+                raise ValueError(f"无法读取图像文件 '{file_path}'")
+            extracted = extract_answers(img)
+            entry = {"image_hash": image_hash, "extract_version": EXTRACT_VERSION, "extracted": extracted}
+            manifest.update(sheet_id, **entry, verdicts=None, status="extracted")
+
+        key_hashes = {q: text_hash(a) for q, a in answer_key.items()}
+        questions = changed_items(entry, key_hashes, COMPARE_VERSION)
+        print(f"Comparing {len(questions)} question(s): {file_path}")
+        verdicts = judge_answers(entry["extracted"], answer_key, questions,
+                                 entry["verdicts"] if len(questions) < len(answer_key) else None)
+        if not isinstance(verdicts, dict):
+            # 无法按题合并时保存原始回复，下次运行会重新比对全部题目
+            manifest.update(sheet_id, verdicts=None, status="done", result=verdicts)
+            return {"status": "success", "result": verdicts}
+
+        result = json.dumps(verdicts, ensure_ascii=False, indent=4)
+        manifest.update(sheet_id, compare_version=COMPARE_VERSION, key_hashes=key_hashes, verdicts=verdicts,
+                        status="done", result=result, error=None)
+        return {"status": "success", "result": result}
+    except Exception as e:
+        print(f"发生错误: {e}")
+        # 失败的答卷在下次运行时会重新处理
+        manifest.update(sheet_id, status="failed", error=f"{type(e).__name__}: {e}")
+        raise
+
+def is_current(file_path, answer_key, manifest):
+    entry = manifest.get(os.path.relpath(file_path))
+    if entry.get("status") != "done" or entry.get("extract_version") != EXTRACT_VERSION:
+        return False
+    key_hashes = {q: text_hash(a) for q, a in answer_key.items()}
+    return not changed_items(entry, key_hashes, COMPARE_VERSION) and entry.get("image_hash") == file_hash(file_path)
+
+def save_result(file_path, result):
+    root = os.path.dirname(file_path)
+    result_path = os.path.join(root, "result.json")
+    # 按本答卷上次与这次的判定增减各题统计，Showoff不必重新扫描output/
+    previous = parsed_result(read_json(result_path)) if os.path.exists(result_path) else None
+    write_json_atomic(result_path, result, ensure_ascii=False, indent=4)
+    QuestionStats(os.path.dirname(root)).record(previous, parsed_result(result))
+
+def main():
+    parser = argparse.ArgumentParser(description="批改./output/下的答卷，默认只处理有变化或上次失败的答卷")
+    parser.add_argument("--full", action="store_true", help="忽略清单，重新识别并批改全部答卷")
+    parser.add_argument("--manifest", default="./output/review_manifest.json")
+    parser.add_argument("--job", help="批改任务（job）id，多位老师同时批改时按权重公平分配worker")
+    args = parser.parse_args()
+    global JOB_ID
+    JOB_ID = args.job
 
-    # 创建两个工作线程
-    threads = []
-    for _ in range(3):
-        t = threading.Thread(target=worker, args=(file_queue, answer))
-        t.start()
-        threads.append(t)
+    answer_key = json.loads(ANSWER)
 
     # 遍历./output/下的所有文件夹中的corrected_column_2.jpg文件
+    file_paths = []
     for root, dirs, files in os.walk("./output/"):
         for file in files:
             if file == "corrected_column_2.jpg":
-                file_queue.put(os.path.join(root, file))
+                file_paths.append(os.path.join(root, file))
 
-    # 等待所有任务完成
-    file_queue.join()
+    with RunManifest(args.manifest) as manifest:
+        if not args.full:
+            pending = [p for p in file_paths if not is_current(p, answer_key, manifest)]
+            print(f"共{len(file_paths)}份答卷，{len(file_paths) - len(pending)}份未变化，跳过")
+            file_paths = pending
 
-    # 停止工作线程
-    for _ in range(3):
-        file_queue.put(None)
-    for t in threads:
-        t.join()
+        # 并发数不再固定为3：根据延迟、429/超时和队列深度自动调整，并定期打印当前并发与吞吐
+        run_adaptive(file_paths, lambda file_path: evlaulateTask2(file_path, answer_key, manifest, args.full),
+                     AIMDController(initial=3), on_result=save_result, probe=GatewayProbe("http://localhost:5000"))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
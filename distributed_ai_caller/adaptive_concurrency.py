@@ -0,0 +1,233 @@
+# adaptive_concurrency.py
+"""
+AIMD concurrency control for the bulk grading drivers.
+
+Instead of a fixed number of threads, run_adaptive() keeps up to controller.limit items in flight. The limit grows by
+about one per round of completions while latency stays close to its best recent value, and is cut in half on
+overload: 429s or rate-limit failures, timeouts, latency well above the baseline, or a broker queue that keeps growing.
+Progress is printed as it runs:
+
+    [adaptive] limit 6.2  in flight 6  done 120/400  failed 2  4.85 items/s  p50 3.1s  queue 4
+"""
+import logging
+import re
+import threading
+import time
+from collections import deque
+from queue import Empty, Queue
+
+import requests
+
+from hedging import percentile
+
+logger = logging.getLogger(__name__)
+
+# Failure types reported by /get_result that mean "slow down" rather than "bad input"
+OVERLOAD_ERRORS = ('RateLimitError', 'CircuitOpenError', 'APITimeoutError', 'APIConnectionError', 'InternalServerError',
+                   'ConnectionError')
+
+
+class ResultTimeout(TimeoutError):
+    """
+    Raised by a driver that stopped polling a task still queued or running.
+
+    The task is not lost, so its item is not sent again: that would pay for a second provider call.
+    """
+
+
+class AIMDController:
+    """
+    Additive-increase/multiplicative-decrease limit on requests in flight, shared by the driver's threads.
+
+    Args:
+    initial, minimum, maximum (int): starting limit and its bounds
+    decrease (float): factor the limit is multiplied by on overload
+    latency_tolerance (float): back off when recent median latency exceeds this multiple of the baseline
+    queue_depth_limit (int): back off when the broker queue is deeper than this and still growing
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=32, decrease=0.5, latency_tolerance=2.5, queue_depth_limit=20,
+                 window=50):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.queue_depth_limit = queue_depth_limit
+        self.in_flight = 0
+        self.latencies = deque(maxlen=window)
+        self.baseline = deque(maxlen=window * 4)
+        self.completed = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self.last_decrease = 0.0
+        self.last_queue_depth = None
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, latency):
+        with self.condition:
+            self.completed += 1
+            self.latencies.append(latency)
+            self.baseline.append(latency)
+            recent = percentile(list(self.latencies)[-max(3, int(self.limit)):], 50)
+            if len(self.baseline) >= 5 and recent > self.latency_tolerance * min(self.baseline):
+                self._decrease(f"latency {recent:.1f}s vs baseline {min(self.baseline):.1f}s")
+            else:
+                # +1/limit per completion adds about one slot per round of in-flight requests
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def on_failure(self, error, final=True):
+        """Record a failed call; final=False for one whose item will be tried again."""
+        with self.condition:
+            self.failed += final
+            if is_overload(error):
+                self._decrease(f"{type(error).__name__}: {error}")
+
+    def on_signals(self, queue_depth=None, rate_limited=0):
+        """React to gateway-side signals: broker queue depth and 429s the workers saw since the last call."""
+        with self.condition:
+            if rate_limited:
+                self._decrease(f"{rate_limited} provider 429s")
+            elif queue_depth is not None and queue_depth > self.queue_depth_limit and \
+                    self.last_queue_depth is not None and queue_depth > self.last_queue_depth:
+                self._decrease(f"queue depth {queue_depth}")
+            self.last_queue_depth = queue_depth
+
+    def _decrease(self, reason):
+        # One cut per round trip: the failures of requests already in flight reflect the old limit, not the new one
+        now = time.monotonic()
+        round_trip = percentile(list(self.latencies), 50) or 1.0
+        if now - self.last_decrease < round_trip:
+            return
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        logger.info(f"Concurrency limit cut to {self.limit:.1f}: {reason}")
+
+    def stats(self):
+        with self.condition:
+            elapsed = time.monotonic() - self.started_at
+            return {
+                'limit': round(self.limit, 1),
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'failed': self.failed,
+                'throughput': self.completed / elapsed if elapsed else 0.0,
+                'p50': percentile(list(self.latencies), 50),
+                'queue_depth': self.last_queue_depth,
+            }
+
+
+def is_overload(error):
+    if isinstance(error, (TimeoutError, requests.Timeout, requests.ConnectionError)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in (429, 502, 503, 504)
+    return any(str(error).startswith(name) for name in OVERLOAD_ERRORS)
+
+
+def should_resubmit(error):
+    """
+    True for an overload error after which the call is known not to be running: the provider or the broker turned it
+    away, or the gateway could not be reached. After a client-side timeout (a poll given up, a read timed out) the task
+    may still be running, so it is only a reason to slow down.
+    """
+    if isinstance(error, (TimeoutError, requests.ReadTimeout)):
+        return False
+    return is_overload(error)
+
+
+class GatewayProbe:
+    """Reads queue depth and the workers' 429 count from master.py's /metrics; returns None where unavailable."""
+
+    def __init__(self, base_url="http://localhost:5000"):
+        self.url = f"{base_url}/metrics"
+        self.last_rate_limited = None
+
+    def read(self):
+        try:
+            text = requests.get(self.url, timeout=2).text
+        except requests.RequestException:
+            return None, 0
+        depths = re.findall(r'^ai_queue_depth\{[^}]*\} (\S+)$', text, re.M)
+        total = sum(float(v) for v in re.findall(r'^ai_provider_errors_total\{[^}]*status="429"[^}]*\} (\S+)$', text,
+                                                  re.M))
+        rate_limited = 0 if self.last_rate_limited is None else max(0, total - self.last_rate_limited)
+        self.last_rate_limited = total
+        return (int(sum(float(d) for d in depths)) if depths else None), int(rate_limited)
+
+
+def run_adaptive(items, fn, controller=None, on_result=None, probe=None, report_interval=5.0, max_attempts=3):
+    """
+    Call fn(item) for every item with adaptive concurrency; fn should raise on failure.
+
+    on_result(item, result) is called from the worker threads for each success. Items whose call was turned away by
+    overload (see should_resubmit) are put back at the end of the queue, up to max_attempts tries in all. Returns the
+    controller's final stats.
+    """
+    controller = controller or AIMDController()
+    items = list(items)
+    pending = Queue()
+    for item in items:
+        pending.put((item, 1))
+    finished = threading.Event()
+
+    def work():
+        while True:
+            controller.acquire()
+            try:
+                item, attempt = pending.get_nowait()
+            except Empty:
+                controller.release()
+                return
+            start = time.monotonic()
+            try:
+                result = fn(item)
+            except Exception as e:
+                retry = should_resubmit(e) and attempt < max_attempts
+                controller.on_failure(e, final=not retry)
+                if retry:
+                    # Put back before releasing the slot, so no thread can find the queue empty and quit meanwhile
+                    pending.put((item, attempt + 1))
+                else:
+                    logger.warning(f"Failed on {item}: {type(e).__name__}: {e}")
+            else:
+                controller.on_success(time.monotonic() - start)
+                if on_result:
+                    on_result(item, result)
+            finally:
+                controller.release()
+
+    def report():
+        while not finished.wait(report_interval):
+            if probe:
+                controller.on_signals(*probe.read())
+            s = controller.stats()
+            p50 = f"{s['p50']:.1f}s" if s['p50'] is not None else '-'
+            queue = s['queue_depth'] if s['queue_depth'] is not None else '-'
+            print(f"[adaptive] limit {s['limit']}  in flight {s['in_flight']}  "
+                  f"done {s['completed'] + s['failed']}/{len(items)}  failed {s['failed']}  "
+                  f"{s['throughput']:.2f} items/s  p50 {p50}  queue {queue}")
+
+    reporter = threading.Thread(target=report, daemon=True, name='adaptive-report')
+    reporter.start()
+    # Enough threads for the largest limit; the controller decides how many of them may have a request out
+    threads = [threading.Thread(target=work, name=f'adaptive-{i}') for i in range(controller.maximum)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    finished.set()
+    reporter.join()
+    return controller.stats()
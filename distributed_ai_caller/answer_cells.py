@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+
+# 填空题答题框（corrected_column_2）的版式：12行，每行左侧为题号
+ANSWER_ROWS = 12
+LABEL_WIDTH = 0.18
+# 测量墨迹时裁掉每格的上下边缘和右边缘，避开行分隔线和外框
+CELL_MARGIN_Y = 0.2
+CELL_MARGIN_X = 0.03
+# 墨迹像素占比超过该值的格子视为已作答
+INK_THRESHOLD = 0.005
+# 用于版本号：参数变化时增量批改的清单缓存随之失效
+PREFILTER_VERSION = f"rows={ANSWER_ROWS},label={LABEL_WIDTH},ink={INK_THRESHOLD}"
+
+
+def row_bounds(height):
+    edges = np.linspace(0, height, ANSWER_ROWS + 1).round().astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def ink_mask(gray):
+    # 自适应阈值按局部背景判断墨迹，不受光照渐变影响；开运算去掉噪点
+    height, width = gray.shape
+    block = max(15, (height // ANSWER_ROWS) | 1)
+    mask = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, block, 15)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+    # 去掉行分隔线和外框：横向长于1/8宽或纵向长于1/4列高的直线不是字迹（矫正后的行线略有倾斜，横向核不能太长）
+    lines = cv2.morphologyEx(mask, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (width // 8, 1)))
+    lines |= cv2.morphologyEx(mask, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, height // 4)))
+    lines = cv2.dilate(lines, np.ones((3, 3), np.uint8))
+    return cv2.subtract(mask, lines)
+
+
+def ink_densities(img):
+    """
+    按题号测量答题框每格的墨迹占比（不含左侧题号）
+
+    Args:
+    img (numpy.ndarray): 矫正后的答题框图像（BGR或灰度）
+
+    Returns:
+    dict: {"1": 占比, ..., "12": 占比}
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    mask = ink_mask(gray)
+    height, width = gray.shape
+    x0, x1 = int(width * LABEL_WIDTH), int(width * (1 - CELL_MARGIN_X))
+    densities = {}
+    for i, (top, bottom) in enumerate(row_bounds(height)):
+        margin = int((bottom - top) * CELL_MARGIN_Y)
+        cell = mask[top + margin:bottom - margin, x0:x1]
+        densities[str(i + 1)] = cv2.countNonZero(cell) / cell.size if cell.size else 0.0
+    return densities
+
+
+def answered_questions(img, threshold=INK_THRESHOLD):
+    """返回有墨迹（已作答）的题号列表"""
+    return [q for q, density in ink_densities(img).items() if density > threshold]
+
+
+def compose_rows(img, questions):
+    """把指定题号的整行（含题号）按顺序纵向拼接成一张图，只把有作答的行发给模型"""
+    rows = row_bounds(img.shape[0])
+    return np.vstack([img[rows[int(q) - 1][0]:rows[int(q) - 1][1]] for q in questions])
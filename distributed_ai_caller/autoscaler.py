@@ -0,0 +1,279 @@
+# autoscaler.py
+"""
+Worker autoscaler: sizes the worker pool from the backlog instead of a fixed count.
+
+Every interval it reads the broker queue depth, the tasks in flight (the broker's unacked hash, since task_acks_late
+keeps a task there until it finishes), the tasks still pending in grading jobs, the age of the oldest waiting task,
+and the provider's rate-limit headroom (new 429s since the last look, and the circuit breakers). From these
+ScalingPolicy picks a worker count within [min_workers, max_workers]:
+
+- enough workers for the backlog at tasks_per_worker each, and one more while the oldest task waits too long;
+- no scale-up while the provider is rate limiting or a breaker is open, since more workers would only get more 429s;
+- up by at most scale_up_step per interval, down by one worker once the backlog has stayed small for
+  scale_down_delay seconds, so a gap between two batches does not tear the pool down.
+
+In local mode the autoscaler runs the workers itself (python worker.py ...). A worker is retired with SIGTERM, Celery's
+warm shutdown: it finishes the task it is running and exits, and with acks_late whatever it had reserved goes back to
+the queue unacknowledged. In signal mode it only publishes the count, in Redis (ai_autoscaler:desired_workers, also
+the ai_workers_desired gauge of /metrics) and as a JSON line on stdout, for a container orchestrator to act on.
+
+    python autoscaler.py --min 1 --max 8 -- -P threads -c 4
+    python autoscaler.py --mode signal --min 2 --max 20
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import redis
+
+from celery_app import app as celery_app, breaker, jobs
+from metrics import METRICS_KEY_PREFIX
+
+logger = logging.getLogger(__name__)
+
+DESIRED_WORKERS_KEY = 'ai_autoscaler:desired_workers'
+PROVIDERS = ['openai', 'anthropic']
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+
+class ScalingPolicy:
+    """
+    Args:
+    min_workers, max_workers (int): bounds of the pool
+    tasks_per_worker (int): tasks one worker keeps busy with, about its pool concurrency
+    max_task_age (float): seconds the oldest waiting task may wait before another worker is added
+    scale_up_step (int): most workers added per decision
+    scale_down_delay (float): seconds the backlog must stay below the pool's size before a worker is retired
+    """
+
+    def __init__(self, min_workers=1, max_workers=4, tasks_per_worker=4, max_task_age=30.0, scale_up_step=2,
+                 scale_down_delay=60.0):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.tasks_per_worker = tasks_per_worker
+        self.max_task_age = max_task_age
+        self.scale_up_step = scale_up_step
+        self.scale_down_delay = scale_down_delay
+        self.below_since = None
+
+    def desired(self, current, signals, now=None):
+        """Worker count to run next, given the current count and the signals QueueSignals.read() returns."""
+        now = time.monotonic() if now is None else now
+        load = signals['queued'] + signals['in_flight'] + signals['pending']
+        target = math.ceil(load / self.tasks_per_worker)
+        age = signals.get('oldest_age')
+        if age is not None and age > self.max_task_age:
+            target = max(target, current + 1)
+        if signals.get('throttled'):
+            target = min(target, current)
+        target = min(max(target, self.min_workers), self.max_workers)
+
+        if current > self.max_workers:
+            return self.max_workers
+        if target >= current:
+            self.below_since = None
+            return min(target, max(current + self.scale_up_step, self.min_workers))
+        if self.below_since is None:
+            self.below_since = now
+        if now - self.below_since < self.scale_down_delay:
+            return current
+        # One worker at a time, each after another full delay
+        self.below_since = now
+        return current - 1
+
+
+class QueueSignals:
+    """Reads the autoscaler's inputs from the broker and the result backend's Redis."""
+
+    def __init__(self, broker_client, store, get_client, queue):
+        self.broker_client = broker_client
+        self.store = store
+        self.get_client = get_client
+        self.queue = queue
+        self.last_throttled_total = None
+
+    def read(self):
+        pipe = self.broker_client.pipeline()
+        pipe.llen(self.queue)
+        pipe.hlen('unacked')
+        # Kombu pushes on the left and workers pop from the right, so the oldest message is the last one
+        pipe.lindex(self.queue, -1)
+        queued, in_flight, oldest = pipe.execute()
+
+        active = self.store.active()
+        oldest_times = [t for t in (self._enqueued_at(oldest), self.store.oldest_submitted_at(list(active))) if t]
+        return {
+            'queued': queued,
+            'in_flight': in_flight,
+            'pending': sum(job['pending'] for job in active.values()),
+            'oldest_age': time.time() - min(oldest_times) if oldest_times else None,
+            'throttled': self._throttled(),
+        }
+
+    @staticmethod
+    def _enqueued_at(raw):
+        if not raw:
+            return None
+        try:
+            return json.loads(raw).get('headers', {}).get('enqueued_at')
+        except ValueError:
+            return None
+
+    def _throttled(self):
+        """True if the providers answered 429 since the last read, or a circuit breaker is not closed."""
+        fields = self.get_client().hgetall(METRICS_KEY_PREFIX + 'ai_provider_errors_total')
+        total = sum(float(v) for k, v in fields.items() if b'status="429"' in k)
+        new_429s = self.last_throttled_total is not None and total > self.last_throttled_total
+        self.last_throttled_total = total
+        return new_429s or any(breaker.state(provider) != 'closed' for provider in PROVIDERS)
+
+
+class LocalWorkers:
+    """
+    Worker processes started and stopped by the autoscaler.
+
+    Args:
+    worker_args (list): extra arguments for worker.py, such as ['-P', 'threads', '-c', '4']
+    drain_timeout (float): seconds a retired worker may take to finish its task before it is killed
+    """
+
+    def __init__(self, worker_args=(), drain_timeout=600.0):
+        self.worker_args = list(worker_args)
+        self.drain_timeout = drain_timeout
+        self.running = []
+        self.draining = []
+        self.started = 0
+
+    def count(self):
+        self.reap()
+        return len(self.running)
+
+    def scale_to(self, count):
+        while len(self.running) < count:
+            self.started += 1
+            name = f"autoscale-{os.getpid()}-{self.started}@%h"
+            process = subprocess.Popen([sys.executable, WORKER_SCRIPT, '-n', name] + self.worker_args,
+                                       cwd=os.path.dirname(WORKER_SCRIPT))
+            logger.info(f"Started worker {name} (pid {process.pid})")
+            self.running.append(process)
+        while len(self.running) > count:
+            # The newest worker goes first; SIGTERM is a warm shutdown, so its current task still completes
+            process = self.running.pop()
+            process.send_signal(signal.SIGTERM)
+            logger.info(f"Draining worker pid {process.pid}")
+            self.draining.append((process, time.monotonic()))
+
+    def reap(self):
+        for process in [p for p in self.running if p.poll() is not None]:
+            logger.warning(f"Worker pid {process.pid} exited with code {process.returncode}")
+            self.running.remove(process)
+        still_draining = []
+        for process, since in self.draining:
+            if process.poll() is not None:
+                logger.info(f"Worker pid {process.pid} drained")
+            elif time.monotonic() - since > self.drain_timeout:
+                # Its unacknowledged task is redelivered by the broker after the visibility timeout
+                logger.warning(f"Worker pid {process.pid} did not drain in {self.drain_timeout}s, killing it")
+                process.kill()
+            else:
+                still_draining.append((process, since))
+        self.draining = still_draining
+
+    def publish(self, signals):
+        pass
+
+    def stop(self):
+        self.scale_to(0)
+        for process, _ in self.draining:
+            process.wait()
+        self.draining = []
+
+
+class ScalingSignal:
+    """Publishes the desired worker count for an orchestrator instead of running workers."""
+
+    def __init__(self, get_client):
+        self.get_client = get_client
+        self.desired = None
+
+    def count(self):
+        return self.desired
+
+    def scale_to(self, count):
+        self.desired = count
+
+    def publish(self, signals):
+        self.get_client().set(DESIRED_WORKERS_KEY, self.desired)
+        print(json.dumps({'desired_workers': self.desired, **signals}), flush=True)
+
+    def stop(self):
+        pass
+
+
+def run(policy, signals, workers, interval=5.0):
+    last = None
+    while True:
+        try:
+            current = workers.count()
+            observed = signals.read()
+            desired = policy.desired(policy.min_workers if current is None else current, observed)
+            workers.scale_to(desired)
+            workers.publish(observed)
+            if desired != last:
+                logger.info(f"Workers: {current} -> {desired} ({observed})")
+                last = desired
+        except redis.RedisError as e:
+            # Keep the pool as it is until the signals can be read again
+            logger.error(f"Autoscaler could not read its signals: {e}")
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scale Celery workers with the backlog",
+                                     epilog="Arguments after -- are passed to worker.py in local mode")
+    parser.add_argument('--mode', choices=['local', 'signal'], default='local',
+                        help="run the workers here, or only publish the desired count")
+    parser.add_argument('--min', type=int, default=1, dest='min_workers')
+    parser.add_argument('--max', type=int, default=4, dest='max_workers')
+    parser.add_argument('--tasks-per-worker', type=int, default=4, help="about each worker's pool concurrency")
+    parser.add_argument('--max-task-age', type=float, default=30.0,
+                        help="add a worker while the oldest waiting task is older than this many seconds")
+    parser.add_argument('--scale-up-step', type=int, default=2)
+    parser.add_argument('--scale-down-delay', type=float, default=60.0)
+    parser.add_argument('--drain-timeout', type=float, default=600.0)
+    parser.add_argument('--interval', type=float, default=5.0)
+    parser.add_argument('worker_args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if not 0 <= args.min_workers <= args.max_workers:
+        parser.error("need 0 <= --min <= --max")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    policy = ScalingPolicy(args.min_workers, args.max_workers, args.tasks_per_worker, args.max_task_age,
+                           args.scale_up_step, args.scale_down_delay)
+    signals = QueueSignals(redis.Redis.from_url(celery_app.conf.broker_url), jobs, lambda: celery_app.backend.client,
+                           celery_app.conf.task_default_queue)
+    worker_args = [a for a in args.worker_args if a != '--']
+    if args.mode == 'local':
+        workers = LocalWorkers(worker_args, args.drain_timeout)
+    else:
+        workers = ScalingSignal(lambda: celery_app.backend.client)
+
+    # Stop on SIGTERM as on Ctrl-C, draining the local workers
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        run(policy, signals, workers, args.interval)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        logger.info("Stopping: draining workers")
+        workers.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# celery_app.py
+"""
+The Celery application and its configuration, with nothing worker-only attached.
+
+The gateway enqueues tasks by name through this app, so it starts without provider SDKs, OpenCV or secrets.json;
+celery_config.py registers the task implementations on the same app for workers.
+"""
+import os
+import time
+
+from celery import Celery
+from celery.backends.redis import RedisBackend
+from celery.signals import before_task_publish
+
+from costs import CostLedger
+from jobs import JobStore
+from metrics import Metrics
+from resilience import CircuitBreaker
+import tracing
+
+# Broker, result backend, jobs and costs; load_test.py points it at a database of its own
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+
+
+class PollingRedisBackend(RedisBackend):
+    """Redis result backend for clients that poll for results rather than block on AsyncResult.get()."""
+
+    def on_task_call(self, producer, task_id):
+        # The stock backend subscribes to every sent task's pub/sub channel (and unsubscribes when the AsyncResult is
+        # collected) so get() can wait without polling. Nothing here blocks on a result, and those two round trips
+        # were half the cost of an enqueue.
+        pass
+
+
+# Create Celery application
+app = Celery('ai_tasks', broker=REDIS_URL, backend=f'celery_app:PollingRedisBackend+{REDIS_URL}')
+app.conf.update(
+    broker_connection_retry_on_startup=True,
+    worker_prefetch_multiplier=1,
+    task_acks_late=True,
+    task_serializer='json',
+    result_serializer='json',
+    accept_content=['json'],
+    result_expires=3600,
+)
+
+metrics = Metrics(lambda: app.backend.client)
+breaker = CircuitBreaker(lambda: app.backend.client)
+jobs = JobStore(lambda: app.backend.client)
+ledger = CostLedger(lambda: app.backend.client)
+
+
+@before_task_publish.connect
+def stamp_enqueue_time(headers=None, **kwargs):
+    headers['enqueued_at'] = time.time()
+    tracing.inject(headers)
+
+
+def send_ai_task(model_name, system_prompt, user_request, image_paths=None, hedge=True, stream=False, images=None,
+                 task_id=None, job_id=None):
+    """
+    Enqueue a call by task name; the implementations live in celery_config.py, which only workers import.
+
+    image_paths are files the workers read; images are base64 JPEGs sent with the task, for callers that hold the
+    crops in memory. The scheduler passes the task_id it handed out at submission and the job_id, which travels as a
+    message header so workers can count the job's progress.
+    """
+    options = {'task_id': task_id}
+    if job_id:
+        options['headers'] = {'job_id': job_id}
+    if image_paths or images:
+        kwargs = {'hedge': hedge, 'stream': stream}
+        if images:
+            kwargs['images'] = images
+        return app.send_task('ai_tasks.call_ai_api_img', args=[model_name, system_prompt, user_request, image_paths],
+                             kwargs=kwargs, **options)
+    return app.send_task('ai_tasks.call_ai_api', args=[model_name, system_prompt, user_request],
+                         kwargs={'hedge': hedge, 'stream': stream}, **options)
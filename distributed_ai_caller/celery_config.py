@@ -1,31 +1,28 @@
-import sys
 import json
 import os
+import time
 import logging
-from celery import Celery, states
+from contextlib import contextmanager
+from celery import states
+from celery.signals import task_prerun, task_postrun
 from celery.exceptions import SoftTimeLimitExceeded
 from celery.utils.serialization import UnpickleableExceptionWrapper
 
 import anthropic
+import openai
 from openai import OpenAI
 from image_utils import image_to_base64
+from celery_app import app, breaker, jobs, ledger, metrics
+from hedging import LatencyTracker, hedged_call, record_hedge_stats
+from resilience import CircuitOpenError, ProviderError, backoff_delay
+from token_stream import StreamInterruptedError, TokenPublisher
+import costs
+import tracing
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Create Celery application
-app = Celery('ai_tasks', broker='redis://localhost:6379/0', backend='redis://localhost:6379/0')
-app.conf.update(
-    broker_connection_retry_on_startup=True,
-    worker_prefetch_multiplier=1,
-    task_acks_late=True,
-    task_serializer='json',
-    result_serializer='json',
-    accept_content=['json'],
-    result_expires=3600,
-)
-
 def load_api_keys(file_path='secrets.json'):
     """Load API keys from a JSON file."""
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -40,99 +37,415 @@ def load_api_keys(file_path='secrets.json'):
         logger.error(f"Error: {file_path} is not a valid JSON file")
     return None
 
-# Load API keys
-api_keys = load_api_keys()
-if not api_keys:
-    logger.error("Failed to load API keys. Please check the secrets.json file.")
-    sys.exit(1)
+# Comparable models on the other provider, used for hedged attempts and for failover while a breaker is open
+MODEL_EQUIVALENTS = {
+    'claude-3-5-sonnet-20240620': 'gpt-4o',
+    'gpt-4o': 'claude-3-5-sonnet-20240620',
+    'claude-3-haiku-20240307': 'gpt-4o-mini',
+    'gpt-4o-mini': 'claude-3-haiku-20240307',
+}
 
-# Initialize API clients
-openai_client = OpenAI(api_key=api_keys['openai']['api_key'])
-anthropic_client = anthropic.Anthropic(api_key=api_keys['anthropic']['api_key'])
+# Hedging: if a provider call has not returned by the given percentile of recent latencies for its model,
+# a second attempt is fired (on the equivalent model if one is configured) and whichever answers first wins.
+HEDGE_POLICY = {
+    'enabled': True,
+    'percentile': 95,
+    'min_samples': 20,
+    'default_deadline': 30.0,
+    'min_deadline': 2.0,
+}
 
-def safe_result(func):
-    def wrapper(*args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            logger.error(f"Error in {func.__name__}: {str(e)}", exc_info=True)
-            return {
-                'status': 'error',
-                'message': str(e),
-                'type': type(e).__name__
-            }
-    return wrapper
-
-@app.task(name='ai_tasks.call_ai_api', bind=True, throws=(ValueError, SoftTimeLimitExceeded))
-@safe_result
-def call_ai_api(self, model_name, system_prompt, user_request):
-    logger.info(f"Task {self.request.id} started: model={model_name}")
+# Transient provider errors are retried by Celery with exponential backoff and full jitter, freeing the worker while
+# it waits. The SDKs' own retries are turned off so attempts are not multiplied, and the timeout bounds how long a
+# hung call can hold a worker.
+RETRY_POLICY = {
+    'max_retries': 5,
+    'backoff_base': 2.0,
+    'backoff_max': 120.0,
+    'provider_timeout': 120.0,
+}
+RETRYABLE_ERRORS = (
+    openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError,
+    anthropic.RateLimitError, anthropic.APIConnectionError, anthropic.InternalServerError,
+    CircuitOpenError,
+)
+
+latency_tracker = LatencyTracker(lambda: app.backend.client)
+
+# API clients are built on first use, so importing this module needs neither secrets.json nor network setup
+_clients = {}
+
+def get_api_keys():
+    if 'api_keys' not in _clients:
+        api_keys = load_api_keys()
+        if not api_keys:
+            raise RuntimeError("Failed to load API keys. Please check the secrets.json file.")
+        _clients['api_keys'] = api_keys
+    return _clients['api_keys']
+
+def get_openai_client():
+    if 'openai' not in _clients:
+        _clients['openai'] = OpenAI(api_key=get_api_keys()['openai']['api_key'], max_retries=0,
+                                    timeout=RETRY_POLICY['provider_timeout'])
+    return _clients['openai']
+
+def get_anthropic_client():
+    if 'anthropic' not in _clients:
+        _clients['anthropic'] = anthropic.Anthropic(api_key=get_api_keys()['anthropic']['api_key'], max_retries=0,
+                                                    timeout=RETRY_POLICY['provider_timeout'])
+    return _clients['anthropic']
+
+_task_spans = {}
+
+@task_prerun.connect
+def start_task_span(task_id=None, task=None, args=None, kwargs=None, **extra):
+    task_span = tracing.start_span('task', trace_id=task.request.get('trace_id'),
+                                   parent_id=task.request.get('parent_span_id'), task=task.name, task_id=task_id,
+                                   **task_labels(args, kwargs, 'total'))
+    token = tracing.activate(task_span)
+    _task_spans[task_id] = (task_span, token)
+    enqueued_at = task.request.get('enqueued_at')
+    if enqueued_at:
+        tracing.start_span('broker.wait', start=enqueued_at).finish(end=task_span.start)
+
+@task_postrun.connect
+def finish_task_span(task_id=None, retval=None, state=None, **extra):
+    task_span, token = _task_spans.pop(task_id, (None, None))
+    if task_span is None:
+        return
+    if state != states.SUCCESS:
+        task_span.error = f"{state}: {retval}"
+    task_span.finish()
+    tracing.deactivate(token)
+
+_task_usage = {}
+
+@task_prerun.connect
+def start_task_usage(task_id=None, task=None, **extra):
+    _task_usage[task_id] = costs.start_task(task.request.get('job_id'), task.request.get('prior_usage'))
+
+@task_postrun.connect
+def end_task_usage(task_id=None, **extra):
+    token = _task_usage.pop(task_id, None)
+    if token is not None:
+        costs.end_task(token)
+
+@task_prerun.connect
+def observe_queue_wait(task=None, args=None, kwargs=None, **extra):
+    enqueued_at = task.request.get('enqueued_at')
+    if enqueued_at:
+        metrics.observe('ai_task_latency_seconds', time.time() - enqueued_at, task_labels(args, kwargs, 'queue_wait'))
+
+@task_postrun.connect
+def observe_task_total(task=None, args=None, kwargs=None, retval=None, state=None, **extra):
+    status = {states.SUCCESS: 'success', states.RETRY: 'retry'}.get(state, 'error')
+    metrics.inc('ai_tasks_total', {'task': task.name, 'status': status})
+    enqueued_at = task.request.get('enqueued_at')
+    if enqueued_at:
+        metrics.observe('ai_task_latency_seconds', time.time() - enqueued_at, task_labels(args, kwargs, 'total'))
+
+@task_postrun.connect
+def record_job_progress(task=None, state=None, **extra):
+    job_id = task.request.get('job_id')
+    # A retry is the same task coming back later, not a finished one
+    if job_id and state != states.RETRY:
+        jobs.record_finished(job_id, state == states.SUCCESS)
+
+def task_labels(args, kwargs, stage):
+    model_name = args[0] if args else (kwargs or {}).get('model_name', '')
+    return {'model': model_name, 'provider': provider_name(model_name), 'stage': stage}
+
+def provider_name(model_name):
     if "gpt" in model_name.lower():
-        result = call_openai_api(model_name, system_prompt, user_request)
+        return 'openai'
     elif "claude" in model_name.lower():
-        result = call_claude_api(model_name, system_prompt, user_request)
-    else:
-        raise ValueError(f"Unsupported model: {model_name}")
+        return 'anthropic'
+    return 'unknown'
+
+@contextmanager
+def track_provider_call(model_name, images=None):
+    """
+    Record provider time, outcome, token usage and cost; the caller stores the SDK usage object in the yielded dict.
+
+    images are the call's base64 JPEGs, for estimating how many of its input tokens they took.
+    """
+    labels = {'model': model_name, 'provider': provider_name(model_name)}
+    call = {'usage': None}
+    start = time.monotonic()
+    try:
+        with tracing.span('provider.call', **labels):
+            yield call
+    except Exception as e:
+        metrics.inc('ai_provider_requests_total', {**labels, 'outcome': 'error'})
+        metrics.inc('ai_provider_errors_total', {**labels, 'type': type(e).__name__,
+                                                 'status': getattr(e, 'status_code', '')})
+        # Only errors that say the provider is unhealthy count towards its breaker; a bad request does not
+        if is_retryable(e):
+            breaker.record_failure(labels['provider'])
+        raise
+    breaker.record_success(labels['provider'])
+    metrics.observe('ai_task_latency_seconds', time.monotonic() - start, {**labels, 'stage': 'provider'})
+    metrics.inc('ai_provider_requests_total', {**labels, 'outcome': 'ok'})
+    if call['usage'] is not None:
+        record_usage(labels, call['usage'], images)
+
+def record_usage(labels, usage, images=None):
+    """Add a call's usage to the metrics, the running task's usage and the per-day and per-job ledger."""
+    input_tokens, output_tokens = costs.usage_tokens(usage)
+    call_usage = {
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'image_tokens': sum(costs.image_tokens(labels['provider'], image) for image in images or []),
+        'cost_usd': costs.cost_usd(labels['model'], input_tokens, output_tokens),
+        'calls': 1,
+    }
+    metrics.inc('ai_tokens_total', {**labels, 'direction': 'input'}, input_tokens)
+    metrics.inc('ai_tokens_total', {**labels, 'direction': 'output'}, output_tokens)
+    metrics.inc('ai_cost_usd_total', labels, call_usage['cost_usd'])
+    task_usage = costs.current_task()
+    if task_usage is not None:
+        task_usage.add(call_usage)
+    ledger.record(labels['model'], task_usage.job_id if task_usage else None, call_usage)
+
+def is_retryable(exc):
+    """Rate limits, timeouts, connection failures, 5xx responses and open breakers are worth another attempt."""
+    if isinstance(exc, RETRYABLE_ERRORS):
+        return True
+    status_code = getattr(exc, 'status_code', None)
+    return isinstance(status_code, int) and (status_code in (408, 409, 429) or status_code >= 500)
+
+def retry_delay(exc, retries):
+    """Backoff before the next attempt, never shorter than the provider's Retry-After or the breaker's cooldown."""
+    minimum = (exc.retry_in or 0) if isinstance(exc, CircuitOpenError) else 0
+    response = getattr(exc, 'response', None)
+    if response is not None:
+        try:
+            minimum = max(minimum, float(response.headers.get('retry-after', 0)))
+        except (TypeError, ValueError):
+            pass
+    return backoff_delay(retries, RETRY_POLICY['backoff_base'], RETRY_POLICY['backoff_max'], minimum)
+
+def retry_or_raise(task, exc, stream=False):
+    """Retry task after a backoff if exc is transient and retries remain; otherwise fail it with exc."""
+    retries = task.request.retries
+    if is_retryable(exc) and retries < task.max_retries:
+        countdown = retry_delay(exc, retries)
+        logger.warning(f"Task {task.request.id} retry {retries + 1}/{task.max_retries} in {countdown:.1f}s: "
+                       f"{type(exc).__name__}: {exc}")
+        # The retry carries the usage so far, so the result's usage covers every attempt
+        headers = {**(task.request.headers or {}), 'prior_usage': costs.current_usage()}
+        raise task.retry(exc=exc, countdown=countdown, headers=headers)
+    logger.error(f"Task {task.request.id} failed: {type(exc).__name__}: {exc}")
+    if stream:
+        TokenPublisher(app.backend.client, task.request.id).error(f"{type(exc).__name__}: {exc}")
+    if isinstance(exc, (openai.APIError, anthropic.APIError)):
+        raise ProviderError(type(exc).__name__, str(exc), getattr(exc, 'status_code', None)) from exc
+    raise exc
+
+@app.task(name='ai_tasks.call_ai_api', bind=True, max_retries=RETRY_POLICY['max_retries'],
+          throws=(ValueError, SoftTimeLimitExceeded, CircuitOpenError, ProviderError))
+def call_ai_api(self, model_name, system_prompt, user_request, hedge=True, stream=False):
+    logger.info(f"Task {self.request.id} started: model={model_name}")
+    try:
+        if stream:
+            result = stream_model(self.request.id, model_name, system_prompt, user_request)
+        else:
+            result = call_model(model_name, system_prompt, user_request, hedge=hedge)
+    except Exception as e:
+        retry_or_raise(self, e, stream)
     logger.info(f"Task {self.request.id} completed successfully")
-    return {'status': 'success', 'result': result}
+    return {'status': 'success', 'result': result, 'timings': tracing.current_timings(),
+            'usage': costs.current_usage()}
 
-@app.task(name='ai_tasks.call_ai_api_img', bind=True, throws=(ValueError, SoftTimeLimitExceeded))
-@safe_result
-def call_ai_api_img(self, model_name, system_prompt, user_request, image_paths=None):
+@app.task(name='ai_tasks.call_ai_api_img', bind=True, max_retries=RETRY_POLICY['max_retries'],
+          throws=(ValueError, SoftTimeLimitExceeded, CircuitOpenError, ProviderError))
+def call_ai_api_img(self, model_name, system_prompt, user_request, image_paths=None, hedge=True, stream=False,
+                    images=None):
     logger.info(f"Task {self.request.id} started: model={model_name}")
-    if "gpt" in model_name.lower():
-        result = call_openai_api_img(model_name, system_prompt, user_request, image_paths)
-    elif "claude" in model_name.lower():
-        result = call_claude_api_img(model_name, system_prompt, user_request, image_paths)
-    else:
-        raise ValueError(f"Unsupported model: {model_name}")
+    try:
+        images = encode_images(image_paths, images)
+        if stream:
+            result = stream_model(self.request.id, model_name, system_prompt, user_request, images)
+        else:
+            result = call_model(model_name, system_prompt, user_request, images, hedge=hedge)
+    except Exception as e:
+        retry_or_raise(self, e, stream)
     logger.info(f"Task {self.request.id} completed successfully")
-    return {'status': 'success', 'result': result}
+    return {'status': 'success', 'result': result, 'timings': tracing.current_timings(),
+            'usage': costs.current_usage()}
+
+def encode_images(image_paths=None, images=None):
+    """
+    Base64 JPEGs for the call: image_paths read from disk (JPEG files are passed through as is) followed by images,
+    which callers holding crops in memory send already encoded.
+
+    Done once per task, so retries and hedged attempts reuse the same payload.
+    """
+    encoded = []
+    for image_path in image_paths or []:
+        with tracing.span('image.encode', path=image_path):
+            base64_image = image_to_base64(image_path)
+        if base64_image is None:
+            raise ValueError(f"Could not read image {image_path}")
+        encoded.append(base64_image)
+    return encoded + list(images or [])
+
+def get_provider_call(model_name, with_images=False):
+    """Return the provider helper that serves model_name."""
+    provider = provider_name(model_name)
+    if provider == 'openai':
+        return call_openai_api_img if with_images else call_openai_api
+    elif provider == 'anthropic':
+        return call_claude_api_img if with_images else call_claude_api
+    raise ValueError(f"Unsupported model: {model_name}")
+
+def choose_model(model_name):
+    """
+    Return model_name, or its equivalent on the other provider while model_name's breaker is open.
 
-@safe_result
-def call_openai_api(model_name, system_prompt, user_request):
+    Raises CircuitOpenError when neither provider can take the call, so the task fails fast and retries after the
+    cooldown instead of waiting on a provider that is down.
+    """
+    provider = provider_name(model_name)
+    if breaker.allow(provider):
+        return model_name
+    metrics.inc('ai_provider_requests_total', {'model': model_name, 'provider': provider, 'outcome': 'circuit_open'})
+    fallback = MODEL_EQUIVALENTS.get(model_name)
+    if fallback and provider_name(fallback) != provider and breaker.allow(provider_name(fallback)):
+        logger.warning(f"Circuit breaker open for {provider}, failing over from {model_name} to {fallback}")
+        return fallback
+    raise CircuitOpenError(provider, breaker.retry_in(provider))
+
+def call_model(model_name, system_prompt, user_request, images=None, hedge=True):
+    """
+    Call model_name, hedging against the equivalent model when the call runs past the latency deadline.
+
+    Each attempt checks the circuit breakers first and is failed over to the equivalent model if its provider is down.
+    """
+    with_images = images is not None
+
+    def attempt(name):
+        def run():
+            chosen = choose_model(name)
+            provider_call = get_provider_call(chosen, with_images)
+            args = (chosen, system_prompt, user_request, images) if with_images \
+                else (chosen, system_prompt, user_request)
+            start = time.monotonic()
+            result = provider_call(*args)
+            latency_tracker.record(chosen, time.monotonic() - start)
+            return result
+        return run
+
+    primary = attempt(model_name)
+    if not (hedge and HEDGE_POLICY['enabled']):
+        return primary()
+
+    hedge_model = MODEL_EQUIVALENTS.get(model_name, model_name)
+    deadline = latency_tracker.deadline(model_name, HEDGE_POLICY['percentile'], HEDGE_POLICY['min_samples'],
+                                        HEDGE_POLICY['default_deadline'], HEDGE_POLICY['min_deadline'])
+    result, winner, hedged = hedged_call(primary, attempt(hedge_model), deadline)
+    record_hedge_stats(app.backend.client, model_name, hedged, winner)
+    if hedged:
+        logger.info(f"Hedged call for {model_name} won by {winner} ({hedge_model if winner == 'hedge' else model_name})")
+    return result
+
+def stream_model(task_id, model_name, system_prompt, user_request, images=None):
+    """Call model_name, publishing tokens to the task's Redis stream as they arrive. Streamed calls are not hedged."""
+    publisher = TokenPublisher(app.backend.client, task_id)
+    model_name = choose_model(model_name)
+    provider_call = get_provider_call(model_name, images is not None)
+    args = (model_name, system_prompt, user_request, images) if images is not None \
+        else (model_name, system_prompt, user_request)
+    try:
+        result = provider_call(*args, on_token=publisher.token)
+    except Exception as e:
+        if publisher.started:
+            # Tokens already relayed to the client cannot be taken back, so a stream that broke midway is not retried
+            raise StreamInterruptedError(f"{type(e).__name__}: {e}") from e
+        raise
+    publisher.done(result)
+    return result
+
+def create_openai_completion(model_name, messages, on_token=None, images=None):
+    """Run a chat completion and return its text, passing each token to on_token if given."""
+    with track_provider_call(model_name, images) as call:
+        if on_token is None:
+            completion = get_openai_client().chat.completions.create(model=model_name, messages=messages)
+            call['usage'] = completion.usage
+            return completion.choices[0].message.content
+
+        parts = []
+        for chunk in get_openai_client().chat.completions.create(model=model_name, messages=messages, stream=True,
+                                                                 stream_options={"include_usage": True}):
+            if chunk.usage:
+                call['usage'] = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                on_token(chunk.choices[0].delta.content)
+        return ''.join(parts)
+
+def create_claude_message(model_name, system_prompt, messages, on_token=None, images=None):
+    """Create a message and return its text, passing each token to on_token if given."""
+    with track_provider_call(model_name, images) as call:
+        if on_token is None:
+            message = get_anthropic_client().messages.create(
+                model=model_name,
+                max_tokens=1024,
+                system=system_prompt,
+                messages=messages
+            )
+            call['usage'] = message.usage
+            return message.content[0].text
+
+        with get_anthropic_client().messages.stream(
+            model=model_name,
+            max_tokens=1024,
+            system=system_prompt,
+            messages=messages
+        ) as stream:
+            for text in stream.text_stream:
+                on_token(text)
+            message = stream.get_final_message()
+            call['usage'] = message.usage
+            return message.content[0].text
+
+def parse_result(text):
+    """Return the reply as JSON if it parses, else the raw text."""
+    with tracing.span('result.parse'):
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            return text
+
+def call_openai_api(model_name, system_prompt, user_request, on_token=None):
     logger.info("Starting OpenAI API call")
-    completion = openai_client.chat.completions.create(
-        model=model_name,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_request}
-        ]
-    )
-    result = completion.choices[0].message.content
+    result = create_openai_completion(model_name, [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_request}
+    ], on_token)
     logger.info("OpenAI API call completed successfully")
     return result
 
-@safe_result
-def call_claude_api(model_name, system_prompt, user_request):
+def call_claude_api(model_name, system_prompt, user_request, on_token=None):
     logger.info("Starting Claude API call")
     messages = [
         {"role": "user", "content": user_request}
     ]
 
-    message = anthropic_client.messages.create(
-        model=model_name,
-        max_tokens=1024,
-        system=system_prompt,
-        messages=messages
-    )
+    text = create_claude_message(model_name, system_prompt, messages, on_token)
 
-    try:
-        result = json.loads(message.content[0].text)
-    except json.JSONDecodeError:
-        result = message.content[0].text
+    result = parse_result(text)
 
     logger.info("Claude API call completed successfully")
     return result
 
-@safe_result
-def call_openai_api_img(model_name, system_prompt, user_request, image_paths=None):
+def call_openai_api_img(model_name, system_prompt, user_request, images=None, on_token=None):
     logger.info("Starting OpenAI API call with image")
     messages = [{"role": "system", "content": system_prompt}]
 
-    if image_paths:
-        for image_path in image_paths:
-            base64_image = image_to_base64(image_path)
+    if images:
+        for base64_image in images:
+            metrics.observe('ai_image_payload_bytes', len(base64_image) * 3 // 4, {'provider': 'openai'})
             messages.append({
                 "role": "user",
                 "content": [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}]
@@ -140,22 +453,17 @@ def call_openai_api_img(model_name, system_prompt, user_request, image_paths=Non
 
     messages.append({"role": "user", "content": user_request})
 
-    completion = openai_client.chat.completions.create(
-        model=model_name,
-        messages=messages
-    )
-    result = completion.choices[0].message.content
+    result = create_openai_completion(model_name, messages, on_token, images)
     logger.info("OpenAI API call with image completed successfully")
     return result
 
-@safe_result
-def call_claude_api_img(model_name, system_prompt, user_request, image_paths=None):
+def call_claude_api_img(model_name, system_prompt, user_request, images=None, on_token=None):
     logger.info("Starting Anthropic API call with image")
     messages = []
 
-    if image_paths:
-        for i, image_path in enumerate(image_paths, 1):
-            base64_image = image_to_base64(image_path)
+    if images:
+        for i, base64_image in enumerate(images, 1):
+            metrics.observe('ai_image_payload_bytes', len(base64_image) * 3 // 4, {'provider': 'anthropic'})
             messages.extend([
                 {"type": "text", "text": f"Image {i}:"},
                 {
@@ -170,17 +478,10 @@ def call_claude_api_img(model_name, system_prompt, user_request, image_paths=Non
 
     messages.append({"type": "text", "text": user_request})
 
-    message = anthropic_client.messages.create(
-        model=model_name,
-        max_tokens=1024,
-        system=system_prompt,
-        messages=[{"role": "user", "content": messages}]
-    )
+    text = create_claude_message(model_name, system_prompt, [{"role": "user", "content": messages}], on_token,
+                                 images)
 
-    try:
-        result = json.loads(message.content[0].text)
-    except json.JSONDecodeError:
-        result = message.content[0].text
+    result = parse_result(text)
 
     logger.info("Anthropic API call with image completed successfully")
     return result
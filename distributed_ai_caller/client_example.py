@@ -1,16 +1,18 @@
 # client_example.py
+import json
 import time
 
 import requests
 
 
-def call_ai_api(model_name, system_prompt, user_request, image_paths=None):
+def call_ai_api(model_name, system_prompt, user_request, image_paths=None, stream=False):
     url = "http://localhost:5000/call_ai"
     payload = {
         "model_name": model_name,
         "system_prompt": system_prompt,
         "user_request": user_request,
-        "image_paths": image_paths
+        "image_paths": image_paths,
+        "stream": stream
     }
     response = requests.post(url, json=payload)
     response.raise_for_status()  # 如果请求失败，这将抛出异常
@@ -25,12 +27,14 @@ def get_result(task_id):
     for _ in range(max_retries):
         try:
             response = requests.get(url)
-            response.raise_for_status()  # 如果请求失败，这将抛出异常
+            # 任务失败（重试耗尽或不可重试的错误）时返回500和错误信息，此时不再轮询
+            if response.status_code != 500 or response.json().get("status") != "error":
+                response.raise_for_status()  # 如果请求失败，这将抛出异常
             result = response.json()
             if result["status"] == "completed":
                 return result["result"]
             elif result["status"] == "error":
-                raise Exception(result["message"])
+                raise Exception(f"{result.get('type', 'Error')}: {result['message']}")
             time.sleep(retry_delay)
         except requests.RequestException as e:
             print(f"请求发生错误: {e}")
@@ -39,6 +43,26 @@ def get_result(task_id):
     raise TimeoutError("获取结果超时")
 
 
+def stream_result(task_id, on_token=lambda token: print(token, end="", flush=True)):
+    # 通过SSE逐个接收token，返回最终结果（任务需以stream=True提交）
+    url = f"http://localhost:5000/stream/{task_id}"
+    with requests.get(url, stream=True, timeout=(5, 60)) as response:
+        response.raise_for_status()
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                data = json.loads(line[len("data:"):])
+                if event == "token":
+                    on_token(data)
+                elif event == "done":
+                    return data
+                elif event == "error":
+                    raise Exception(data)
+    raise Exception("流在结果返回前中断")
+
+
 def main():
     try:
         # 示例1：调用OpenAI的GPT模型
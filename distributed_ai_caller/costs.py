@@ -0,0 +1,299 @@
+# costs.py
+"""
+Token and cost accounting, and the budgets that hold back bulk grading jobs.
+
+Every provider call's usage (input and output tokens as the SDK reports them, plus an estimate of how many of the
+input tokens were images, which neither SDK breaks out) is priced with MODEL_PRICES and added up in Redis per day and
+per job, each broken down by model. A task returns its own usage with its result, hedged attempts and the attempts
+before a retry included, since all of them are billed.
+
+Budgets apply to jobs only, so interactive calls (sent without a job_id) are never held back, though what they spend
+still counts towards the day. A job may have its own budget (POST /jobs with budget_usd) and all jobs share the daily
+budget (POST /budget, or python costs.py --daily-budget 20). As the larger of the two fractions spent reaches each
+threshold of BUDGET_POLICY, the scheduler dispatches the job's tasks more slowly (at most slow_quota in flight), then on
+its CHEAPER_MODELS model as well, then not at all until the budget is raised or the day turns over.
+
+    python costs.py                 # today's spend by model
+    python costs.py --job exam-1    # one job's spend
+"""
+import argparse
+import base64
+import contextvars
+import io
+import json
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+COST_KEY_PREFIX = 'ai_costs:'
+DAILY_BUDGET_KEY = COST_KEY_PREFIX + 'daily_budget'
+# Spend per day is kept for a quarter, per job as long as a finished job's record
+DAY_TTL = 90 * 24 * 3600
+JOB_TTL = 7 * 24 * 3600
+
+# USD per million tokens: (input, output). Image tokens are billed as input tokens.
+MODEL_PRICES = {
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'claude-3-5-sonnet-20240620': (3.00, 15.00),
+    'claude-3-haiku-20240307': (0.25, 1.25),
+}
+# What a job is switched to once its budget reaches downgrade_at
+CHEAPER_MODELS = {
+    'gpt-4o': 'gpt-4o-mini',
+    'claude-3-5-sonnet-20240620': 'claude-3-haiku-20240307',
+}
+# Fractions of a budget at which bulk work is slowed, moved to the cheaper model, and paused; None turns a step off
+BUDGET_POLICY = {
+    'slow_at': 0.8,
+    'slow_quota': 1,
+    'downgrade_at': 0.9,
+    'pause_at': 1.0,
+}
+USAGE_FIELDS = ('input_tokens', 'output_tokens', 'image_tokens', 'cost_usd', 'calls')
+
+_unpriced = set()
+
+
+def usage_tokens(usage):
+    """(input, output) tokens from an OpenAI or Anthropic usage object."""
+    input_tokens = getattr(usage, 'input_tokens', None) or getattr(usage, 'prompt_tokens', 0) or 0
+    output_tokens = getattr(usage, 'output_tokens', None) or getattr(usage, 'completion_tokens', 0) or 0
+    return input_tokens, output_tokens
+
+
+def cost_usd(model_name, input_tokens, output_tokens):
+    prices = MODEL_PRICES.get(model_name)
+    if prices is None:
+        if model_name not in _unpriced:
+            _unpriced.add(model_name)
+            logger.warning(f"No price configured for {model_name}; its calls are counted at $0")
+        return 0.0
+    return (input_tokens * prices[0] + output_tokens * prices[1]) / 1e6
+
+
+def image_tokens(provider, base64_image):
+    """
+    Estimated input tokens for one base64 JPEG, from the providers' published sizing rules.
+
+    Only the image header is parsed. Anthropic scales images to at most 1568 px and 1.15 megapixels and charges
+    width * height / 750; OpenAI fits them in 2048 px, then the short side in 768 px, and charges 85 plus 170 per
+    512 px tile.
+    """
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(base64_image))) as img:
+            width, height = img.size
+    except Exception:
+        return 0
+    if provider == 'anthropic':
+        scale = min(1.0, 1568 / max(width, height), math.sqrt(1.15e6 / (width * height)))
+        return math.ceil(width * scale * height * scale / 750)
+    if provider == 'openai':
+        scale = min(1.0, 2048 / max(width, height))
+        scale *= min(1.0, 768 / (min(width, height) * scale))
+        return 85 + 170 * math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 0
+
+
+class TaskUsage:
+    """
+    Usage of the provider calls made by one task, hedged attempts (which run on other threads) included. prior is the
+    usage of the task's earlier attempts, which a retry carries over in its prior_usage header.
+    """
+
+    def __init__(self, job_id=None, prior=None):
+        self.job_id = job_id
+        self.totals = {field: (prior or {}).get(field, 0) for field in USAGE_FIELDS}
+        self.lock = threading.Lock()
+
+    def add(self, usage):
+        with self.lock:
+            for field in USAGE_FIELDS:
+                self.totals[field] += usage[field]
+
+    def result(self):
+        with self.lock:
+            return {**self.totals, 'cost_usd': round(self.totals['cost_usd'], 6)}
+
+
+_task_usage = contextvars.ContextVar('task_usage', default=None)
+
+
+def start_task(job_id=None, prior=None):
+    """Collect the usage of the calls made in this context, on top of prior; returns a token for end_task()."""
+    return _task_usage.set(TaskUsage(job_id, prior))
+
+
+def end_task(token):
+    _task_usage.reset(token)
+
+
+def current_task():
+    return _task_usage.get()
+
+
+def current_usage():
+    """This task's usage so far, for storing with its result; None outside a task."""
+    task = _task_usage.get()
+    return task.result() if task else None
+
+
+def day_key(day=None):
+    return f"{COST_KEY_PREFIX}day:{day or time.strftime('%Y-%m-%d')}"
+
+
+def job_key(job_id):
+    return f"{COST_KEY_PREFIX}job:{job_id}"
+
+
+def parse_breakdown(fields):
+    """{'cost_usd': total, 'models': {model: usage}} from a day's or job's hash."""
+    totals = {'cost_usd': 0.0, 'models': {}}
+    for field, value in fields.items():
+        model, name = field.decode().rsplit('|', 1)
+        totals['models'].setdefault(model, dict.fromkeys(USAGE_FIELDS, 0))[name] = float(value)
+    for usage in totals['models'].values():
+        for name in USAGE_FIELDS:
+            usage[name] = round(usage[name], 6) if name == 'cost_usd' else int(usage[name])
+        totals['cost_usd'] += usage['cost_usd']
+    totals['cost_usd'] = round(totals['cost_usd'], 6)
+    return totals
+
+
+class CostLedger:
+    """
+    Spend per day and per job in Redis hashes (ai_costs:day:<date>, ai_costs:job:<id>), one '<model>|<field>' entry
+    per model and usage field, so every worker adds to the same totals.
+    """
+
+    def __init__(self, get_client):
+        self.get_client = get_client
+
+    def record(self, model_name, job_id, usage):
+        try:
+            pipe = self.get_client().pipeline(transaction=False)
+            keys = [(day_key(), DAY_TTL)] + ([(job_key(job_id), JOB_TTL)] if job_id else [])
+            for key, ttl in keys:
+                for field in USAGE_FIELDS:
+                    pipe.hincrbyfloat(key, f"{model_name}|{field}", usage[field])
+                pipe.expire(key, ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not record cost of a {model_name} call: {e}")
+
+    def day(self, day=None):
+        day = day or time.strftime('%Y-%m-%d')
+        return {'date': day, **parse_breakdown(self.get_client().hgetall(day_key(day))),
+                'budget_usd': self.daily_budget()}
+
+    def job(self, job_id):
+        return {'job_id': job_id, **parse_breakdown(self.get_client().hgetall(job_key(job_id)))}
+
+    def daily_budget(self):
+        value = self.get_client().get(DAILY_BUDGET_KEY)
+        return float(value) if value else None
+
+    def set_daily_budget(self, budget_usd):
+        """Set the daily budget for jobs, or remove it with None."""
+        if budget_usd:
+            self.get_client().set(DAILY_BUDGET_KEY, float(budget_usd))
+        else:
+            self.get_client().delete(DAILY_BUDGET_KEY)
+
+    def spent(self, job_ids):
+        """(today's spend, {job id: spend}), read in one round trip."""
+        pipe = self.get_client().pipeline()
+        pipe.hgetall(day_key())
+        for job_id in job_ids:
+            pipe.hgetall(job_key(job_id))
+        replies = pipe.execute()
+        return (parse_breakdown(replies[0])['cost_usd'],
+                {job_id: parse_breakdown(fields)['cost_usd'] for job_id, fields in zip(job_ids, replies[1:])})
+
+
+def budget_action(spent, budget, policy=None):
+    """None, 'slow', 'downgrade' or 'pause' for spent out of budget (no budget: None)."""
+    policy = policy or BUDGET_POLICY
+    if not budget:
+        return None
+    fraction = spent / budget
+    for action in ('pause', 'downgrade', 'slow'):
+        threshold = policy.get(f'{action}_at')
+        if threshold is not None and fraction >= threshold:
+            return action
+    return None
+
+
+class BudgetGuard:
+    """What the scheduler does with each job given its own and the daily budget."""
+
+    SEVERITY = (None, 'slow', 'downgrade', 'pause')
+
+    def __init__(self, ledger, policy=None, refresh=1.0):
+        self.ledger = ledger
+        self.policy = policy or BUDGET_POLICY
+        self.refresh = refresh
+        self.read_at = None
+        self.spending = (0.0, {}, None)
+        self.last = {}
+
+    def actions(self, active):
+        """{job id: action} for the active jobs, logging each change."""
+        # Spend moves slowly next to the scheduler's ticks, so it is read at most every refresh seconds
+        now = time.monotonic()
+        if self.read_at is None or now - self.read_at >= self.refresh or set(active) - set(self.spending[1]):
+            spent_today, spent_by_job = self.ledger.spent(list(active))
+            self.spending = (spent_today, spent_by_job, self.ledger.daily_budget())
+            self.read_at = now
+        spent_today, spent_by_job, daily_budget = self.spending
+        daily = budget_action(spent_today, daily_budget, self.policy)
+        actions = {}
+        for job_id, job in active.items():
+            own = budget_action(spent_by_job.get(job_id, 0.0), job.get('budget_usd'), self.policy)
+            actions[job_id] = max(own, daily, key=self.SEVERITY.index)
+            if actions[job_id] != self.last.get(job_id):
+                logger.warning(f"Job {job_id} budget action: {actions[job_id] or 'none'} "
+                               f"(job ${spent_by_job.get(job_id, 0.0):.2f} of {job.get('budget_usd') or '-'}, "
+                               f"today ${spent_today:.2f})")
+        self.last = actions
+        return actions
+
+    def apply(self, job, action):
+        """Limit the job's in-flight tasks for 'slow' and 'downgrade'; returns False if it must not dispatch."""
+        if action == 'pause':
+            return False
+        if action in ('slow', 'downgrade'):
+            slow_quota = self.policy['slow_quota']
+            job['quota'] = min(job['quota'], slow_quota) if job['quota'] else slow_quota
+        return True
+
+    @staticmethod
+    def task_args(args, action):
+        if action == 'downgrade' and args.get('model_name') in CHEAPER_MODELS:
+            return {**args, 'model_name': CHEAPER_MODELS[args['model_name']]}
+        return args
+
+
+def main():
+    import redis
+    from celery_app import REDIS_URL
+
+    parser = argparse.ArgumentParser(description="Show token and cost totals, or set the daily budget for jobs")
+    parser.add_argument('--date', help="day to show, YYYY-MM-DD (default today)")
+    parser.add_argument('--job', help="show this job's spend instead of a day's")
+    parser.add_argument('--daily-budget', type=float, help="USD per day for all jobs; 0 removes the budget")
+    args = parser.parse_args()
+
+    client = redis.Redis.from_url(REDIS_URL)
+    ledger = CostLedger(lambda: client)
+    if args.daily_budget is not None:
+        ledger.set_daily_budget(args.daily_budget)
+    print(json.dumps(ledger.job(args.job) if args.job else ledger.day(args.date), indent=1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+# gateway.py
+"""
+Production gateway for /call_ai, /get_result and /stream: an ASGI app served by uvicorn with several worker processes.
+
+master.py stays the all-in-one development server (jobs, metrics, hedge stats); this serves the hot endpoints
+without blocking the event loop. Enqueueing goes through Celery's thread-safe producer pool on a bounded
+thread pool, results are read straight from the result backend with redis.asyncio, and request bodies are validated
+before anything touches the broker.
+
+    python gateway.py --workers 4 --port 5000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, List, Optional
+
+import redis.asyncio as aioredis
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from quart import Quart, Response, g, jsonify, request
+
+from celery_app import app as celery_app, jobs, metrics, send_ai_task
+from token_stream import format_sse, read_events_async
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Inline images (base64 JPEG crops) make up most of a large request
+MAX_BODY_BYTES = 16 * 1024 * 1024
+MAX_PROMPT_CHARS = 200_000
+MAX_IMAGES = 32
+MAX_IMAGE_CHARS = 8 * 1024 * 1024
+MAX_TASK_ID_CHARS = 64
+# Threads per process for send_task and metric writes; each holds at most one broker connection
+IO_THREADS = 32
+# Results and errors can hold whole model replies; only this much of one is logged
+LOG_RESULT_CHARS = 200
+
+app = Quart(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_BODY_BYTES
+
+InlineImage = Annotated[str, Field(max_length=MAX_IMAGE_CHARS)]
+
+
+class CallAIRequest(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+
+    model_name: str = Field(min_length=1, max_length=100)
+    system_prompt: str = Field(max_length=MAX_PROMPT_CHARS)
+    user_request: str = Field(max_length=MAX_PROMPT_CHARS)
+    image_paths: Optional[List[str]] = Field(default=None, max_length=MAX_IMAGES)
+    # Base64 JPEGs sent inline by callers that hold the crops in memory
+    images: Optional[List[InlineImage]] = Field(default=None, max_length=MAX_IMAGES)
+    hedge: bool = True
+    stream: bool = False
+    # Submit as part of a job, dispatched by scheduler.py in fair shares with other jobs
+    job_id: Optional[str] = Field(default=None, min_length=1, max_length=MAX_TASK_ID_CHARS)
+
+
+@app.before_serving
+async def start_clients():
+    # to_thread copies contextvars, so the active span reaches before_task_publish and is injected into the headers
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(IO_THREADS, thread_name_prefix='gateway-io'))
+    app.backend_client = aioredis.Redis.from_url(celery_app.backend.url)
+
+
+@app.after_serving
+async def close_clients():
+    await app.backend_client.aclose()
+
+
+@app.before_request
+async def start_timer():
+    g.request_start = time.monotonic()
+
+
+@app.after_request
+async def observe_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    elapsed = time.monotonic() - g.request_start
+
+    def record():
+        metrics.inc('ai_gateway_requests_total', {'endpoint': endpoint, 'status': response.status_code})
+        metrics.observe('ai_gateway_latency_seconds', elapsed, {'endpoint': endpoint})
+    # Fire and forget: a slow metrics write should not delay the response
+    asyncio.get_running_loop().run_in_executor(None, record)
+    return response
+
+
+@app.route('/call_ai', methods=['POST'])
+async def call_ai():
+    body = await request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"status": "error", "message": "Request body must be a JSON object"}), 400
+    try:
+        data = CallAIRequest.model_validate(body)
+    except ValidationError as e:
+        return jsonify({"status": "error", "message": "Invalid request",
+                        "errors": e.errors(include_url=False, include_input=False)}), 400
+
+    trace_id, parent_id = tracing.parse_traceparent(request.headers.get('traceparent'))
+    enqueue_span = tracing.start_span('gateway.call_ai', trace_id=trace_id, parent_id=parent_id, model=data.model_name)
+    token = tracing.activate(enqueue_span)
+    try:
+        if data.job_id:
+            task_id = await asyncio.to_thread(jobs.submit, data.job_id, data.model_dump(exclude={'job_id'}))
+        else:
+            task = await asyncio.to_thread(send_ai_task, data.model_name, data.system_prompt, data.user_request,
+                                           data.image_paths, data.hedge, data.stream, data.images)
+            task_id = task.id
+    except Exception as e:
+        enqueue_span.error = f"{type(e).__name__}: {e}"
+        logger.error(f"Could not enqueue task for model {data.model_name}: {e}")
+        return jsonify({"status": "error", "message": "Could not enqueue task"}), 503
+    finally:
+        tracing.deactivate(token)
+        enqueue_span.finish()
+
+    logger.debug(f"Task {task_id} created for model {data.model_name}")
+    response = {"task_id": task_id, "trace_id": enqueue_span.trace_id}
+    if data.job_id:
+        response["job_id"] = data.job_id
+    if data.stream:
+        response["stream_url"] = f"/stream/{task_id}"
+    return jsonify(response), 202
+
+
+@app.route('/get_result/<task_id>', methods=['GET'])
+async def get_result(task_id):
+    if len(task_id) > MAX_TASK_ID_CHARS:
+        return jsonify({"status": "error", "message": "Invalid task id"}), 400
+    backend = celery_app.backend
+    try:
+        raw = await app.backend_client.get(backend.get_key_for_task(task_id))
+    except Exception as e:
+        logger.error(f"Could not read result for task {task_id}: {e}")
+        return jsonify({"status": "error", "message": "Result backend unavailable"}), 503
+
+    # A missing key is a task that has not finished (or never existed), which Celery also reports as PENDING
+    meta = backend.decode_result(raw) if raw else {'status': 'PENDING'}
+    if meta['status'] == 'SUCCESS':
+        return jsonify({"status": "completed", "result": meta['result']})
+    if meta['status'] in ('FAILURE', 'REVOKED'):
+        error = meta['result']
+        logger.warning(f"Task {task_id} failed: {str(error)[:LOG_RESULT_CHARS]}")
+        return jsonify({"status": "error", "message": str(error),
+                        "type": getattr(error, 'error_type', type(error).__name__)}), 500
+    return jsonify({"status": "pending"}), 202
+
+
+@app.route('/stream/<task_id>', methods=['GET'])
+async def stream_result(task_id):
+    """Relay a streaming task's tokens as Server-Sent Events, ending with a 'done' or 'error' event."""
+    if len(task_id) > MAX_TASK_ID_CHARS:
+        return jsonify({"status": "error", "message": "Invalid task id"}), 400
+    last_id = request.headers.get('Last-Event-ID', '0')
+
+    async def events():
+        async for entry_id, event, data in read_events_async(app.backend_client, task_id, last_id):
+            yield format_sse(entry_id, event, data).encode('utf-8')
+
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # A stream lasts as long as the provider call, past Quart's default response timeout
+    response.timeout = None
+    return response
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve /call_ai, /get_result and /stream with uvicorn")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="uvicorn worker processes")
+    parser.add_argument('--log-level', default='warning')
+    parser.add_argument('--access-log', action='store_true', help="log every request (off for throughput)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    uvicorn.run('gateway:app', host=args.host, port=args.port, workers=args.workers, log_level=args.log_level,
+                access_log=args.access_log)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+# gradebook.py
+"""
+Class gradebook and per-question statistics built from the graded sheets in output/.
+
+Each sheet folder holds id.json (student id, from Task_AnswerSheetNamerec) and result.json (per-question verdicts,
+from Task_AnswerSheetReview). iter_sheets() reads them one folder at a time and csv_chunks()/xlsx_chunks() turn the
+rows into a download as they are read, so exporting any number of sheets takes the memory of one row.
+
+The statistics are kept up to date as results are saved instead of by rescanning: Task_AnswerSheetReview.save_result
+calls QuestionStats.record() with the sheet's previous and new verdicts, which moves the sheet's counts in
+output/question_stats.json. A regraded sheet is counted once, with its latest verdicts. For an output/ graded before
+the statistics existed, build them once with:
+
+    python gradebook.py --rebuild output
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import threading
+import zipfile
+from xml.sax.saxutils import escape
+
+from grading_manifest import write_json_atomic
+
+STATS_FILE = 'question_stats.json'
+VERDICTS = ('correct', 'incorrect', 'review_required')
+
+
+def parse_json_content(content):
+    return content if isinstance(content, dict) else json.loads(content)
+
+
+def parsed_result(result):
+    """The reply saved in id.json or result.json as a dict, or None for a failed task or a reply that is not JSON."""
+    if not isinstance(result, dict) or result.get('status') != 'success':
+        return None
+    try:
+        verdicts = parse_json_content(result.get('result'))
+    except (TypeError, ValueError):
+        return None
+    return verdicts if isinstance(verdicts, dict) else None
+
+
+def read_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def question_order(question):
+    return (0, int(question), '') if str(question).isdigit() else (1, 0, str(question))
+
+
+def iter_sheets(output_folder):
+    """Yield (folder, student id or None, verdicts) for every graded sheet, one folder read at a time."""
+    with os.scandir(output_folder) as entries:
+        folders = sorted(entry.name for entry in entries if entry.is_dir())
+    for folder in folders:
+        verdicts = parsed_result(read_json(os.path.join(output_folder, folder, 'result.json')))
+        if verdicts is None:
+            continue
+        student = parsed_result(read_json(os.path.join(output_folder, folder, 'id.json'))) or {}
+        yield folder, student.get('student_id'), verdicts
+
+
+def gradebook_rows(sheets, questions):
+    # questions is how many questions the sheet was graded on, not a score
+    yield ['folder', 'student_id'] + [f"Q{q}" for q in questions] + ['correct', 'review_required', 'questions']
+    for folder, student_id, verdicts in sheets:
+        row = [verdicts.get(q, '') for q in questions]
+        yield [folder, student_id or ''] + row + [row.count('correct'), row.count('review_required'), len(questions)]
+
+
+def csv_chunks(rows):
+    """Encode rows as CSV one row at a time; the BOM makes Excel read the file as UTF-8."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    yield '\ufeff'.encode('utf-8')
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+
+class _ChunkSink:
+    """Write-only file object that hands what was written to the generator reading it."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>',
+    'xl/workbook.xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Gradebook" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>',
+}
+
+
+def xlsx_cell(value):
+    if isinstance(value, (int, float)):
+        return f'<c><v>{value}</v></c>'
+    return f'<c t="inlineStr"><is><t>{escape(str(value))}</t></is></c>'
+
+
+def xlsx_chunks(rows):
+    """
+    Encode rows as a one-sheet XLSX workbook while they are produced.
+
+    The sheet is written straight into a zip stream with inline strings (no shared-string table to collect first),
+    so nothing but the current row is held; zipfile falls back to data descriptors on an unseekable output.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        for name, xml in XLSX_PARTS.items():
+            workbook.writestr(name, xml)
+        with workbook.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            for row in rows:
+                sheet.write(('<row>' + ''.join(xlsx_cell(value) for value in row) + '</row>').encode('utf-8'))
+                chunk = sink.take()
+                if chunk:
+                    yield chunk
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.take()
+
+
+class QuestionStats:
+    """
+    Per-question verdict counts over the graded sheets of one output folder, kept in STATS_FILE there.
+
+    Each update re-reads the file under a lock, so the threads of one grading run add up; it is not meant for two runs
+    writing the same folder at once.
+    """
+
+    _locks = {}
+
+    def __init__(self, output_folder):
+        self.path = os.path.join(output_folder, STATS_FILE)
+        self.lock = QuestionStats._locks.setdefault(os.path.abspath(self.path), threading.Lock())
+
+    def read(self):
+        stats = read_json(self.path) or {}
+        return {'sheets': stats.get('sheets', 0), 'questions': stats.get('questions', {})}
+
+    def record(self, previous, verdicts):
+        """Replace a sheet's previous verdicts (None if it had none) with its new ones (None if it now has none)."""
+        if previous == verdicts:
+            return
+        with self.lock:
+            stats = self.read()
+            self._count(stats, previous, -1)
+            self._count(stats, verdicts, 1)
+            write_json_atomic(self.path, stats, ensure_ascii=False, indent=1)
+
+    @staticmethod
+    def _count(stats, verdicts, sign):
+        if verdicts is None:
+            return
+        stats['sheets'] += sign
+        for question, verdict in verdicts.items():
+            counts = stats['questions'].setdefault(str(question), {'graded': 0, **dict.fromkeys(VERDICTS, 0)})
+            counts['graded'] += sign
+            if verdict in VERDICTS:
+                counts[verdict] += sign
+
+    def summary(self):
+        """The counts with percent correct, questions in order."""
+        stats = self.read()
+        questions = {}
+        for question in sorted(stats['questions'], key=question_order):
+            counts = stats['questions'][question]
+            graded = counts['graded']
+            questions[question] = {**counts,
+                                   'percent_correct': round(100 * counts['correct'] / graded, 1) if graded else None}
+        return {'sheets': stats['sheets'], 'questions': questions}
+
+    def rebuild(self):
+        """Recount from the result.json files, for a folder graded before the statistics were kept."""
+        stats = {'sheets': 0, 'questions': {}}
+        for _, _, verdicts in iter_sheets(os.path.dirname(self.path)):
+            self._count(stats, verdicts, 1)
+        with self.lock:
+            write_json_atomic(self.path, stats, ensure_ascii=False, indent=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the per-question statistics of an output folder")
+    parser.add_argument('--rebuild', metavar='OUTPUT_FOLDER', required=True)
+    args = parser.parse_args()
+    stats = QuestionStats(args.rebuild)
+    stats.rebuild()
+    print(json.dumps(stats.summary(), ensure_ascii=False, indent=1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# grading_manifest.py
+"""
+Run manifest for incremental grading: what each sheet was last graded from, so a re-run only redoes what changed.
+
+Per sheet it records the hash of the input image, the version (model + prompt hash) of the extraction and comparison
+steps, the extracted answers, and the hash of every answer-key item each verdict was made against. A sheet is
+re-extracted only when its image or the extraction step changed, and re-compared only for the key items that changed,
+so fixing one item of the answer key costs one small comparison call per sheet. Sheets that failed are retried.
+
+The manifest is checkpointed atomically (write to a temporary file, then rename) at most every checkpoint_interval
+seconds and on close(), so an interrupted run resumes from the last checkpoint instead of starting over.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def text_hash(*parts):
+    """Short hash of some strings, used as a version id for a model + prompt or an answer-key item."""
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def write_json_atomic(path, data, **dump_kwargs):
+    """Write data as JSON so that readers (and a crash) only ever see the old file or the complete new one."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def changed_items(entry, key_hashes, compare_version):
+    """Answer-key items whose verdict in entry is missing or was made against a different key item or comparison."""
+    verdicts = entry.get('verdicts')
+    if not isinstance(verdicts, dict) or entry.get('compare_version') != compare_version:
+        return list(key_hashes)
+    previous = entry.get('key_hashes', {})
+    return [q for q, h in key_hashes.items() if q not in verdicts or previous.get(q) != h]
+
+
+class RunManifest:
+    """
+    Thread-safe {sheet id: entry} store backed by a JSON file.
+
+    Args:
+    path (str): manifest file; created on the first checkpoint
+    checkpoint_interval (float): seconds between automatic checkpoints; 0 writes on every update
+    """
+
+    def __init__(self, path, checkpoint_interval=2.0):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.last_checkpoint = time.monotonic()
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f).get('sheets', {})
+            except (ValueError, OSError) as e:
+                # Start over rather than fail the run; the old file is kept for inspection
+                logger.warning(f"Could not read manifest {path}, starting a fresh one: {e}")
+                os.replace(path, path + '.corrupt')
+
+    def get(self, sheet_id):
+        with self.lock:
+            return dict(self.entries.get(sheet_id, {}))
+
+    def update(self, sheet_id, **fields):
+        with self.lock:
+            self.entries.setdefault(sheet_id, {}).update(fields, updated_at=time.time())
+            self.dirty = True
+            if time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+                self._checkpoint()
+
+    def checkpoint(self):
+        with self.lock:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        if self.dirty:
+            write_json_atomic(self.path, {'sheets': self.entries}, ensure_ascii=False, indent=1)
+            self.dirty = False
+        self.last_checkpoint = time.monotonic()
+
+    def close(self):
+        self.checkpoint()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,113 @@
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+HEDGE_STATS_KEY = 'ai_tasks:hedge_stats'
+
+# Attempts run on a shared pool so a hedge can be fired while the primary call is still blocked on the provider.
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge')
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of samples using nearest-rank."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+class LatencyTracker:
+    """Recent provider latencies per model, kept in Redis so all workers share one hedge deadline."""
+
+    def __init__(self, get_client, key_prefix='ai_tasks:latency:', max_samples=200):
+        self.get_client = get_client
+        self.key_prefix = key_prefix
+        self.max_samples = max_samples
+
+    def record(self, model_name, seconds):
+        key = self.key_prefix + model_name
+        try:
+            pipe = self.get_client().pipeline()
+            pipe.lpush(key, f"{seconds:.3f}")
+            pipe.ltrim(key, 0, self.max_samples - 1)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not record latency for {model_name}: {e}")
+
+    def samples(self, model_name):
+        try:
+            return [float(s) for s in self.get_client().lrange(self.key_prefix + model_name, 0, -1)]
+        except Exception as e:
+            logger.warning(f"Could not read latencies for {model_name}: {e}")
+            return []
+
+    def deadline(self, model_name, pct, min_samples, default, minimum):
+        """Seconds to wait for model_name before hedging, i.e. its pct-th percentile latency."""
+        samples = self.samples(model_name)
+        if len(samples) < min_samples:
+            return default
+        return max(minimum, percentile(samples, pct))
+
+
+def hedged_call(primary, hedge, deadline):
+    """
+    Run primary(); if it has not returned within deadline seconds, also run hedge() and use whichever answers first.
+
+    A failed attempt only loses if the other one succeeds. The losing attempt is cancelled if it has not started yet;
+    an attempt already blocked on the provider cannot be interrupted, so its result is simply discarded.
+
+    Returns:
+    tuple: (result, winner, hedged) where winner is 'primary' or 'hedge' and hedged is True if hedge() was fired
+    """
+    # Attempts run in the caller's context so their trace spans nest under the calling task
+    futures = {_executor.submit(contextvars.copy_context().run, primary): 'primary'}
+    done, _ = wait(futures, timeout=deadline)
+    if done:
+        future = done.pop()
+        return future.result(), 'primary', False
+
+    logger.info(f"Primary attempt exceeded hedge deadline of {deadline:.1f}s, firing hedge")
+    futures[_executor.submit(contextvars.copy_context().run, hedge)] = 'hedge'
+    pending = set(futures)
+    first_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                # When both fail, the primary's error is the one reported
+                if first_error is None or futures[future] == 'primary':
+                    first_error = e
+                continue
+            for loser in pending:
+                loser.cancel()
+            return result, futures[future], True
+    raise first_error
+
+
+def record_hedge_stats(client, model_name, hedged, winner):
+    """Count calls, hedges and hedge wins per model in Redis."""
+    try:
+        pipe = client.pipeline()
+        pipe.hincrby(HEDGE_STATS_KEY, f"{model_name}:calls", 1)
+        if hedged:
+            pipe.hincrby(HEDGE_STATS_KEY, f"{model_name}:hedged", 1)
+            pipe.hincrby(HEDGE_STATS_KEY, f"{model_name}:won_{winner}", 1)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not record hedge stats for {model_name}: {e}")
+
+
+def read_hedge_stats(client):
+    """Return {model: {'calls', 'hedged', 'won_primary', 'won_hedge', 'hedge_rate'}} from Redis."""
+    stats = {}
+    for field, value in client.hgetall(HEDGE_STATS_KEY).items():
+        model_name, counter = field.decode().rsplit(':', 1)
+        stats.setdefault(model_name, {'calls': 0, 'hedged': 0, 'won_primary': 0, 'won_hedge': 0})[counter] = int(value)
+    for model_stats in stats.values():
+        model_stats['hedge_rate'] = model_stats['hedged'] / model_stats['calls'] if model_stats['calls'] else 0.0
+    return stats
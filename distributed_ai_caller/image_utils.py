@@ -28,9 +28,35 @@ def preprocess_image(image):
     return result
 
 
+JPEG_QUALITY = 95
+
+
+def encode_jpeg(image, quality=JPEG_QUALITY):
+    # 内存中的图像只编码一次，得到的字节既可直接提交给任务，也可原样写入磁盘
+    ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("图像编码失败")
+    return buffer.tobytes()
+
+
+def bytes_to_base64(data):
+    return base64.b64encode(data).decode('utf-8')
+
+
 def image_to_base64(file_path):
     # 读取图像
-    image = cv2.imread(file_path)
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        print(f"错误：无法读取图像文件 '{file_path}'")
+        return None
+
+    # 已经是JPEG的文件原样编码为base64，避免解码再压缩带来的耗时和画质损失
+    if data[:3] == b'\xff\xd8\xff':
+        return bytes_to_base64(data)
+
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
     if image is None:
         print(f"错误：无法读取图像文件 '{file_path}'")
         return None
@@ -45,8 +71,7 @@ def image_to_base64(file_path):
     # cv2.destroyAllWindows()
 
     # 将处理后的图像编码为 base64
-    _, buffer = cv2.imencode('.jpg', enhanced)
-    return base64.b64encode(buffer).decode('utf-8')
+    return bytes_to_base64(encode_jpeg(enhanced))
 
 
 if __name__ == '__main__':
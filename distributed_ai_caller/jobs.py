@@ -0,0 +1,153 @@
+# jobs.py
+"""
+Grading jobs: named groups of tasks (one exam run, one teacher) that the scheduler interleaves fairly.
+
+/call_ai with a job_id does not enqueue to Celery. It gives the task an id and appends its arguments to the job's
+pending list in Redis; scheduler.py moves pending tasks to the broker in weighted round robin across jobs, keeping
+the broker queue short so that a job submitted later is not stuck behind everything an earlier job enqueued.
+
+Per job, in the hash ai_jobs:job:<id>: weight, quota (most tasks in flight at once, 0 for no limit), budget_usd
+(0 for none; see costs.py), and counters total, dispatched, done and failed. Workers update done/failed from the
+job_id message header when a task finishes.
+"""
+import json
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+JOB_KEY_PREFIX = 'ai_jobs:'
+ACTIVE_JOBS_KEY = JOB_KEY_PREFIX + 'active'
+# Finished jobs are kept this long for /jobs/<id>
+JOB_TTL = 7 * 24 * 3600
+
+
+class JobStore:
+
+    def __init__(self, get_client):
+        self.get_client = get_client
+
+    def _job_key(self, job_id):
+        return f"{JOB_KEY_PREFIX}job:{job_id}"
+
+    def _pending_key(self, job_id):
+        return f"{JOB_KEY_PREFIX}pending:{job_id}"
+
+    def create(self, job_id=None, name='', weight=1.0, quota=0, budget_usd=0):
+        """Create a job, or update the name, weight, quota and budget of an existing one. Returns the job id."""
+        if not float(weight) > 0:
+            raise ValueError(f"Job weight must be positive, got {weight}")
+        job_id = job_id or uuid.uuid4().hex
+        client = self.get_client()
+        pipe = client.pipeline()
+        pipe.hsetnx(self._job_key(job_id), 'created_at', time.time())
+        pipe.hset(self._job_key(job_id), mapping={'name': name, 'weight': float(weight), 'quota': int(quota),
+                                                   'budget_usd': float(budget_usd or 0)})
+        pipe.persist(self._job_key(job_id))
+        pipe.execute()
+        return job_id
+
+    def submit(self, job_id, args):
+        """Queue a call (send_ai_task keyword arguments) under job_id, creating the job if needed; returns its task id."""
+        task_id = str(uuid.uuid4())
+        pipe = self.get_client().pipeline()
+        pipe.hsetnx(self._job_key(job_id), 'created_at', time.time())
+        pipe.hsetnx(self._job_key(job_id), 'weight', 1.0)
+        pipe.hincrby(self._job_key(job_id), 'total', 1)
+        pipe.persist(self._job_key(job_id))
+        item = {'task_id': task_id, 'args': args, 'submitted_at': time.time()}
+        pipe.rpush(self._pending_key(job_id), json.dumps(item))
+        pipe.sadd(ACTIVE_JOBS_KEY, job_id)
+        pipe.execute()
+        return task_id
+
+    def active(self):
+        """{job id: job} for jobs that may have tasks to dispatch, with 'pending' and 'in_flight' counts."""
+        client = self.get_client()
+        job_ids = sorted(j.decode() for j in client.smembers(ACTIVE_JOBS_KEY))
+        pipe = client.pipeline()
+        for job_id in job_ids:
+            pipe.hgetall(self._job_key(job_id))
+            pipe.llen(self._pending_key(job_id))
+        replies = pipe.execute()
+        return {job_id: self._parse(job_id, fields, pending)
+                for job_id, fields, pending in zip(job_ids, replies[::2], replies[1::2])}
+
+    def oldest_submitted_at(self, job_ids):
+        """Submission time of the oldest task still pending in any of job_ids, or None."""
+        pipe = self.get_client().pipeline()
+        for job_id in job_ids:
+            pipe.lindex(self._pending_key(job_id), 0)
+        times = [json.loads(raw).get('submitted_at') for raw in pipe.execute() if raw]
+        return min((t for t in times if t), default=None)
+
+    def pop(self, job_id):
+        """Take the job's next pending task and count it as dispatched; returns (task id, args) or None."""
+        client = self.get_client()
+        raw = client.lpop(self._pending_key(job_id))
+        if raw is None:
+            return None
+        pipe = client.pipeline()
+        pipe.hincrby(self._job_key(job_id), 'dispatched', 1)
+        pipe.hsetnx(self._job_key(job_id), 'started_at', time.time())
+        pipe.execute()
+        item = json.loads(raw)
+        return item['task_id'], item['args']
+
+    def retire(self, job_id):
+        """Drop a job with nothing pending or in flight from the active set; its record expires after JOB_TTL."""
+        client = self.get_client()
+        pipe = client.pipeline()
+        pipe.srem(ACTIVE_JOBS_KEY, job_id)
+        pipe.llen(self._pending_key(job_id))
+        _, pending = pipe.execute()
+        if pending:
+            # A task was submitted since the job was read; submit() pushes and re-adds atomically, so put it back
+            client.sadd(ACTIVE_JOBS_KEY, job_id)
+        else:
+            client.expire(self._job_key(job_id), JOB_TTL)
+
+    def record_finished(self, job_id, succeeded):
+        try:
+            pipe = self.get_client().pipeline()
+            pipe.hincrby(self._job_key(job_id), 'done' if succeeded else 'failed', 1)
+            pipe.hset(self._job_key(job_id), 'last_finished_at', time.time())
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not record progress of job {job_id}: {e}")
+
+    def get(self, job_id):
+        """The job with progress and ETA, or None if there is no such job."""
+        client = self.get_client()
+        pipe = client.pipeline()
+        pipe.hgetall(self._job_key(job_id))
+        pipe.llen(self._pending_key(job_id))
+        fields, pending = pipe.execute()
+        return self._parse(job_id, fields, pending) if fields else None
+
+    def _parse(self, job_id, fields, pending):
+        fields = {k.decode(): v.decode() for k, v in fields.items()}
+        total, dispatched = int(fields.get('total', 0)), int(fields.get('dispatched', 0))
+        done, failed = int(fields.get('done', 0)), int(fields.get('failed', 0))
+        finished = done + failed
+        job = {
+            'job_id': job_id,
+            'name': fields.get('name', ''),
+            'weight': float(fields.get('weight', 1.0)),
+            'quota': int(fields.get('quota', 0)),
+            'budget_usd': float(fields.get('budget_usd', 0)) or None,
+            'total': total,
+            'pending': pending,
+            'in_flight': max(0, dispatched - finished),
+            'done': done,
+            'failed': failed,
+            'progress': finished / total if total else 0.0,
+            'eta_seconds': None,
+        }
+        # ETA from the job's own completion rate since its first dispatch
+        started_at, last_finished_at = fields.get('started_at'), fields.get('last_finished_at')
+        if finished and started_at and last_finished_at and float(last_finished_at) > float(started_at):
+            rate = finished / (float(last_finished_at) - float(started_at))
+            job['eta_seconds'] = round((total - finished) / rate, 1)
+        return job
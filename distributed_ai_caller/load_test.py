@@ -0,0 +1,248 @@
+# load_test.py
+"""
+Throughput benchmark for the gateway and workers, run against the local mock provider.
+
+Starts mock_provider.py, master.py and real Celery workers over the local Redis, drives /call_ai + /get_result with
+concurrent clients and reports throughput, latency percentiles and resource usage for each pool type and worker
+count. Results are written as JSON so runs can be compared:
+
+    python load_test.py --pools solo,prefork --workers 1,4 --requests 400 --output before.json
+    python load_test.py --pools solo,prefork --workers 1,4 --requests 400 --compare before.json
+
+Each scenario starts from an empty Celery queue, so the harness deletes the queue and the unacked tasks in the Redis
+it runs against. Give it a database of its own (--redis-url redis://localhost:6379/15); a Redis that is not on this
+machine is only cleared with --purge.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import redis
+import requests
+
+from celery_app import REDIS_URL
+from hedging import percentile
+from mock_provider import MockConfig, start_mock_provider
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+
+def wait_for(check, timeout=30, interval=0.2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except Exception:
+            pass
+        time.sleep(interval)
+    raise TimeoutError("服务启动超时")
+
+
+def start_gateway(port, env, kind='flask', workers=1):
+    if kind == 'asgi':
+        command = [sys.executable, 'gateway.py', '--port', str(port), '--workers', str(workers)]
+    else:
+        command = [sys.executable, '-c', f"import master; master.app.run(port={port}, threaded=True)"]
+    process = subprocess.Popen(command, cwd=SCRIPT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # An unknown task id reads as pending, so any non-error answer means the gateway is up
+    wait_for(lambda: requests.get(f"http://localhost:{port}/get_result/warmup", timeout=1).status_code < 500)
+    return process
+
+
+def start_workers(count, pool, concurrency, env):
+    processes = []
+    for i in range(count):
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'celery', '-A', 'celery_config', 'worker', '--loglevel=warning',
+             '-P', pool, '-c', str(concurrency), '-n', f"bench{i}-{pool}@%h", '--without-gossip', '--without-mingle'],
+            cwd=SCRIPT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    return processes
+
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def run_request(gateway, payload, poll_interval, timeout):
+    """Submit one task and poll until it finishes; returns (latency, outcome)."""
+    start = time.monotonic()
+    response = requests.post(f"{gateway}/call_ai", json=payload, timeout=10)
+    response.raise_for_status()
+    task_id = response.json()["task_id"]
+    while time.monotonic() - start < timeout:
+        result = requests.get(f"{gateway}/get_result/{task_id}", timeout=10)
+        body = result.json()
+        if body["status"] == "completed":
+            return time.monotonic() - start, 'ok'
+        if body["status"] == "error":
+            return time.monotonic() - start, 'error'
+        time.sleep(poll_interval)
+    return time.monotonic() - start, 'timeout'
+
+
+def run_load(gateway, payload, total, clients, poll_interval, timeout):
+    results = []
+    lock = threading.Lock()
+
+    def one(_):
+        try:
+            outcome = run_request(gateway, payload, poll_interval, timeout)
+        except requests.RequestException:
+            outcome = (0.0, 'gateway_error')
+        with lock:
+            results.append(outcome)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(one, range(total)))
+    return results, time.monotonic() - start
+
+
+def summarize(results, elapsed):
+    latencies = [latency for latency, outcome in results if outcome == 'ok']
+    outcomes = {}
+    for _, outcome in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return {
+        'requests': len(results),
+        'outcomes': outcomes,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        'p50': round(percentile(latencies, 50) or 0.0, 3),
+        'p95': round(percentile(latencies, 95) or 0.0, 3),
+        'p99': round(percentile(latencies, 99) or 0.0, 3),
+    }
+
+
+def children_usage():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is the largest single child, in KiB on Linux
+    return {'cpu_user': usage.ru_utime, 'cpu_system': usage.ru_stime, 'max_rss_mb': usage.ru_maxrss / 1024}
+
+
+def run_scenario(args, pool, workers, env, mock_port):
+    redis_client = redis.Redis.from_url(args.redis_url)
+    redis_client.delete('celery', 'unacked', 'unacked_index')
+    requests.post(f"http://localhost:{mock_port}/stats/reset", timeout=5)
+
+    before = children_usage()
+    worker_processes = start_workers(workers, pool, args.concurrency, env)
+    try:
+        payload = {"model_name": args.model, "system_prompt": "You are a grader.", "user_request": "Grade this.",
+                   "image_paths": [os.path.abspath(args.image)] if args.image else None, "hedge": args.hedge}
+        # Warm up so worker start-up is not counted in the measurement
+        run_load(args.gateway_url, payload, workers, workers, args.poll_interval, args.timeout)
+        results, elapsed = run_load(args.gateway_url, payload, args.requests, args.clients, args.poll_interval,
+                                    args.timeout)
+    finally:
+        stop(worker_processes)
+    after = children_usage()
+
+    summary = summarize(results, elapsed)
+    summary.update({
+        'pool': pool,
+        'workers': workers,
+        'concurrency': args.concurrency,
+        'cpu_seconds': round((after['cpu_user'] - before['cpu_user']) + (after['cpu_system'] - before['cpu_system']),
+                             3),
+        'max_rss_mb': round(after['max_rss_mb'], 1),
+        'provider': requests.get(f"http://localhost:{mock_port}/stats", timeout=5).json(),
+    })
+    return summary
+
+
+def print_table(scenarios, baseline=None):
+    baseline = {(s['pool'], s['workers']): s for s in baseline or []}
+    print(f"{'pool':<10}{'workers':>8}{'req/s':>10}{'p50':>8}{'p95':>8}{'p99':>8}{'errors':>8}{'cpu s':>8}"
+          f"{'rss MB':>8}")
+    for s in scenarios:
+        errors = s['requests'] - s['outcomes'].get('ok', 0)
+        print(f"{s['pool']:<10}{s['workers']:>8}{s['throughput']:>10.2f}{s['p50']:>8.2f}{s['p95']:>8.2f}"
+              f"{s['p99']:>8.2f}{errors:>8}{s['cpu_seconds']:>8.1f}{s['max_rss_mb']:>8.0f}")
+        previous = baseline.get((s['pool'], s['workers']))
+        if previous:
+            change = (s['throughput'] - previous['throughput']) / previous['throughput'] * 100 \
+                if previous['throughput'] else 0.0
+            print(f"{'':<18}vs baseline: req/s {change:+.1f}%, p95 {s['p95'] - previous['p95']:+.2f}s, "
+                  f"p99 {s['p99'] - previous['p99']:+.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test master.py and Celery workers against a mock provider")
+    parser.add_argument('--pools', default='solo,prefork,threads', help="comma-separated Celery pool types")
+    parser.add_argument('--workers', default='1,2,4', help="comma-separated worker process counts")
+    parser.add_argument('--concurrency', type=int, default=4, help="-c for prefork/threads pools")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=32, help="concurrent client threads")
+    parser.add_argument('--model', default='claude-3-haiku-20240307')
+    parser.add_argument('--image', help="optional image to send with every request")
+    parser.add_argument('--hedge', action='store_true', help="leave hedging enabled")
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--gateway', default='flask', choices=['flask', 'asgi'],
+                        help="master.py dev server or gateway.py under uvicorn")
+    parser.add_argument('--gateway-workers', type=int, default=1, help="uvicorn worker processes for --gateway asgi")
+    parser.add_argument('--gateway-port', type=int, default=5055)
+    parser.add_argument('--mock-port', type=int, default=8400)
+    parser.add_argument('--redis-url', default=REDIS_URL,
+                        help="Redis for the gateway and workers; its Celery queue is cleared before each scenario")
+    parser.add_argument('--purge', action='store_true', help="allow clearing the queue of a Redis on another host")
+    parser.add_argument('--latency-median', type=float, default=0.5)
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--output', help="write results as JSON")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+    if urlparse(args.redis_url).hostname not in LOCAL_HOSTS and not args.purge:
+        parser.error(f"{args.redis_url} is not a local Redis and its queued tasks would be deleted; "
+                     f"use a database of your own or pass --purge")
+
+    mock = start_mock_provider(args.mock_port, MockConfig(args.latency_median, args.latency_sigma, args.error_rate,
+                                                          args.rate_limit_rate))
+    env = dict(os.environ,
+               REDIS_URL=args.redis_url,
+               OPENAI_BASE_URL=f"http://localhost:{args.mock_port}/v1",
+               ANTHROPIC_BASE_URL=f"http://localhost:{args.mock_port}")
+    gateway = start_gateway(args.gateway_port, env, args.gateway, args.gateway_workers)
+    args.gateway_url = f"http://localhost:{args.gateway_port}"
+
+    scenarios = []
+    try:
+        for pool in args.pools.split(','):
+            for workers in (int(w) for w in args.workers.split(',')):
+                print(f"Running {args.requests} requests: pool={pool} workers={workers}")
+                scenarios.append(run_scenario(args, pool, workers, env, args.mock_port))
+    finally:
+        stop([gateway])
+        mock.shutdown()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['scenarios']
+    print_table(scenarios, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'gateway_url')},
+                       'scenarios': scenarios}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
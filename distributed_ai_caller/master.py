@@ -1,11 +1,38 @@
 # master.py
-from flask import Flask, request, jsonify
-from celery_config import call_ai_api, call_ai_api_img
+import time
+import redis
+from flask import Flask, Response, g, request, jsonify, stream_with_context
+from celery_app import app as celery_app, breaker, jobs, ledger, metrics, send_ai_task
 from celery.result import AsyncResult
+from autoscaler import DESIRED_WORKERS_KEY
+from hedging import read_hedge_stats
+from token_stream import format_sse, read_events
+import tracing
 import logging
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
+
+# Results can hold whole model replies; only this much of one is logged
+LOG_RESULT_CHARS = 200
+
+broker_client = redis.Redis.from_url(celery_app.conf.broker_url)
+MONITORED_QUEUES = [celery_app.conf.task_default_queue]
+PROVIDERS = ['openai', 'anthropic']
+CIRCUIT_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.monotonic()
+
+
+@app.after_request
+def observe_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('ai_gateway_requests_total', {'endpoint': endpoint, 'status': response.status_code})
+    metrics.observe('ai_gateway_latency_seconds', time.monotonic() - g.request_start, {'endpoint': endpoint})
+    return response
 
 
 @app.route('/call_ai', methods=['POST'])
@@ -15,40 +42,151 @@ def call_ai():
     system_prompt = data.get('system_prompt')
     user_request = data.get('user_request')
     image_paths = data.get('image_paths')
+    images = data.get('images')
+    hedge = data.get('hedge', True)
+    stream = data.get('stream', False)
+    job_id = data.get('job_id')
     app.logger.info(f"Received request for model: {model_name}")
 
-    if image_paths:
-        app.logger.info(f"Received image paths: {image_paths}")
-        task = call_ai_api_img.delay(model_name, system_prompt, user_request, image_paths)
-    else:
-        task = call_ai_api.delay(model_name, system_prompt, user_request)
+    # The enqueue span's trace id travels with the task, continuing the caller's trace if it sent a traceparent
+    trace_id, parent_id = tracing.parse_traceparent(request.headers.get('traceparent'))
+    enqueue_span = tracing.start_span('gateway.call_ai', trace_id=trace_id, parent_id=parent_id, model=model_name)
+    token = tracing.activate(enqueue_span)
+    try:
+        if image_paths:
+            app.logger.info(f"Received {len(image_paths)} image paths")
+        if images:
+            app.logger.info(f"Received {len(images)} inline images")
+        if job_id:
+            # Part of a job: queued for scheduler.py to dispatch in fair shares with other jobs
+            task_id = jobs.submit(job_id, {'model_name': model_name, 'system_prompt': system_prompt,
+                                           'user_request': user_request, 'image_paths': image_paths,
+                                           'hedge': hedge, 'stream': stream, 'images': images})
+        else:
+            task_id = send_ai_task(model_name, system_prompt, user_request, image_paths, hedge, stream, images).id
+    finally:
+        tracing.deactivate(token)
+        enqueue_span.finish()
+
+    app.logger.info(f"Task created with id: {task_id}")
+    response = {"task_id": task_id, "trace_id": enqueue_span.trace_id}
+    if job_id:
+        response["job_id"] = job_id
+    if stream:
+        response["stream_url"] = f"/stream/{task_id}"
+    return jsonify(response), 202
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request.json or {}
+    try:
+        weight = float(data.get('weight', 1.0))
+        quota = int(data.get('quota', 0))
+        budget_usd = float(data.get('budget_usd') or 0)
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "weight, quota and budget_usd must be numbers"}), 400
+    if weight <= 0 or quota < 0 or budget_usd < 0:
+        return jsonify({"status": "error",
+                        "message": "weight must be positive, quota and budget_usd not negative"}), 400
+    job_id = jobs.create(data.get('job_id'), data.get('name', ''), weight, quota, budget_usd)
+    app.logger.info(f"Job {job_id} created with weight {weight}, quota {quota} and budget {budget_usd or 'none'}")
+    return jsonify(jobs.get(job_id)), 201
+
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify(list(jobs.active().values()))
 
-    app.logger.info(f"Task created with id: {task.id}")
-    return jsonify({"task_id": task.id}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify({**job, 'cost': ledger.job(job_id)})
+
+
+@app.route('/costs', methods=['GET'])
+def costs_by_day():
+    """Tokens and estimated spend per model for ?date=YYYY-MM-DD (default today), with the daily budget."""
+    return jsonify(ledger.day(request.args.get('date')))
+
+
+@app.route('/budget', methods=['POST'])
+def set_budget():
+    """Set the daily budget (USD) shared by all jobs; 0 or null removes it. Calls without a job_id are not limited."""
+    data = request.json or {}
+    try:
+        daily_usd = float(data.get('daily_usd') or 0)
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "daily_usd must be a number"}), 400
+    if daily_usd < 0:
+        return jsonify({"status": "error", "message": "daily_usd must not be negative"}), 400
+    ledger.set_daily_budget(daily_usd)
+    app.logger.info(f"Daily budget set to {daily_usd or 'none'}")
+    return jsonify(ledger.day())
 
 
 @app.route('/get_result/<task_id>', methods=['GET'])
 def get_result(task_id):
     app.logger.info(f"Checking result for task: {task_id}")
-    # Try both task types
-    task = AsyncResult(task_id, app=call_ai_api.app)
-    if not task.ready():
-        task = AsyncResult(task_id, app=call_ai_api_img.app)
+    task = AsyncResult(task_id, app=celery_app)
 
     if task.ready():
         app.logger.info(f"Task {task_id} is ready")
         if task.successful():
             result = task.result
-            app.logger.info(f"Task {task_id} completed successfully: {result}")
+            app.logger.info(f"Task {task_id} completed successfully: {str(result)[:LOG_RESULT_CHARS]}")
             return jsonify({"status": "completed", "result": result})
         else:
-            error = str(task.result)
-            app.logger.error(f"Task {task_id} failed: {error}")
-            return jsonify({"status": "error", "message": error}), 500
+            error = task.result
+            app.logger.error(f"Task {task_id} failed: {str(error)[:LOG_RESULT_CHARS]}")
+            return jsonify({"status": "error", "message": str(error),
+                            "type": getattr(error, 'error_type', type(error).__name__)}), 500
     else:
         app.logger.info(f"Task {task_id} is still pending")
         return jsonify({"status": "pending"}), 202
 
 
+@app.route('/stream/<task_id>', methods=['GET'])
+def stream_result(task_id):
+    """Relay a streaming task's tokens as Server-Sent Events, ending with a 'done' or 'error' event."""
+    last_id = request.headers.get('Last-Event-ID', '0')
+    client = celery_app.backend.client
+
+    def events():
+        for entry_id, event, data in read_events(client, task_id, last_id):
+            yield format_sse(entry_id, event, data)
+
+    app.logger.info(f"Streaming result for task: {task_id}")
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    gauges = [
+        ('ai_queue_depth', 'Tasks waiting in each broker queue.',
+         [({'queue': queue}, broker_client.llen(queue)) for queue in MONITORED_QUEUES]),
+        # With task_acks_late a task stays in the broker's unacked hash until it finishes, so this is what's in flight
+        ('ai_tasks_in_flight', 'Tasks reserved by workers and not yet acknowledged.',
+         [({}, broker_client.hlen('unacked'))]),
+        ('ai_circuit_state', 'Provider circuit breaker state: 0 closed, 1 half-open, 2 open.',
+         [({'provider': provider}, CIRCUIT_STATES[breaker.state(provider)]) for provider in PROVIDERS]),
+    ]
+    desired = celery_app.backend.client.get(DESIRED_WORKERS_KEY)
+    if desired is not None:
+        # Published by autoscaler.py, for an orchestrator that scales workers on a metric
+        gauges.append(('ai_workers_desired', 'Worker count the autoscaler asks for.', [({}, int(desired))]))
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/hedge_stats', methods=['GET'])
+def hedge_stats():
+    return jsonify(read_hedge_stats(celery_app.backend.client))
+
+
 if __name__ == '__main__':
+    # Development server only; use gateway.py to serve /call_ai, /get_result and /stream in production
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
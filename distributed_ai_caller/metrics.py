@@ -0,0 +1,106 @@
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY_PREFIX = 'ai_metrics:'
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, math.inf)
+BYTES_BUCKETS = (10e3, 50e3, 100e3, 250e3, 500e3, 1e6, 2.5e6, 5e6, math.inf)
+
+# name: (type, help, buckets)
+METRICS = {
+    'ai_task_latency_seconds': ('histogram', 'Task latency by stage: queue_wait, provider or total.', LATENCY_BUCKETS),
+    'ai_tasks_total': ('counter', 'Tasks finished, by task and status.', None),
+    'ai_provider_requests_total': ('counter', 'Provider API calls, by outcome.', None),
+    'ai_provider_errors_total': ('counter', 'Provider API errors, by exception type and HTTP status.', None),
+    'ai_tokens_total': ('counter', 'Tokens reported by the provider, by direction (input/output).', None),
+    'ai_cost_usd_total': ('counter', 'Estimated provider spend in USD, from token usage and MODEL_PRICES.', None),
+    'ai_image_payload_bytes': ('histogram', 'Size of each image sent to a provider.', BYTES_BUCKETS),
+    'ai_gateway_requests_total': ('counter', 'Gateway HTTP requests, by endpoint and status code.', None),
+    'ai_gateway_latency_seconds': ('histogram', 'Gateway HTTP request handling time.', LATENCY_BUCKETS),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped))
+
+
+def series(name, labels):
+    return f"{name}{{{labels}}}" if labels else name
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metrics:
+    """
+    Counters and histograms stored in Redis hashes.
+
+    Every worker process writes to the same hashes, so the gateway can render the totals for the whole cluster
+    without each worker exposing its own endpoint.
+    """
+
+    def __init__(self, get_client):
+        self.get_client = get_client
+
+    def inc(self, name, labels=None, amount=1):
+        self._write(lambda pipe: pipe.hincrbyfloat(METRICS_KEY_PREFIX + name, format_labels(labels), amount))
+
+    def observe(self, name, value, labels=None):
+        buckets = METRICS[name][2]
+        bucket = next(b for b in buckets if value <= b)
+        label_str = format_labels(labels)
+        key = METRICS_KEY_PREFIX + name
+
+        def write(pipe):
+            pipe.hincrby(key, f"{label_str}|{format_value(bucket)}", 1)
+            pipe.hincrbyfloat(key, f"{label_str}|sum", value)
+        self._write(write)
+
+    def _write(self, write):
+        try:
+            pipe = self.get_client().pipeline(transaction=False)
+            write(pipe)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not record metric: {e}")
+
+    def render(self, gauges=()):
+        """
+        Return every metric in Prometheus text format.
+
+        Args:
+        gauges (iterable): (name, help, [(labels, value), ...]) tuples computed at scrape time
+        """
+        client = self.get_client()
+        lines = []
+        for name, samples_help, samples in gauges:
+            lines += [f"# HELP {name} {samples_help}", f"# TYPE {name} gauge"]
+            lines += [f"{series(name, format_labels(labels))} {format_value(value)}" for labels, value in samples]
+
+        for name, (metric_type, metric_help, buckets) in METRICS.items():
+            fields = {k.decode(): float(v) for k, v in client.hgetall(METRICS_KEY_PREFIX + name).items()}
+            lines += [f"# HELP {name} {metric_help}", f"# TYPE {name} {metric_type}"]
+            if metric_type == 'counter':
+                lines += [f"{series(name, labels)} {format_value(value)}" for labels, value in sorted(fields.items())]
+                continue
+
+            by_labels = {}
+            for field, value in fields.items():
+                labels, part = field.rsplit('|', 1)
+                by_labels.setdefault(labels, {})[part] = value
+            for labels, parts in sorted(by_labels.items()):
+                prefix = labels + ',' if labels else ''
+                cumulative = 0
+                for bucket in buckets:
+                    cumulative += parts.get(format_value(bucket), 0)
+                    lines.append(f'{name}_bucket{{{prefix}le="{format_value(bucket)}"}} {format_value(cumulative)}')
+                lines.append(f"{series(name + '_sum', labels)} {format_value(parts.get('sum', 0))}")
+                lines.append(f"{series(name + '_count', labels)} {format_value(cumulative)}")
+        return '\n'.join(lines) + '\n'
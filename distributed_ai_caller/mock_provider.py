@@ -0,0 +1,249 @@
+# mock_provider.py
+"""
+Local stand-in for the OpenAI and Anthropic APIs, for load testing without paying for (or being limited by) real calls.
+
+Workers are pointed at it through the SDKs' own environment variables:
+    OPENAI_BASE_URL=http://localhost:8400/v1 ANTHROPIC_BASE_URL=http://localhost:8400 python worker.py
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPLY = json.dumps({str(i): "correct" for i in range(1, 13)}, indent=4)
+
+
+class MockConfig:
+    def __init__(self, latency_median=1.0, latency_sigma=0.5, error_rate=0.0, rate_limit_rate=0.0,
+                 tokens_per_second=200.0, reply=DEFAULT_REPLY):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.tokens_per_second = tokens_per_second
+        self.reply = reply
+
+    def sample_latency(self):
+        """Lognormal latency, which reproduces the long tail seen from the real providers."""
+        if self.latency_sigma <= 0:
+            return self.latency_median
+        return random.lognormvariate(0, self.latency_sigma) * self.latency_median
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.by_model = {}
+
+    def record(self, model, outcome, input_tokens=0, output_tokens=0, image_bytes=0):
+        with self.lock:
+            stats = self.by_model.setdefault(model, {'requests': 0, 'ok': 0, 'error': 0, 'rate_limited': 0,
+                                                     'input_tokens': 0, 'output_tokens': 0, 'image_bytes': 0})
+            stats['requests'] += 1
+            stats[outcome] += 1
+            stats['input_tokens'] += input_tokens
+            stats['output_tokens'] += output_tokens
+            stats['image_bytes'] += image_bytes
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.by_model))
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def count_content(content):
+    """Return (text_tokens, image_bytes) for an OpenAI or Anthropic message content field."""
+    if isinstance(content, str):
+        return estimate_tokens(content), 0
+    tokens, image_bytes = 0, 0
+    for part in content or []:
+        if part.get('type') == 'text':
+            tokens += estimate_tokens(part['text'])
+        elif part.get('type') == 'image_url':
+            image_bytes += len(part['image_url']['url'].split(',', 1)[-1]) * 3 // 4
+        elif part.get('type') == 'image':
+            image_bytes += len(part['source']['data']) * 3 // 4
+    return tokens, image_bytes
+
+
+def image_tokens(image_bytes):
+    # Roughly what a JPEG column crop of that size costs at the providers' pixel-based image pricing
+    return image_bytes // 100
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    config = MockConfig()
+    stats = MockStats()
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send_json(200, self.stats.snapshot())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path.rstrip('/').endswith('/chat/completions'):
+            provider = 'openai'
+        elif self.path.rstrip('/').endswith('/messages'):
+            provider = 'anthropic'
+        elif self.path == '/stats/reset':
+            self.stats.reset()
+            return self._send_json(200, {})
+        else:
+            return self._send_json(404, {'error': 'not found'})
+
+        model = body.get('model', 'unknown')
+        text_tokens, image_bytes = 0, 0
+        for message in body.get('messages', []):
+            tokens, size = count_content(message.get('content'))
+            text_tokens += tokens
+            image_bytes += size
+        if body.get('system'):
+            text_tokens += estimate_tokens(body['system'])
+        input_tokens = text_tokens + image_tokens(image_bytes)
+
+        roll = random.random()
+        if roll < self.config.rate_limit_rate:
+            self.stats.record(model, 'rate_limited', image_bytes=image_bytes)
+            return self._send_error(provider, 429, 'rate_limit_error', 'Mock rate limit', {'retry-after': '1'})
+        if roll < self.config.rate_limit_rate + self.config.error_rate:
+            time.sleep(self.config.sample_latency() / 2)
+            self.stats.record(model, 'error', image_bytes=image_bytes)
+            return self._send_error(provider, 500, 'api_error', 'Mock internal error')
+
+        reply = self.config.reply
+        output_tokens = estimate_tokens(reply)
+        self.stats.record(model, 'ok', input_tokens, output_tokens, image_bytes)
+        if body.get('stream'):
+            return self._stream(provider, model, reply, input_tokens, output_tokens)
+
+        time.sleep(self.config.sample_latency())
+        if provider == 'openai':
+            self._send_json(200, {
+                'id': f"chatcmpl-{uuid.uuid4().hex}", 'object': 'chat.completion', 'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': reply}}],
+                'usage': {'prompt_tokens': input_tokens, 'completion_tokens': output_tokens,
+                          'total_tokens': input_tokens + output_tokens},
+            })
+        else:
+            self._send_json(200, {
+                'id': f"msg_{uuid.uuid4().hex}", 'type': 'message', 'role': 'assistant', 'model': model,
+                'content': [{'type': 'text', 'text': reply}], 'stop_reason': 'end_turn', 'stop_sequence': None,
+                'usage': {'input_tokens': input_tokens, 'output_tokens': output_tokens},
+            })
+
+    def _stream(self, provider, model, reply, input_tokens, output_tokens):
+        """Send the reply as SSE chunks, the first after the sampled latency and the rest at tokens_per_second."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        chunks = [reply[i:i + 4] for i in range(0, len(reply), 4)]
+        message_id = uuid.uuid4().hex
+
+        def send(event, data):
+            prefix = f"event: {event}\n" if event else ''
+            self.wfile.write(f"{prefix}data: {json.dumps(data) if not isinstance(data, str) else data}\n\n".encode())
+            self.wfile.flush()
+
+        time.sleep(self.config.sample_latency())
+        if provider == 'openai':
+            base = {'id': f"chatcmpl-{message_id}", 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                    'model': model}
+            for chunk in chunks:
+                send(None, {**base, 'choices': [{'index': 0, 'delta': {'content': chunk}, 'finish_reason': None}]})
+                time.sleep(1 / self.config.tokens_per_second)
+            send(None, {**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+            send(None, {**base, 'choices': [], 'usage': {'prompt_tokens': input_tokens,
+                                                         'completion_tokens': output_tokens,
+                                                         'total_tokens': input_tokens + output_tokens}})
+            send(None, '[DONE]')
+            return
+
+        send('message_start', {'type': 'message_start', 'message': {
+            'id': f"msg_{message_id}", 'type': 'message', 'role': 'assistant', 'model': model, 'content': [],
+            'stop_reason': None, 'stop_sequence': None, 'usage': {'input_tokens': input_tokens, 'output_tokens': 0}}})
+        send('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                     'content_block': {'type': 'text', 'text': ''}})
+        for chunk in chunks:
+            send('content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                         'delta': {'type': 'text_delta', 'text': chunk}})
+            time.sleep(1 / self.config.tokens_per_second)
+        send('content_block_stop', {'type': 'content_block_stop', 'index': 0})
+        send('message_delta', {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                               'usage': {'output_tokens': output_tokens}})
+        send('message_stop', {'type': 'message_stop'})
+
+    def _send_error(self, provider, status, error_type, message, headers=None):
+        if provider == 'openai':
+            body = {'error': {'message': message, 'type': error_type, 'code': None}}
+        else:
+            body = {'type': 'error', 'error': {'type': error_type, 'message': message}}
+        self._send_json(status, body, headers)
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_mock_provider(port=8400, config=None):
+    """Serve the mock provider on a background thread; returns the server (call shutdown() to stop it)."""
+    handler = type('ConfiguredHandler', (MockProviderHandler,), {'config': config or MockConfig(),
+                                                                 'stats': MockStats()})
+    server = ThreadingHTTPServer(('0.0.0.0', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='mock-provider').start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI/Anthropic server for load tests")
+    parser.add_argument('--port', type=int, default=8400)
+    parser.add_argument('--latency-median', type=float, default=1.0, help="median response latency in seconds")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="lognormal sigma; 0 for fixed latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls answered with HTTP 500")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument('--tokens-per-second', type=float, default=200.0, help="pace of streamed chunks")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    config = MockConfig(args.latency_median, args.latency_sigma, args.error_rate, args.rate_limit_rate,
+                        args.tokens_per_second)
+    server = start_mock_provider(args.port, config)
+    logger.info(f"Mock provider listening on port {args.port}; stats at http://localhost:{args.port}/stats")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
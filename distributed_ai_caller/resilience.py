@@ -0,0 +1,134 @@
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a provider whose circuit breaker is open.
+
+    The args are the constructor's own, so the result backend rebuilds the same exception rather than one whose
+    provider is the formatted message.
+    """
+
+    def __init__(self, provider, retry_in=None):
+        super().__init__(provider, retry_in)
+        self.provider = provider
+        self.retry_in = retry_in
+
+    def __str__(self):
+        return f"Circuit breaker open for {self.provider}"
+
+
+class ProviderError(Exception):
+    """
+    A provider call that failed for good, recorded by the SDK exception's type name, message and HTTP status.
+
+    The SDK exceptions cannot be rebuilt from their args, so the result backend would otherwise keep only their base
+    class (e.g. OpenAIError instead of RateLimitError).
+    """
+
+    def __init__(self, error_type, message, status_code=None):
+        super().__init__(error_type, message, status_code)
+        self.error_type = error_type
+        self.message = message
+        self.status_code = status_code
+
+    def __str__(self):
+        return f"{self.error_type}: {self.message}"
+
+
+def backoff_delay(retries, base=2.0, cap=120.0, minimum=0.0):
+    """
+    Seconds to wait before retry number retries + 1: exponential backoff with full jitter.
+
+    Full jitter (a uniform draw up to the exponential bound) spreads out the retries of tasks that failed together,
+    so they do not hit the provider again in lockstep. minimum is a floor such as a Retry-After value.
+    """
+    return max(minimum, random.uniform(0, min(cap, base * 2 ** retries)))
+
+
+class CircuitBreaker:
+    """
+    Per-provider circuit breaker kept in Redis so every worker sees the same state.
+
+    Closed: calls go through, and consecutive transient failures are counted across all workers. Once failure_threshold
+    of them happen without a success in between, the breaker opens for cooldown seconds and calls fail fast. After the
+    cooldown it is half-open: one probe call at a time is let through, and its outcome closes or reopens the breaker.
+    """
+
+    def __init__(self, get_client, key_prefix='ai_tasks:breaker:', failure_threshold=5, failure_window=60.0,
+                 cooldown=30.0, probe_timeout=30.0):
+        self.get_client = get_client
+        self.key_prefix = key_prefix
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+
+    def _keys(self, provider):
+        prefix = self.key_prefix + provider
+        return prefix + ':failures', prefix + ':open', prefix + ':tripped', prefix + ':probe'
+
+    def state(self, provider):
+        """'closed', 'open' or 'half_open'."""
+        _, open_key, tripped_key, _ = self._keys(provider)
+        try:
+            is_open, tripped = self.get_client().mget(open_key, tripped_key)
+        except Exception as e:
+            logger.warning(f"Could not read circuit breaker for {provider}: {e}")
+            return 'closed'
+        if is_open:
+            return 'open'
+        return 'half_open' if tripped else 'closed'
+
+    def allow(self, provider):
+        """Return True if a call to provider may go ahead; in the half-open state only one probe at a time may."""
+        state = self.state(provider)
+        if state == 'closed':
+            return True
+        if state == 'open':
+            return False
+        probe_key = self._keys(provider)[3]
+        try:
+            return bool(self.get_client().set(probe_key, 1, nx=True, px=int(self.probe_timeout * 1000)))
+        except Exception as e:
+            logger.warning(f"Could not claim circuit breaker probe for {provider}: {e}")
+            return True
+
+    def retry_in(self, provider):
+        """Seconds until an open breaker goes half-open, or 0."""
+        try:
+            return max(0, self.get_client().pttl(self._keys(provider)[1])) / 1000
+        except Exception:
+            return 0
+
+    def record_success(self, provider):
+        try:
+            failures_key, _, tripped_key, probe_key = self._keys(provider)
+            self.get_client().delete(failures_key, tripped_key, probe_key)
+        except Exception as e:
+            logger.warning(f"Could not reset circuit breaker for {provider}: {e}")
+
+    def record_failure(self, provider):
+        failures_key, open_key, tripped_key, probe_key = self._keys(provider)
+        try:
+            client = self.get_client()
+            pipe = client.pipeline()
+            pipe.incr(failures_key)
+            pipe.pexpire(failures_key, int(self.failure_window * 1000))
+            pipe.exists(tripped_key)
+            failures, _, tripped = pipe.execute()
+            # A failed probe reopens straight away; otherwise the breaker opens once the threshold is reached
+            if tripped or failures >= self.failure_threshold:
+                pipe = client.pipeline()
+                pipe.set(open_key, time.time(), px=int(self.cooldown * 1000))
+                pipe.set(tripped_key, 1)
+                pipe.delete(failures_key, probe_key)
+                pipe.execute()
+                logger.warning(f"Circuit breaker for {provider} opened for {self.cooldown:.0f}s "
+                               f"after {failures} failures")
+        except Exception as e:
+            logger.warning(f"Could not record failure for {provider}: {e}")
@@ -0,0 +1,126 @@
+# scheduler.py
+"""
+Fair-share dispatcher for grading jobs: moves tasks from the jobs' pending lists to the Celery broker.
+
+Celery drains its queue first in, first out, so whoever enqueues first owns the workers until their run is done. The
+scheduler keeps the broker queue short (max_queued tasks) and refills it with weighted deficit round robin over the
+active jobs: each round a job earns its weight in credit and dispatches one task per whole credit, never more than
+its quota in flight. Two jobs of weight 1 alternate task by task, so a small job finishes in about twice the time
+it would take alone however large the other one is.
+
+Jobs near their budget (their own or the day's, see costs.py) are dispatched one task at a time, then on a cheaper
+model, then paused; calls sent without a job_id never pass through here, so interactive traffic is not held back.
+
+Run one scheduler next to the gateway:
+
+    python scheduler.py --max-queued 8
+"""
+import argparse
+import logging
+import time
+
+import redis
+
+from celery_app import app as celery_app, jobs, ledger, send_ai_task
+from costs import BudgetGuard
+
+logger = logging.getLogger(__name__)
+
+
+class FairScheduler:
+    """
+    Args:
+    store (JobStore): where jobs and their pending tasks live
+    dispatch (callable): dispatch(job_id, task_id, args) sends one task to the broker
+    queue_depth (callable): number of tasks waiting in the broker queue
+    max_queued (int): broker queue depth to keep topped up to; about the workers' total concurrency is enough
+    budget (BudgetGuard): slows, downgrades or pauses jobs near their budget; None for no budgets
+    """
+
+    def __init__(self, store, dispatch, queue_depth, max_queued=8, budget=None):
+        self.store = store
+        self.dispatch = dispatch
+        self.queue_depth = queue_depth
+        self.max_queued = max_queued
+        self.budget = budget
+        self.credits = {}
+
+    def tick(self):
+        """Fill the broker queue up to max_queued; returns the number of tasks dispatched."""
+        room = self.max_queued - self.queue_depth()
+        active = self.store.active()
+        for job_id, job in active.items():
+            if not job['pending'] and not job['in_flight']:
+                self.store.retire(job_id)
+        actions = self.budget.actions(active) if self.budget is not None and active else {}
+        runnable = {}
+        for job_id, job in active.items():
+            # A paused job stays active, and resumes once its budget is raised or the day turns over
+            if self.budget is not None and not self.budget.apply(job, actions.get(job_id)):
+                continue
+            # A job without positive weight never earns a whole credit, and would keep the loop below spinning
+            if job['weight'] > 0 and job['pending'] and not (job['quota'] and job['in_flight'] >= job['quota']):
+                runnable[job_id] = job
+        # Credit is only kept by jobs that are waiting to run, so an idle job cannot save up a burst
+        self.credits = {job_id: self.credits.get(job_id, 0.0) for job_id in runnable}
+
+        dispatched = 0
+        while room > 0 and runnable:
+            for job_id in list(runnable):
+                job = runnable[job_id]
+                self.credits[job_id] += job['weight']
+                while self.credits[job_id] >= 1 and room > 0 and job['pending'] and \
+                        not (job['quota'] and job['in_flight'] >= job['quota']):
+                    item = self.store.pop(job_id)
+                    if item is None:
+                        job['pending'] = 0
+                        break
+                    task_id, args = item
+                    if self.budget is not None:
+                        args = self.budget.task_args(args, actions.get(job_id))
+                    self.dispatch(job_id, task_id, args)
+                    self.credits[job_id] -= 1
+                    job['pending'] -= 1
+                    job['in_flight'] += 1
+                    room -= 1
+                    dispatched += 1
+                if not job['pending'] or (job['quota'] and job['in_flight'] >= job['quota']):
+                    del runnable[job_id]
+                    self.credits.pop(job_id, None)
+                if room <= 0:
+                    break
+        return dispatched
+
+    def run(self, interval=0.05):
+        while True:
+            try:
+                dispatched = self.tick()
+            except redis.RedisError as e:
+                logger.error(f"Scheduler tick failed: {e}")
+                dispatched = 0
+            if not dispatched:
+                time.sleep(interval)
+
+
+def dispatch_task(job_id, task_id, args):
+    send_ai_task(**args, task_id=task_id, job_id=job_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dispatch grading jobs' tasks to the broker in fair shares")
+    parser.add_argument('--max-queued', type=int, default=8,
+                        help="tasks to keep waiting in the broker queue; about the workers' total concurrency")
+    parser.add_argument('--interval', type=float, default=0.05, help="seconds between polls when idle")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    broker_client = redis.Redis.from_url(celery_app.conf.broker_url)
+    queue = celery_app.conf.task_default_queue
+    scheduler = FairScheduler(jobs, dispatch_task, lambda: broker_client.llen(queue), args.max_queued,
+                              BudgetGuard(ledger))
+    logger.info(f"Scheduling jobs into queue {queue} with at most {args.max_queued} tasks waiting")
+    scheduler.run(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,80 @@
 # test_celery_tasks.py
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
-from unittest.mock import patch, MagicMock
-from celery_config import call_ai_api, call_openai_api, call_claude_api
+from unittest.mock import ANY, AsyncMock, patch, MagicMock
+import cv2
+import httpx
+import numpy as np
+import openai
+import requests
+from celery.exceptions import Retry
+from celery_config import call_ai_api, call_openai_api, call_claude_api, choose_model, encode_images, is_retryable
+from celery_config import call_ai_api_img, finish_task_span, start_task_span
+from celery_app import stamp_enqueue_time
+from adaptive_concurrency import AIMDController, ResultTimeout, run_adaptive, should_resubmit
+from answer_cells import answered_questions, compose_rows
+from autoscaler import ScalingPolicy
+from costs import BudgetGuard, current_usage, end_task, image_tokens, start_task
+from gradebook import QuestionStats, csv_chunks, gradebook_rows
+from grading_manifest import RunManifest, changed_items, text_hash
+from hedging import hedged_call, percentile
+from jobs import JobStore
+from image_utils import encode_jpeg, image_to_base64
+from metrics import Metrics
+from resilience import CircuitOpenError, backoff_delay
+from scheduler import FairScheduler
+from token_stream import TokenPublisher, read_events
+import tracing
 
 
 class TestCeleryTasks(unittest.TestCase):
 
+    def setUp(self):
+        # Keep the tests independent of whatever breaker state the shared Redis holds
+        breaker = patch('celery_config.breaker').start()
+        breaker.allow.return_value = True
+        self.addCleanup(patch.stopall)
+
     @patch('celery_config.call_openai_api')
     def test_call_ai_api_gpt(self, mock_openai):
         mock_openai.return_value = "OpenAI response"
         result = call_ai_api("gpt-3.5-turbo", "System prompt", "User request")
-        self.assertEqual(result, "OpenAI response")
+        self.assertEqual(result['result'], "OpenAI response")
         mock_openai.assert_called_once_with("gpt-3.5-turbo", "System prompt", "User request")
 
     @patch('celery_config.call_claude_api')
     def test_call_ai_api_claude(self, mock_claude):
         mock_claude.return_value = "Claude response"
         result = call_ai_api("claude-3-haiku-20240307", "System prompt", "User request")
-        self.assertEqual(result, "Claude response")
+        self.assertEqual(result['result'], "Claude response")
         mock_claude.assert_called_once_with("claude-3-haiku-20240307", "System prompt", "User request")
 
     def test_call_ai_api_unsupported_model(self):
         with self.assertRaises(ValueError):
             call_ai_api("unsupported-model", "System prompt", "User request")
 
-    @patch('celery_config.openai.ChatCompletion.create')
-    def test_call_openai_api(self, mock_create):
+    @patch('celery_config.get_openai_client')
+    def test_call_openai_api(self, mock_client):
+        mock_create = mock_client.return_value.chat.completions.create
         mock_response = MagicMock()
-        mock_response.choices[0].message = {'content': 'OpenAI response'}
+        mock_response.choices[0].message.content = 'OpenAI response'
         mock_create.return_value = mock_response
 
         result = call_openai_api("gpt-3.5-turbo", "System prompt", "User request")
         self.assertEqual(result, "OpenAI response")
         mock_create.assert_called_once()
 
-    @patch('celery_config.anthropic.completions.create')
-    def test_call_claude_api(self, mock_create):
+    @patch('celery_config.get_anthropic_client')
+    def test_call_claude_api(self, mock_client):
+        mock_create = mock_client.return_value.messages.create
         mock_response = MagicMock()
-        mock_response.completion = 'Claude response'
+        mock_response.content[0].text = 'Claude response'
         mock_create.return_value = mock_response
 
         result = call_claude_api("claude-3-haiku-20240307", "System prompt", "User request")
@@ -45,5 +82,524 @@ class TestCeleryTasks(unittest.TestCase):
         mock_create.assert_called_once()
 
 
+class TestGateway(unittest.TestCase):
+
+    def test_master_imports_without_worker_dependencies(self):
+        # The gateway must start without provider SDKs, OpenCV or secrets.json
+        code = ("import sys, master; "
+                "print(sorted(m for m in ('cv2', 'openai', 'anthropic', 'celery_config') if m in sys.modules))")
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.strip().splitlines()[-1], '[]')
+
+    @patch('gateway.send_ai_task')
+    def test_async_gateway_validates_before_enqueueing(self, mock_send):
+        import asyncio
+        import gateway
+
+        async def post(body):
+            response = await gateway.app.test_client().post('/call_ai', json=body)
+            return response.status_code, await response.get_json()
+
+        status, body = asyncio.run(post({"model_name": "", "user_request": 3}))
+        self.assertEqual(status, 400)
+        self.assertEqual({e['loc'][0] for e in body['errors']}, {'model_name', 'system_prompt', 'user_request'})
+        mock_send.assert_not_called()
+
+        mock_send.return_value = MagicMock(id='task-1')
+        status, body = asyncio.run(post({"model_name": "gpt-4o", "system_prompt": "s", "user_request": "u"}))
+        self.assertEqual((status, body['task_id']), (202, 'task-1'))
+        mock_send.assert_called_once_with('gpt-4o', 's', 'u', None, True, False, None)
+
+    def test_async_gateway_relays_the_token_stream(self):
+        import asyncio
+        import gateway
+
+        def entry(entry_id, event, data):
+            return entry_id.encode(), {b'event': event.encode(), b'data': json.dumps(data).encode()}
+
+        client = MagicMock()
+        client.xread = AsyncMock(return_value=[(b'ai_tasks:stream:task-1', [entry('2-0', 'token', 'Hi'),
+                                                                            entry('3-0', 'done', 'Hi')])])
+
+        async def get():
+            response = await gateway.app.test_client().get('/stream/task-1', headers={'Last-Event-ID': '1-0'})
+            return response.status_code, response.mimetype, (await response.get_data()).decode()
+
+        with patch.object(gateway.app, 'backend_client', client, create=True):
+            status, mimetype, body = asyncio.run(get())
+        self.assertEqual((status, mimetype), (200, 'text/event-stream'))
+        self.assertEqual(body, 'id: 2-0\nevent: token\ndata: "Hi"\n\nid: 3-0\nevent: done\ndata: "Hi"\n\n')
+        client.xread.assert_called_once_with({'ai_tasks:stream:task-1': '1-0'}, block=15000, count=100)
+
+
+class TestHedging(unittest.TestCase):
+
+    def test_percentile(self):
+        self.assertEqual(percentile(list(range(1, 101)), 95), 95)
+        self.assertIsNone(percentile([], 95))
+
+    def test_primary_within_deadline_is_not_hedged(self):
+        hedge = MagicMock()
+        result, winner, hedged = hedged_call(lambda: "primary", hedge, deadline=1.0)
+        self.assertEqual((result, winner, hedged), ("primary", "primary", False))
+        hedge.assert_not_called()
+
+    def test_slow_primary_is_hedged(self):
+        def slow():
+            time.sleep(0.5)
+            return "primary"
+        result, winner, hedged = hedged_call(slow, lambda: "hedge", deadline=0.05)
+        self.assertEqual((result, winner, hedged), ("hedge", "hedge", True))
+
+    def test_failed_hedge_waits_for_primary(self):
+        def slow():
+            time.sleep(0.2)
+            return "primary"
+        def failing():
+            raise RuntimeError("provider down")
+        result, winner, hedged = hedged_call(slow, failing, deadline=0.05)
+        self.assertEqual((result, winner), ("primary", "primary"))
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_transient_errors_are_retryable(self):
+        request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+        rate_limited = openai.RateLimitError('slow down', response=httpx.Response(429, request=request), body=None)
+        bad_request = openai.BadRequestError('bad', response=httpx.Response(400, request=request), body=None)
+        self.assertTrue(is_retryable(rate_limited))
+        self.assertTrue(is_retryable(openai.APITimeoutError(request)))
+        self.assertTrue(is_retryable(CircuitOpenError('openai')))
+        self.assertFalse(is_retryable(bad_request))
+        self.assertFalse(is_retryable(ValueError("Unsupported model")))
+
+    def test_circuit_open_error_survives_the_result_backend(self):
+        from celery_app import app as celery_app
+        backend = celery_app.backend
+        restored = backend.exception_to_python(backend.prepare_exception(CircuitOpenError('openai', 12.5)))
+        self.assertIsInstance(restored, CircuitOpenError)
+        self.assertEqual(str(restored), 'Circuit breaker open for openai')
+        self.assertEqual((restored.provider, restored.retry_in), ('openai', 12.5))
+
+    def test_backoff_is_jittered_and_capped(self):
+        delays = [backoff_delay(10, base=2.0, cap=60.0) for _ in range(200)]
+        self.assertTrue(all(0 <= d <= 60.0 for d in delays))
+        self.assertGreater(len(set(delays)), 1)
+        self.assertEqual(backoff_delay(0, base=2.0, cap=60.0, minimum=5.0), 5.0)
+
+    @patch('celery_config.breaker')
+    def test_open_breaker_fails_over_to_equivalent_model(self, mock_breaker):
+        mock_breaker.allow.side_effect = lambda provider: provider == 'openai'
+        self.assertEqual(choose_model('claude-3-haiku-20240307'), 'gpt-4o-mini')
+        mock_breaker.allow.side_effect = lambda provider: False
+        mock_breaker.retry_in.return_value = 12.0
+        with self.assertRaises(CircuitOpenError):
+            choose_model('claude-3-haiku-20240307')
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+
+    def test_limit_grows_and_halves_on_rate_limit(self):
+        controller = AIMDController(initial=2, maximum=8)
+        for _ in range(20):
+            controller.on_success(0.01)
+        grown = controller.limit
+        self.assertGreater(grown, 4)
+        controller.on_failure(Exception("RateLimitError: slow down"))
+        self.assertAlmostEqual(controller.limit, grown / 2)
+        controller.on_failure(ValueError("bad input"))
+        self.assertAlmostEqual(controller.limit, grown / 2)
+
+    def test_overloaded_items_are_retried(self):
+        attempts = {}
+
+        def flaky(item):
+            attempts[item] = attempts.get(item, 0) + 1
+            if item == 'b' and attempts[item] == 1:
+                raise Exception("RateLimitError: slow down")
+            return item.upper()
+
+        results = {}
+        stats = run_adaptive('abc', flaky, AIMDController(initial=2, maximum=4),
+                             on_result=results.__setitem__, report_interval=60)
+        self.assertEqual(results, {'a': 'A', 'b': 'B', 'c': 'C'})
+        self.assertEqual((stats['completed'], stats['failed']), (3, 0))
+
+    def test_poll_timeouts_are_not_resubmitted(self):
+        attempts = {}
+
+        def slow(item):
+            attempts[item] = attempts.get(item, 0) + 1
+            if item == 'a':
+                # The gateway was unreachable, so nothing was enqueued and the call can be sent again
+                if attempts[item] == 1:
+                    raise requests.ConnectionError("connection refused")
+                return 'A'
+            # The task is still running; sending it again would start a second paid call
+            raise ResultTimeout("获取结果超时")
+
+        controller = AIMDController(initial=4, maximum=4)
+        stats = run_adaptive('ab', slow, controller, report_interval=60)
+        self.assertEqual(attempts, {'a': 2, 'b': 1})
+        self.assertEqual((stats['completed'], stats['failed']), (1, 1))
+        self.assertLess(controller.limit, 4)
+        self.assertFalse(should_resubmit(requests.ReadTimeout()))
+        self.assertTrue(should_resubmit(Exception("RateLimitError: slow down")))
+
+
+class TestGradingManifest(unittest.TestCase):
+
+    def test_only_changed_key_items_are_recompared(self):
+        key_hashes = {'1': text_hash('4'), '2': text_hash('24')}
+        entry = {'compare_version': 'v1', 'key_hashes': dict(key_hashes), 'verdicts': {'1': 'correct', '2': 'incorrect'}}
+        self.assertEqual(changed_items(entry, key_hashes, 'v1'), [])
+        self.assertEqual(changed_items(entry, {**key_hashes, '2': text_hash('12')}, 'v1'), ['2'])
+        self.assertEqual(changed_items(entry, key_hashes, 'v2'), ['1', '2'])
+        self.assertEqual(changed_items({}, key_hashes, 'v1'), ['1', '2'])
+
+    @patch('Task_AnswerSheetReview.compare_answers')
+    def test_changed_key_items_are_recompared_over_earlier_verdicts(self, mock_compare):
+        from Task_AnswerSheetReview import judge_answers
+        answer_key = {'1': '4', '2': '25', '3': 'pi', '4': '7'}
+        extracted = {'1': '4', '2': '24', '3': '', '4': ''}
+        earlier = {'1': 'correct', '2': 'correct', '3': 'review_required', '4': 'incorrect'}
+        mock_compare.return_value = '{"2": "incorrect"}'
+
+        # '2' and '4' changed in the key; '4' is blank on this sheet, so only '2' goes to the model
+        verdicts = judge_answers(extracted, answer_key, ['2', '4'], earlier)
+        mock_compare.assert_called_once_with(extracted, answer_key, ['2'])
+        self.assertEqual(verdicts, {'1': 'correct', '2': 'incorrect', '3': 'review_required', '4': 'review_required'})
+
+    def test_checkpoint_survives_restart(self):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'manifest.json')
+        with RunManifest(path, checkpoint_interval=60) as manifest:
+            manifest.update('s1', status='done', verdicts={'1': 'correct'})
+        self.assertEqual(RunManifest(path).get('s1')['verdicts'], {'1': 'correct'})
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['manifest.json'])
+
+
+class TestAnswerCells(unittest.TestCase):
+
+    def test_only_rows_with_ink_are_answered(self):
+        column = np.full((600, 300), 240, dtype=np.uint8)
+        cv2.rectangle(column, (0, 0), (299, 599), 20, 3)
+        for i in range(12):
+            cv2.line(column, (0, i * 50), (299, i * 50 + 3), 110, 2)
+            cv2.putText(column, f"{i + 1}.", (5, i * 50 + 35), cv2.FONT_HERSHEY_SIMPLEX, 0.6, 90, 1)
+        for row, text in ((1, "24"), (4, "(2,3)")):
+            cv2.putText(column, text, (80, row * 50 + 35), cv2.FONT_HERSHEY_SIMPLEX, 0.9, 30, 2)
+        self.assertEqual(answered_questions(column), ['2', '5'])
+        self.assertEqual(compose_rows(column, ['2', '5']).shape, (100, 300))
+
+
+class TestImages(unittest.TestCase):
+
+    def test_jpeg_files_are_sent_without_reencoding(self):
+        data = encode_jpeg(np.full((40, 60, 3), 200, dtype=np.uint8))
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'crop.jpg')
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.assertEqual(base64.b64decode(image_to_base64(path)), data)
+        self.assertEqual(encode_images([path], ['inline']), [image_to_base64(path), 'inline'])
+        with self.assertRaises(ValueError):
+            encode_images([path + '.missing'])
+
+
+class TestFairScheduler(unittest.TestCase):
+
+    def test_jobs_are_interleaved_by_weight_within_quota(self):
+        pending = {'big': [f'big-{i}' for i in range(10)], 'small': ['small-0', 'small-1', 'small-2'],
+                   'capped': ['capped-0', 'capped-1']}
+        settings = {'big': (1.0, 0), 'small': (2.0, 0), 'capped': (1.0, 1)}
+        store = MagicMock()
+        store.active.side_effect = lambda: {
+            job_id: {'weight': settings[job_id][0], 'quota': settings[job_id][1], 'pending': len(tasks),
+                     'in_flight': 0} for job_id, tasks in pending.items()}
+        store.pop.side_effect = lambda job_id: (pending[job_id].pop(0), {}) if pending[job_id] else None
+        sent = []
+        scheduler = FairScheduler(store, lambda job_id, task_id, args: sent.append(task_id), lambda: 0, max_queued=7)
+
+        self.assertEqual(scheduler.tick(), 7)
+        self.assertEqual(sent, ['big-0', 'small-0', 'small-1', 'capped-0', 'big-1', 'small-2', 'big-2'])
+
+    def test_jobs_without_positive_weight_are_not_run(self):
+        weights = {'zero': 0.0, 'negative': -1.0, 'ok': 1.0}
+        store = MagicMock()
+        store.active.return_value = {job_id: {'weight': weight, 'quota': 0, 'pending': 3, 'in_flight': 0}
+                                     for job_id, weight in weights.items()}
+        store.pop.side_effect = lambda job_id: (f'{job_id}-task', {})
+        sent = []
+        scheduler = FairScheduler(store, lambda job_id, task_id, args: sent.append(task_id), lambda: 0, max_queued=8)
+
+        self.assertEqual(scheduler.tick(), 3)
+        self.assertEqual(sent, ['ok-task'] * 3)
+        with self.assertRaises(ValueError):
+            JobStore(MagicMock()).create('exam-1', weight=0)
+
+
+class TestGradebook(unittest.TestCase):
+
+    def test_stats_follow_regrades_and_rows_count_verdicts(self):
+        with tempfile.TemporaryDirectory() as folder:
+            stats = QuestionStats(folder)
+            first = {'1': 'correct', '2': 'review_required'}
+            stats.record(None, first)
+            stats.record(None, {'1': 'incorrect', '2': 'correct'})
+            stats.record(first, {'1': 'correct', '2': 'correct'})
+            summary = stats.summary()
+            self.assertEqual(summary['sheets'], 2)
+            self.assertEqual(summary['questions']['2'], {'graded': 2, 'correct': 2, 'incorrect': 0,
+                                                         'review_required': 0, 'percent_correct': 100.0})
+
+        rows = gradebook_rows([('a.jpg', '2024001', {'1': 'correct', '2': 'review_required'})], ['1', '2'])
+        text = b''.join(csv_chunks(rows)).decode('utf-8-sig')
+        self.assertEqual(text.splitlines(), ['folder,student_id,Q1,Q2,correct,review_required,questions',
+                                             'a.jpg,2024001,correct,review_required,1,1,2'])
+
+
+class TestAutoscaler(unittest.TestCase):
+
+    def test_scales_up_in_steps_holds_when_throttled_and_drains_slowly(self):
+        policy = ScalingPolicy(min_workers=1, max_workers=6, tasks_per_worker=4, max_task_age=30.0, scale_up_step=2,
+                               scale_down_delay=60.0)
+        backlog = {'queued': 30, 'in_flight': 4, 'pending': 0, 'oldest_age': 5.0, 'throttled': False}
+        self.assertEqual(policy.desired(1, backlog, now=0), 3)
+        self.assertEqual(policy.desired(3, backlog, now=5), 5)
+        self.assertEqual(policy.desired(5, backlog, now=10), 6)
+        self.assertEqual(policy.desired(2, {**backlog, 'throttled': True}, now=15), 2)
+
+        # A small backlog whose oldest task has waited too long still gets one more worker
+        self.assertEqual(policy.desired(2, {**backlog, 'queued': 1, 'in_flight': 0, 'oldest_age': 45.0}, now=20), 3)
+
+        idle = {'queued': 0, 'in_flight': 0, 'pending': 0, 'oldest_age': None, 'throttled': False}
+        self.assertEqual(policy.desired(6, idle, now=100), 6)
+        self.assertEqual(policy.desired(6, idle, now=159), 6)
+        self.assertEqual(policy.desired(6, idle, now=160), 5)
+        self.assertEqual(policy.desired(5, idle, now=170), 5)
+        self.assertEqual(policy.desired(5, idle, now=220), 4)
+
+
+class TestCosts(unittest.TestCase):
+
+    @patch('celery_config.ledger')
+    @patch('celery_config.breaker')
+    @patch('celery_config.get_openai_client')
+    def test_task_returns_and_records_its_usage(self, mock_client, mock_breaker, mock_ledger):
+        mock_breaker.allow.return_value = True
+        response = MagicMock()
+        response.choices[0].message.content = 'ok'
+        response.usage = MagicMock(spec=['prompt_tokens', 'completion_tokens'], prompt_tokens=1000,
+                                   completion_tokens=200)
+        mock_client.return_value.chat.completions.create.return_value = response
+        image = base64.b64encode(encode_jpeg(np.full((1024, 512, 3), 255, np.uint8))).decode()
+
+        # What the task_prerun handler does for a task sent with a job_id header
+        token = start_task('exam-1')
+        try:
+            usage = call_ai_api_img('gpt-4o', 'System', 'Grade', hedge=False, images=[image])['usage']
+        finally:
+            end_task(token)
+        self.assertEqual(usage, {'input_tokens': 1000, 'output_tokens': 200, 'image_tokens': 425,
+                                 'cost_usd': 0.0045, 'calls': 1})
+        self.assertEqual(image_tokens('anthropic', image), 700)
+        mock_ledger.record.assert_called_once()
+        self.assertEqual(mock_ledger.record.call_args[0][:2], ('gpt-4o', 'exam-1'))
+
+    @patch('celery_config.ledger')
+    def test_usage_is_carried_across_retries(self, mock_ledger):
+        from celery_config import record_usage, retry_or_raise
+        labels = {'model': 'gpt-4o', 'provider': 'openai'}
+        usage = MagicMock(spec=['prompt_tokens', 'completion_tokens'], prompt_tokens=1000, completion_tokens=200)
+        task = MagicMock(max_retries=3)
+        task.request.retries = 0
+        task.request.headers = {'job_id': 'exam-1'}
+        task.retry.return_value = Retry()
+
+        # The first attempt is billed and then times out
+        token = start_task('exam-1')
+        try:
+            record_usage(labels, usage)
+            with self.assertRaises(Retry):
+                retry_or_raise(task, openai.APITimeoutError(httpx.Request('POST', 'https://api.openai.com')))
+        finally:
+            end_task(token)
+        headers = task.retry.call_args.kwargs['headers']
+        self.assertEqual(headers['job_id'], 'exam-1')
+
+        token = start_task('exam-1', headers['prior_usage'])
+        try:
+            record_usage(labels, usage)
+            self.assertEqual(current_usage(), {'input_tokens': 2000, 'output_tokens': 400, 'image_tokens': 0,
+                                               'cost_usd': 0.009, 'calls': 2})
+        finally:
+            end_task(token)
+
+    def test_jobs_near_budget_are_slowed_downgraded_then_paused(self):
+        spent = {'free': 50.0, 'slowed': 8.5, 'downgraded': 9.5, 'paused': 10.0}
+        pending = {job_id: [f'{job_id}-{i}' for i in range(3)] for job_id in spent}
+        ledger = MagicMock()
+        ledger.spent.return_value = (sum(spent.values()), spent)
+        ledger.daily_budget.return_value = None
+        store = MagicMock()
+        store.active.side_effect = lambda: {
+            job_id: {'weight': 1.0, 'quota': 0, 'pending': len(tasks), 'in_flight': 0,
+                     'budget_usd': None if job_id == 'free' else 10.0} for job_id, tasks in pending.items()}
+        store.pop.side_effect = lambda job_id: (pending[job_id].pop(0), {'model_name': 'gpt-4o'})
+        sent = []
+        scheduler = FairScheduler(store, lambda job_id, task_id, args: sent.append((task_id, args['model_name'])),
+                                  lambda: 0, max_queued=8, budget=BudgetGuard(ledger))
+
+        self.assertEqual(scheduler.tick(), 5)
+        self.assertEqual(sent, [('free-0', 'gpt-4o'), ('slowed-0', 'gpt-4o'), ('downgraded-0', 'gpt-4o-mini'),
+                                ('free-1', 'gpt-4o'), ('free-2', 'gpt-4o')])
+
+        # The day's budget holds back every job, the one without a budget of its own too
+        ledger.daily_budget.return_value = 60.0
+        scheduler.budget.read_at = None
+        self.assertEqual(scheduler.tick(), 0)
+
+
+class TestTokenStream(unittest.TestCase):
+
+    @staticmethod
+    def published(client):
+        return [(c.args[1]['event'], json.loads(c.args[1]['data']))
+                for c in client.pipeline.return_value.xadd.call_args_list]
+
+    def test_tokens_are_batched_and_end_with_done_or_error(self):
+        client = MagicMock()
+        publisher = TokenPublisher(client, 'task-1')
+        with patch('token_stream.time.monotonic', side_effect=[100.0, 100.0, 100.01, 100.02, 100.1, 100.1, 100.1]):
+            for text in ['Hel', 'lo', ' wor', 'ld']:
+                publisher.token(text)
+            publisher.done({'answer': 'Hello world'})
+        # The first token goes out at once; the rest are sent when FLUSH_INTERVAL has passed
+        self.assertEqual(self.published(client), [('token', 'Hel'), ('token', 'lo world'),
+                                                  ('done', {'answer': 'Hello world'})])
+        client.pipeline.return_value.xadd.assert_called_with('ai_tasks:stream:task-1', ANY, maxlen=10000,
+                                                             approximate=True)
+
+        client = MagicMock()
+        publisher = TokenPublisher(client, 'task-2')
+        publisher.token('partial')
+        publisher.error('RateLimitError: slow down')
+        self.assertEqual(self.published(client), [('token', 'partial'), ('error', 'RateLimitError: slow down')])
+
+    def test_read_events_resumes_keeps_alive_and_stops_at_the_final_event(self):
+        def entry(entry_id, event, data):
+            return entry_id.encode(), {b'event': event.encode(), b'data': json.dumps(data).encode()}
+
+        key = b'ai_tasks:stream:task-1'
+        client = MagicMock()
+        client.xread.side_effect = [
+            [(key, [entry('5-0', 'token', 'a'), entry('6-0', 'token', 'b')])],
+            [],
+            [(key, [entry('7-0', 'error', 'boom'), entry('8-0', 'token', 'never read')])],
+        ]
+        events = list(read_events(client, 'task-1', last_id='4-0', block_ms=10))
+
+        self.assertEqual(events, [('5-0', 'token', 'a'), ('6-0', 'token', 'b'), (None, 'keepalive', None),
+                                  ('7-0', 'error', 'boom')])
+        # Reading starts after the client's Last-Event-ID and continues after the last entry it was sent
+        self.assertEqual([c.args[0] for c in client.xread.call_args_list],
+                         [{'ai_tasks:stream:task-1': '4-0'}, {'ai_tasks:stream:task-1': '6-0'},
+                          {'ai_tasks:stream:task-1': '6-0'}])
+
+
+class FakeHashes:
+    """The few Redis hash commands Metrics uses, in memory."""
+
+    def __init__(self):
+        self.hashes = {}
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def hincrbyfloat(self, key, field, amount):
+        fields = self.hashes.setdefault(key, {})
+        fields[field.encode()] = fields.get(field.encode(), 0) + amount
+
+    hincrby = hincrbyfloat
+
+    def execute(self):
+        pass
+
+    def hgetall(self, key):
+        return {field: str(value).encode() for field, value in self.hashes.get(key, {}).items()}
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render_counters_histograms_and_escaped_labels(self):
+        client = FakeHashes()
+        metrics = Metrics(lambda: client)
+        metrics.inc('ai_tasks_total', {'task': 'ai_tasks.call_ai_api', 'status': 'success'}, 3)
+        metrics.inc('ai_provider_errors_total', {'type': 'APIError', 'status': 'say "hi"\\\n'})
+        for seconds in (0.2, 0.3, 4.0, 500.0):
+            metrics.observe('ai_task_latency_seconds', seconds, {'stage': 'provider'})
+        lines = metrics.render([('ai_queue_depth', 'Tasks waiting.', [({'queue': 'celery'}, 7)])]).splitlines()
+
+        self.assertEqual(lines[:3], ['# HELP ai_queue_depth Tasks waiting.', '# TYPE ai_queue_depth gauge',
+                                     'ai_queue_depth{queue="celery"} 7'])
+        self.assertIn('# TYPE ai_tasks_total counter', lines)
+        self.assertIn('ai_tasks_total{task="ai_tasks.call_ai_api",status="success"} 3', lines)
+        self.assertIn('ai_provider_errors_total{type="APIError",status="say \\"hi\\"\\\\\\n"} 1', lines)
+
+        histogram = [line for line in lines if line.startswith('ai_task_latency_seconds')]
+        buckets = {line.split('le="')[1].split('"')[0]: line.rsplit(' ', 1)[1]
+                   for line in histogram if '_bucket' in line}
+        self.assertEqual((buckets['0.1'], buckets['0.25'], buckets['0.5'], buckets['5'], buckets['120']),
+                         ('0', '1', '2', '3', '3'))
+        self.assertEqual(buckets['+Inf'], '4')
+        self.assertEqual(list(buckets)[-1], '+Inf')
+        self.assertIn('ai_task_latency_seconds_sum{stage="provider"} 504.5', histogram)
+        self.assertIn('ai_task_latency_seconds_count{stage="provider"} 4', histogram)
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        # Keep test spans out of traces.jsonl
+        patch('tracing._exporter').start()
+        self.addCleanup(patch.stopall)
+
+    def test_parse_traceparent(self):
+        trace_id, parent_id = '4bf92f3577b34da6a3ce929d0e0e4736', '00f067aa0ba902b7'
+        self.assertEqual(tracing.parse_traceparent(f'00-{trace_id}-{parent_id}-01'), (trace_id, parent_id))
+        self.assertEqual(tracing.parse_traceparent('garbage'), (None, None))
+        self.assertEqual(tracing.parse_traceparent(None), (None, None))
+
+    def test_task_continues_the_callers_trace_through_the_publish_headers(self):
+        trace_id, parent_id = tracing.parse_traceparent('00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01')
+        enqueue_span = tracing.start_span('gateway.call_ai', trace_id=trace_id, parent_id=parent_id)
+        token = tracing.activate(enqueue_span)
+        headers = {}
+        try:
+            stamp_enqueue_time(headers=headers)
+        finally:
+            tracing.deactivate(token)
+        self.assertEqual((headers['trace_id'], headers['parent_span_id']), (trace_id, enqueue_span.span_id))
+
+        # The worker reads the headers back from the task's request
+        task = MagicMock()
+        task.name = 'ai_tasks.call_ai_api'
+        task.request.get.side_effect = lambda name: headers.get(name)
+        start_task_span(task_id='task-1', task=task, args=['gpt-4o'], kwargs={})
+        try:
+            with tracing.span('provider.call') as provider_span:
+                time.sleep(0.01)
+            task_span = tracing.current_span()
+            timings = tracing.current_timings()
+        finally:
+            finish_task_span(task_id='task-1', state='SUCCESS')
+
+        self.assertEqual((task_span.trace_id, task_span.parent_id), (trace_id, enqueue_span.span_id))
+        self.assertEqual((provider_span.trace_id, provider_span.parent_id), (trace_id, task_span.span_id))
+        self.assertIn('broker.wait', timings)
+        self.assertGreaterEqual(timings['provider.call'], 0.01)
+        self.assertIsNone(tracing.current_span())
+
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,104 @@
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+STREAM_KEY_PREFIX = 'ai_tasks:stream:'
+STREAM_TTL = 3600
+STREAM_MAXLEN = 10000
+FLUSH_INTERVAL = 0.05
+
+
+class StreamInterruptedError(Exception):
+    """A provider call failed after some of its tokens had already been published."""
+
+
+def stream_key(task_id):
+    return STREAM_KEY_PREFIX + task_id
+
+
+class TokenPublisher:
+    """Appends a task's tokens to its Redis stream, batching them so each token is not a separate round trip."""
+
+    def __init__(self, client, task_id):
+        self.client = client
+        self.key = stream_key(task_id)
+        self.buffer = []
+        self.last_flush = 0.0
+        self.started = False
+
+    def token(self, text):
+        self.started = True
+        self.buffer.append(text)
+        # The first token is flushed immediately so time-to-first-token is not delayed by batching
+        if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self._add('token', ''.join(self.buffer))
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def done(self, result):
+        self.flush()
+        self._add('done', result)
+
+    def error(self, message):
+        self.flush()
+        self._add('error', message)
+
+    def _add(self, event, data):
+        try:
+            pipe = self.client.pipeline()
+            pipe.xadd(self.key, {'event': event, 'data': json.dumps(data, ensure_ascii=False)},
+                      maxlen=STREAM_MAXLEN, approximate=True)
+            pipe.expire(self.key, STREAM_TTL)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not publish {event} to {self.key}: {e}")
+
+
+def read_events(client, task_id, last_id='0', block_ms=15000):
+    """
+    Yield (entry_id, event, data) from a task's stream until its 'done' or 'error' event.
+
+    Yields (None, 'keepalive', None) whenever block_ms passes without new entries.
+    """
+    key = stream_key(task_id)
+    while True:
+        response = client.xread({key: last_id}, block=block_ms, count=100)
+        if not response:
+            yield None, 'keepalive', None
+            continue
+        for last_id, event, data in parse_entries(response):
+            yield last_id, event, data
+            if event in ('done', 'error'):
+                return
+
+
+async def read_events_async(client, task_id, last_id='0', block_ms=15000):
+    """read_events() for a redis.asyncio client, so the ASGI gateway can relay a stream without blocking its loop."""
+    key = stream_key(task_id)
+    while True:
+        response = await client.xread({key: last_id}, block=block_ms, count=100)
+        if not response:
+            yield None, 'keepalive', None
+            continue
+        for last_id, event, data in parse_entries(response):
+            yield last_id, event, data
+            if event in ('done', 'error'):
+                return
+
+
+def parse_entries(response):
+    for entry_id, fields in response[0][1]:
+        yield entry_id.decode(), fields[b'event'].decode(), json.loads(fields[b'data'])
+
+
+def format_sse(entry_id, event, data):
+    """One Server-Sent Events message, or a comment line for a keepalive."""
+    if event == 'keepalive':
+        return ": keepalive\n\n"
+    return f"id: {entry_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -0,0 +1,171 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = 'ai_tasks'
+# Batches are appended as OTLP/JSON lines, which an OpenTelemetry collector can ingest with its otlpjsonfile receiver
+TRACE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces.jsonl')
+# Set to e.g. 'http://localhost:4318' to also POST batches to an OTLP/HTTP collector
+OTLP_ENDPOINT = None
+FLUSH_INTERVAL = 1.0
+
+_current = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, attributes=None, start=None, timings=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = start if start is not None else time.time()
+        self.end = None
+        self.error = None
+        # Shared by a task's span and all of its descendants, summing the time spent in each stage
+        self.timings = timings if timings is not None else {}
+
+    def finish(self, end=None):
+        self.end = end if end is not None else time.time()
+        self.timings[self.name] = self.timings.get(self.name, 0.0) + self.end - self.start
+        _exporter.export(self)
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(int(self.start * 1e9)),
+            'endTimeUnixNano': str(int(self.end * 1e9)),
+            'attributes': [{'key': k, 'value': {'stringValue': str(v)}} for k, v in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def start_span(name, trace_id=None, parent_id=None, start=None, **attributes):
+    """Start a span as a child of the current one, or of trace_id/parent_id when continuing a remote trace."""
+    parent = _current.get()
+    if trace_id is None and parent is not None:
+        return Span(name, parent.trace_id, parent.span_id, attributes, start, parent.timings)
+    return Span(name, trace_id or secrets.token_hex(16), parent_id, attributes, start)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time the enclosed block as a child span of the current span."""
+    current = start_span(name, **attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        current.finish()
+
+
+def activate(current):
+    """Make current the parent of spans started in this context; returns a token for deactivate()."""
+    return _current.set(current)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+def current_span():
+    return _current.get()
+
+
+def current_timings():
+    """Seconds spent per stage so far in the current trace, rounded for storing with a result."""
+    current = _current.get()
+    return {name: round(seconds, 4) for name, seconds in current.timings.items()} if current else {}
+
+
+def inject(headers):
+    """Add the current trace context to outgoing Celery headers."""
+    current = _current.get()
+    if current is not None:
+        headers['trace_id'] = current.trace_id
+        headers['parent_span_id'] = current.span_id
+
+
+def parse_traceparent(value):
+    """Return (trace_id, parent_id) from a W3C traceparent header, or (None, None)."""
+    parts = (value or '').split('-')
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        return parts[1], parts[2]
+    return None, None
+
+
+class _Exporter:
+    """Batches finished spans on a background thread and writes them to TRACE_FILE and OTLP_ENDPOINT."""
+
+    def __init__(self):
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def export(self, finished):
+        self._ensure_started()
+        self.queue.put(finished)
+
+    def _ensure_started(self):
+        # Prefork workers inherit the parent's exporter but not its thread, so each process starts its own
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue()
+                threading.Thread(target=self._run, daemon=True, name='trace-exporter').start()
+                self.pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        if self.queue is None or self.pid != os.getpid():
+            return
+        spans = []
+        while True:
+            try:
+                spans.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if not spans:
+            return
+        payload = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]},
+            'scopeSpans': [{'scope': {'name': SERVICE_NAME}, 'spans': [s.to_otlp() for s in spans]}],
+        }]})
+        try:
+            if TRACE_FILE:
+                with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+                    f.write(payload + '\n')
+            if OTLP_ENDPOINT:
+                import requests
+                requests.post(f"{OTLP_ENDPOINT.rstrip('/')}/v1/traces", data=payload,
+                              headers={'Content-Type': 'application/json'}, timeout=5)
+        except Exception as e:
+            logger.warning(f"Could not export {len(spans)} spans: {e}")
+
+
+_exporter = _Exporter()
+atexit.register(_exporter.flush)
@@ -1,4 +1,6 @@
 # worker.py
+import sys
+
 from celery_config import app
 
 if __name__ == '__main__':
@@ -7,4 +9,5 @@ if __name__ == '__main__':
         '--loglevel=info',
         '-P', 'solo',
     ]
-    app.worker_main(argv)
\ No newline at end of file
+    # Extra options (a node name, another pool) come after the defaults and override them, e.g. from autoscaler.py
+    app.worker_main(argv + sys.argv[1:])